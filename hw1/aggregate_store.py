@@ -0,0 +1,284 @@
+"""Persistent per-day log aggregates.
+
+After each run the day aggregate (per-URL count, timesum, max and quantile
+sketch) is saved to "<store_dir>/<YYYYMMDD>-<hash>-<settings>.agg", so
+multi-day reports merge saved aggregates instead of reparsing raw logs.
+Hash is taken from log size, head and tail, so a replaced log
+for the same day is parsed again; settings digest is taken from aggregator
+settings (sketch alpha, URL rules, top-K capacity), so aggregates built
+with other settings are not merged.
+Checkpoints of the growing current log (read offset and aggregate)
+use the same serialization without timings; exact timings are appended
+to a separate file, so each run writes only timings of new lines.
+"""
+
+from array import array
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import struct
+
+STORE_SUFFIX = '.agg'
+MAGIC = b'LOGAGG\x02'
+CHECKPOINT_MAGIC = b'LOGCKPT\x01'
+HASH_SAMPLE_SIZE = 64 * 1024
+NO_TIMINGS = 2 ** 64 - 1
+
+HEADER = struct.Struct('<dQdQI')
+URL_HEADER = struct.Struct('<IQdddQIQ')
+TIMINGS_HEADER = struct.Struct('<IQ')
+
+
+def content_hash(log_path):
+    '''Sampled content hash: size, first and last 64K of the log.
+    '''
+    size = os.path.getsize(log_path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=8)
+    with open(log_path, 'rb') as log:
+        digest.update(log.read(HASH_SAMPLE_SIZE))
+        log.seek(max(0, size - HASH_SAMPLE_SIZE))
+        digest.update(log.read())
+    return digest.hexdigest()
+
+
+def settings_digest(aggregator):
+    '''Digest of aggregator settings which change saved statistics.
+    '''
+    settings = aggregator.settings()
+    settings.pop('exact_median', None)
+    return hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(),
+                           digest_size=4).hexdigest()
+
+
+def aggregate_path(store_dir, logdate, digest, aggregator):
+    return os.path.join(
+        store_dir,
+        f'{logdate}-{digest}-{settings_digest(aggregator)}{STORE_SUFFIX}')
+
+
+def dumps(aggregator, keep_timings=False):
+    '''Serialize aggregator to bytes.
+    Timings are dropped unless keep_timings is set,
+    then median is estimated by sketch after loading.
+    '''
+    rejected = json.dumps(aggregator.rejected).encode()
+    parts = [MAGIC,
+             HEADER.pack(aggregator.alpha, aggregator.total_count,
+                         aggregator.total_time, len(aggregator),
+                         len(rejected)),
+             rejected]
+    for url, stats in aggregator.items():
+        url = url.encode('utf-8')
+        sketch = stats.sketch
+        indexes = array('q', sketch.buckets.keys())
+        counts = array('Q', sketch.buckets.values())
+        timings = stats.timings if keep_timings else None
+        parts.append(URL_HEADER.pack(
+            len(url), stats.count, stats.time_sum, stats.time_max,
+            stats.error, sketch.zero_count, len(indexes),
+            NO_TIMINGS if timings is None else len(timings)))
+        parts.extend((url, indexes.tobytes(), counts.tobytes()))
+        if timings is not None:
+            parts.append(timings.tobytes())
+    return b''.join(parts)
+
+
+def loads(data, aggregator):
+    '''Fill empty aggregator from serialized bytes.
+    '''
+    if not data.startswith(MAGIC):
+        raise ValueError('not a log aggregate')
+    pos = len(MAGIC)
+    alpha, total_count, total_time, urls_count, rejected_size = \
+        HEADER.unpack_from(data, pos)
+    if alpha != aggregator.alpha:
+        raise ValueError('aggregate was saved with different sketch alpha')
+    pos += HEADER.size
+    aggregator.rejected.update(json.loads(data[pos:pos + rejected_size]))
+    pos += rejected_size
+    aggregator.total_count = total_count
+    aggregator.total_time = total_time
+    for _ in range(urls_count):
+        (url_size, count, time_sum, time_max, error,
+         zero_count, buckets_count, timings_count) = \
+            URL_HEADER.unpack_from(data, pos)
+        pos += URL_HEADER.size
+        url = data[pos:pos + url_size].decode('utf-8')
+        pos += url_size
+        indexes, counts = array('q'), array('Q')
+        indexes.frombytes(data[pos:pos + 8 * buckets_count])
+        pos += 8 * buckets_count
+        counts.frombytes(data[pos:pos + 8 * buckets_count])
+        pos += 8 * buckets_count
+        stats = aggregator.new_stats(url)
+        stats.count = count
+        stats.time_sum = time_sum
+        stats.time_max = time_max
+        stats.error = error
+        stats.sketch.buckets = dict(zip(indexes, counts))
+        stats.sketch.zero_count = zero_count
+        stats.sketch.count = count
+        if timings_count == NO_TIMINGS:
+            stats.timings = None
+        else:
+            stats.timings = array('d')
+            stats.timings.frombytes(data[pos:pos + 8 * timings_count])
+            pos += 8 * timings_count
+    return aggregator
+
+
+def dump(aggregator, path, keep_timings=False):
+    '''Atomically write compressed aggregate file.
+    '''
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb', compresslevel=1) as dumpfile:
+        dumpfile.write(dumps(aggregator, keep_timings))
+    os.replace(tmp_path, path)
+
+
+def load(path, aggregator):
+    '''Fill empty aggregator from aggregate file.
+    '''
+    with gzip.open(path, 'rb') as dumpfile:
+        return loads(dumpfile.read(), aggregator)
+
+
+def day_aggregates(store_dir, logdate):
+    '''All saved aggregate files of the day.
+    '''
+    return glob.glob(os.path.join(store_dir, f'{logdate}-*{STORE_SUFFIX}'))
+
+
+def load_day(store_dir, logdate, log_path, aggregator):
+    '''Fill aggregator with saved day aggregate.
+    Returns None if there's no aggregate for this log content.
+    '''
+    path = aggregate_path(store_dir, logdate, content_hash(log_path),
+                          aggregator)
+    if not os.path.exists(path):
+        return None
+    return safe_load(path, aggregator)
+
+
+def safe_load(path, aggregator):
+    '''Fill aggregator from aggregate file, None if it's damaged.
+    '''
+    try:
+        return load(path, aggregator)
+    except (ValueError, OSError, EOFError, struct.error) as exc:
+        logging.info(f'cannot load aggregate {path}: {exc}')
+        return None
+
+
+def save_day(store_dir, logdate, log_path, aggregator):
+    '''Save day aggregate, stale aggregates of the day are removed.
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    path = aggregate_path(store_dir, logdate, content_hash(log_path),
+                          aggregator)
+    for stale_path in day_aggregates(store_dir, logdate):
+        if stale_path != path:
+            os.remove(stale_path)
+    dump(aggregator, path)
+    logging.info(f'day aggregate saved: {path}')
+    return path
+
+
+def load_saved_day(store_dir, logdate, aggregator):
+    '''Fill aggregator with any saved aggregate of the day built
+    with the same settings, e.g. when raw log is already removed.
+    Damaged aggregates are skipped.
+    '''
+    suffix = f'-{settings_digest(aggregator)}{STORE_SUFFIX}'
+    for path in day_aggregates(store_dir, logdate):
+        if path.endswith(suffix):
+            # a failed load leaves partial data, so each try gets a copy
+            loaded = safe_load(path,
+                               type(aggregator)(**aggregator.settings()))
+            if loaded is not None:
+                return loaded
+    return None
+
+
+def dump_checkpoint(path, state, aggregator, keep_timings=False):
+    '''Atomically save reading state (json-able dict) with aggregate.
+    '''
+    state = json.dumps(state).encode()
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb', compresslevel=1) as checkpoint:
+        checkpoint.write(CHECKPOINT_MAGIC)
+        checkpoint.write(struct.pack('<I', len(state)))
+        checkpoint.write(state)
+        checkpoint.write(dumps(aggregator, keep_timings))
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, aggregator):
+    '''Fill empty aggregator from checkpoint and return reading state.
+    Returns None if there's no valid checkpoint.
+    '''
+    if not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, 'rb') as checkpoint:
+            data = checkpoint.read()
+        if not data.startswith(CHECKPOINT_MAGIC):
+            raise ValueError('not a checkpoint')
+        pos = len(CHECKPOINT_MAGIC)
+        state_size, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        state = json.loads(data[pos:pos + state_size])
+        loads(data[pos + state_size:], aggregator)
+    except (ValueError, OSError, EOFError, struct.error) as exc:
+        logging.info(f'cannot load checkpoint {path}: {exc}')
+        return None
+    return state
+
+
+def append_timings(path, aggregator, size):
+    '''Append timings of aggregator URLs to the timings file.
+    The file is cut to size first, dropping records of a run
+    which didn't save its checkpoint. Returns new file size.
+    '''
+    with open(path, 'ab') as timings_file:
+        timings_file.truncate(size)
+        for url, stats in aggregator.items():
+            if stats.timings:
+                url = url.encode('utf-8')
+                timings_file.write(TIMINGS_HEADER.pack(len(url),
+                                                       len(stats.timings)))
+                timings_file.write(url)
+                timings_file.write(stats.timings.tobytes())
+        return timings_file.tell()
+
+
+def load_timings(path, aggregator, size):
+    '''Set timings of aggregator URLs from the first size bytes
+    of the timings file. Returns False if the file is shorter
+    or timings don't match URL counts.
+    '''
+    try:
+        with open(path, 'rb') as timings_file:
+            data = timings_file.read(size)
+    except FileNotFoundError:
+        data = b''
+    if len(data) < size:
+        return False
+    timings = {}
+    pos = 0
+    while pos < size:
+        url_size, count = TIMINGS_HEADER.unpack_from(data, pos)
+        pos += TIMINGS_HEADER.size
+        url = data[pos:pos + url_size].decode('utf-8')
+        pos += url_size
+        timings.setdefault(url, array('d')).frombytes(
+            data[pos:pos + 8 * count])
+        pos += 8 * count
+    for url, stats in aggregator.items():
+        stats.timings = timings.get(url, array('d'))
+        if len(stats.timings) != stats.count:
+            return False
+    return True
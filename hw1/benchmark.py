@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Log analyzer benchmark.
+
+Generates synthetic log (or takes an existing one) and measures stages:
+read, parse, aggregate, rank, render. For every stage seconds, lines/sec
+and peak RSS sampled while the stage runs are saved to JSON, so results of different versions
+can be compared with --compare.
+"""
+
+from argparse import ArgumentParser
+import datetime
+import gzip
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+
+import hw1_log_parser as lp
+import log_generator
+from run_metrics import RunMetrics
+
+TEMPLATE = '<html><script>var table = $table_json;</script></html>'
+
+
+def git_revision():
+    '''Current commit of the repo or None.
+    '''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def open_log(log_path):
+    return (gzip.open(log_path, 'rb') if log_path.endswith('.gz')
+            else open(log_path, 'rb'))
+
+
+def stage_read(log_path, config):
+    with open_log(log_path) as log:
+        return sum(1 for _ in log)
+
+
+def stage_parse(log_path, config):
+    lines = 0
+    parse_line = lp.parse_line
+    with open_log(log_path) as log:
+        for line in log:
+            parse_line(line)
+            lines += 1
+    return lines
+
+
+def stage_aggregate(log_path, config, workers=1):
+    aggregator = lp.aggregate_log(log_path, config, 100, workers)
+    return aggregator, aggregator.total_count + aggregator.errors
+
+
+def stage_rank(aggregator, config):
+    return lp.sorted_reqs(aggregator, config['REPORT_SIZE'])
+
+
+def stage_render(aggregator, sample, config, report_dir):
+    urls_report = lp.full_report(aggregator, sample,
+                                 config.get('PERCENTILES', []))
+    cwd = os.getcwd()
+    os.chdir(report_dir)
+    try:
+        with open('report.html', 'w') as template:
+            template.write(TEMPLATE)
+        lp.render_report(os.path.join(report_dir, 'bench_report.html'),
+                         urls_report)
+    finally:
+        os.chdir(cwd)
+
+
+def measure(name, metrics, lines, func, *args):
+    '''Run stage under RunMetrics.stage, so its peak RSS is sampled
+    while it runs rather than taken from the process high-water mark,
+    and add lines/sec.
+    '''
+    with metrics.stage(name):
+        result = func(*args)
+    if lines is None:
+        lines = result[1] if isinstance(result, tuple) else result
+    seconds = metrics.seconds(name)
+    metrics.stages[name]['lines_per_sec'] = (round(lines / seconds)
+                                             if seconds else None)
+    return result
+
+
+def run(log_path, config, workers=1):
+    '''Measure all stages on the log.
+    '''
+    metrics = RunMetrics()
+    lines = measure('read', metrics, None, stage_read, log_path, config)
+    measure('parse', metrics, None, stage_parse, log_path, config)
+    aggregator, _ = measure('aggregate', metrics, None, stage_aggregate,
+                            log_path, config, workers)
+    sample = measure('rank', metrics, lines, stage_rank, aggregator, config)
+    with tempfile.TemporaryDirectory() as report_dir:
+        measure('render', metrics, lines, stage_render,
+                aggregator, sample, config, report_dir)
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'log': {'path': log_path, 'lines': lines,
+                'bytes': os.path.getsize(log_path),
+                'urls': len(aggregator)},
+        'workers': workers,
+        'stages': metrics.stages,
+    }
+
+
+def compare(result, baseline):
+    '''Log throughput ratio of stages to baseline results.
+    '''
+    for name, stage in result['stages'].items():
+        old = baseline['stages'].get(name, {}).get('lines_per_sec')
+        new = stage['lines_per_sec']
+        if old and new:
+            logging.info(f'{name}: {new / old:.2f}x of baseline '
+                         f'({baseline.get("revision")})')
+
+
+def create_args_parser():
+    '''Create arguments parse.
+    '''
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--log', help='existing log, synthetic by default')
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--urls', type=int, default=10000)
+    parser.add_argument('--distribution', default='lognormal',
+                        choices=sorted(log_generator.DISTRIBUTIONS))
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--config', help='analyzer config path')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--compare', help='previous results JSON')
+    return parser
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format=u'[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S', level=logging.INFO)
+    args = create_args_parser().parse_args()
+    config = dict(lp.config, AGGREGATE_DIR=None)
+    if args.config:
+        config.update(lp.load_config(args.config) or {})
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log_path = args.log
+        if not log_path:
+            log_path = os.path.join(
+                tmpdir, 'bench.log.gz' if args.gzip else 'bench.log')
+            logging.info(f'generating {args.lines} lines')
+            log_generator.generate(log_path, args.lines, args.urls,
+                                   args.distribution, seed=args.seed)
+        result = run(log_path, config, args.workers)
+        result['log'].update(generated=not args.log, seed=args.seed,
+                             distribution=args.distribution)
+
+    with open(args.output, 'w') as output:
+        json.dump(result, output, indent=2)
+    logging.info(f'results saved to {args.output}')
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(result, json.load(baseline))
@@ -0,0 +1,370 @@
+"""Gzip random access index.
+
+Sequential gzip stream can't be split, so the index stores decompressor
+state (compressed bit offset and last 32K of output) at deflate block
+boundaries every `span` bytes of uncompressed data, zran.c style.
+Decoding can be started from any access point, e.g. in different processes.
+Python zlib module doesn't expose Z_BLOCK/inflatePrime,
+so system libz is used via ctypes.
+
+Index is saved to the sidecar file "<log>.gzidx" and reused while the log
+fingerprint (size, mtime and crc of its head and tail) is the same.
+Multi-member gzip files are supported: every member start is an access point.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import zlib
+
+SPAN = 16 * 1024 * 1024
+WINSIZE = 32768
+CHUNK = 256 * 1024
+INDEX_SUFFIX = '.gzidx'
+INDEX_MAGIC = b'GZIDX\x01'
+FINGERPRINT_SIZE = 64 * 1024
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+GZIP_AUTO_WBITS = 47
+GZIP_WBITS = 31
+RAW_WBITS = -15
+GZIP_TRAILER_SIZE = 8
+
+AccessPoint = collections.namedtuple(
+    'AccessPoint', ['out_offset', 'in_offset', 'bits', 'window'])
+GzipIndex = collections.namedtuple(
+    'GzipIndex', ['fingerprint', 'span', 'points'])
+
+
+class ZStream(ctypes.Structure):
+    """zlib z_stream structure.
+    """
+
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+def load_libz():
+    '''Load system zlib or return None.
+    '''
+    name = ctypes.util.find_library('z')
+    if not name:
+        return None
+    libz = ctypes.CDLL(name)
+    libz.zlibVersion.restype = ctypes.c_char_p
+    return libz
+
+
+libz = load_libz()
+
+
+def is_supported():
+    '''Check if random access to gzip is possible.
+    '''
+    return libz is not None
+
+
+class Inflater:
+    """Thin wrapper around libz inflate stream.
+    """
+
+    def __init__(self, window_bits):
+        self.stream = ZStream()
+        self.out = ctypes.create_string_buffer(WINSIZE)
+        self.input = None
+        self.check(libz.inflateInit2_(ctypes.byref(self.stream), window_bits,
+                                      libz.zlibVersion(),
+                                      ctypes.sizeof(ZStream)))
+
+    def check(self, ret):
+        '''Raise on zlib error code.
+        '''
+        if ret < 0 or ret == Z_NEED_DICT:
+            msg = self.stream.msg.decode() if self.stream.msg else ret
+            raise zlib.error(f'inflate error: {msg}')
+        return ret
+
+    def reset(self, window_bits):
+        '''Prepare to decode the next stream.
+        '''
+        self.check(libz.inflateReset2(ctypes.byref(self.stream),
+                                      window_bits))
+
+    def prime(self, bits, value):
+        '''Insert bits of the access point byte.
+        '''
+        self.check(libz.inflatePrime(ctypes.byref(self.stream),
+                                     bits, value))
+
+    def set_dictionary(self, window):
+        '''Restore last 32K of output.
+        '''
+        self.check(libz.inflateSetDictionary(ctypes.byref(self.stream),
+                                             window, len(window)))
+
+    def feed(self, data):
+        '''Set next input bytes.
+        '''
+        self.input = ctypes.create_string_buffer(data, len(data))
+        self.stream.next_in = ctypes.addressof(self.input)
+        self.stream.avail_in = len(data)
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        '''Run inflate, output goes to the free tail of out buffer.
+        '''
+        return self.check(libz.inflate(ctypes.byref(self.stream), flush))
+
+    def reset_output(self):
+        '''Start filling out buffer from the beginning.
+        '''
+        self.stream.next_out = ctypes.addressof(self.out)
+        self.stream.avail_out = WINSIZE
+
+    def close(self):
+        libz.inflateEnd(ctypes.byref(self.stream))
+
+
+def fingerprint(gz_path):
+    '''Cheap log identity: size, mtime and crc of head and tail.
+    '''
+    stat = os.stat(gz_path)
+    with open(gz_path, 'rb') as gz:
+        crc = zlib.crc32(gz.read(FINGERPRINT_SIZE))
+        gz.seek(max(0, stat.st_size - FINGERPRINT_SIZE))
+        crc = zlib.crc32(gz.read(), crc)
+    return stat.st_size, stat.st_mtime_ns, crc
+
+
+def next_member_offset(gz, offset):
+    '''Skip zero padding after member end.
+    Returns next member offset or None on EOF.
+    '''
+    gz.seek(offset)
+    while True:
+        data = gz.read(CHUNK)
+        if not data:
+            return None
+        stripped = data.lstrip(b'\x00')
+        if stripped:
+            return gz.tell() - len(stripped)
+
+
+def build_index(gz_path, span=SPAN):
+    '''Decompress whole file once and collect access points.
+    '''
+    points = []
+    inflater = Inflater(GZIP_AUTO_WBITS)
+    inflater.reset_output()
+    total_out = last = 0
+    new_member = True
+    with open(gz_path, 'rb') as gz:
+        in_pos = 0
+        while True:
+            data = gz.read(CHUNK)
+            if not data:
+                break
+            in_pos += len(data)
+            inflater.feed(data)
+            stream = inflater.stream
+            while stream.avail_in:
+                if not stream.avail_out:
+                    inflater.reset_output()
+                avail_out = stream.avail_out
+                ret = inflater.inflate(Z_BLOCK)
+                total_out += avail_out - stream.avail_out
+                if ret == Z_STREAM_END:
+                    member_end = in_pos - stream.avail_in
+                    next_offset = next_member_offset(gz, member_end)
+                    if next_offset is None:
+                        break
+                    gz.seek(next_offset)
+                    in_pos = next_offset
+                    inflater.reset(GZIP_AUTO_WBITS)
+                    new_member = True
+                    break
+                block_end = stream.data_type & 128
+                last_block = stream.data_type & 64
+                if block_end and (new_member or (
+                        not last_block and total_out - last > span)):
+                    left = stream.avail_out
+                    out = inflater.out.raw
+                    window = out[WINSIZE - left:] + out[:WINSIZE - left]
+                    points.append(AccessPoint(
+                        total_out, in_pos - stream.avail_in,
+                        stream.data_type & 7, window))
+                    last = total_out
+                    new_member = False
+    inflater.close()
+    return GzipIndex(fingerprint(gz_path), span, points)
+
+
+def index_path(gz_path):
+    return gz_path + INDEX_SUFFIX
+
+
+def save_index(index, path):
+    '''Atomically write index to sidecar file, windows are compressed.
+    '''
+    tmp_path = path + '.tmp'
+    try:
+        write_index(index, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_index(index, path):
+    '''Write index file, see save_index.
+    '''
+    size, mtime_ns, crc = index.fingerprint
+    with open(path, 'wb') as sidecar:
+        sidecar.write(INDEX_MAGIC)
+        sidecar.write(struct.pack('<QQIQI', size, mtime_ns, crc,
+                                  index.span, len(index.points)))
+        for point in index.points:
+            window = zlib.compress(point.window)
+            sidecar.write(struct.pack('<QQBI', point.out_offset,
+                                      point.in_offset, point.bits,
+                                      len(window)))
+            sidecar.write(window)
+
+
+def load_index(path):
+    '''Read index from sidecar file.
+    '''
+    header = struct.Struct('<QQIQI')
+    point_header = struct.Struct('<QQBI')
+    with open(path, 'rb') as sidecar:
+        if sidecar.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError('not a gzip index file')
+        size, mtime_ns, crc, span, count = header.unpack(
+            sidecar.read(header.size))
+        points = []
+        for _ in range(count):
+            out_offset, in_offset, bits, length = point_header.unpack(
+                sidecar.read(point_header.size))
+            window = zlib.decompress(sidecar.read(length))
+            points.append(AccessPoint(out_offset, in_offset, bits, window))
+    return GzipIndex((size, mtime_ns, crc), span, points)
+
+
+def get_index(gz_path, span=SPAN):
+    '''Load sidecar index if it matches the log, build and save otherwise.
+    '''
+    path = index_path(gz_path)
+    if os.path.exists(path):
+        try:
+            index = load_index(path)
+        except (ValueError, OSError, struct.error, zlib.error):
+            logging.info('broken gzip index, rebuilding')
+        else:
+            if index.fingerprint == fingerprint(gz_path) \
+                    and index.span == span:
+                return index
+            logging.info('log was changed since indexing, rebuilding')
+    logging.info('building gzip index')
+    index = build_index(gz_path, span)
+    try:
+        save_index(index, path)
+    except OSError as exc:
+        logging.info(f"cannot save gzip index, it'll be rebuilt next time: "
+                     f"{exc}")
+    return index
+
+
+def iter_decompressed(gz_path, point):
+    '''Yields uncompressed data from access point to the end of file.
+    '''
+    inflater = Inflater(RAW_WBITS)
+    with open(gz_path, 'rb') as gz:
+        if point.bits:
+            gz.seek(point.in_offset - 1)
+            inflater.prime(point.bits, gz.read(1)[0] >> (8 - point.bits))
+        else:
+            gz.seek(point.in_offset)
+        inflater.set_dictionary(point.window)
+        in_pos = point.in_offset
+        # raw deflate stream ends before gzip trailer
+        trailer_size = GZIP_TRAILER_SIZE
+        try:
+            while True:
+                data = gz.read(CHUNK)
+                in_pos += len(data)
+                inflater.feed(data)
+                stream = inflater.stream
+                produced = WINSIZE
+                # full output buffer means inflate may have pending output
+                while stream.avail_in or produced == WINSIZE:
+                    inflater.reset_output()
+                    ret = inflater.inflate()
+                    produced = WINSIZE - stream.avail_out
+                    if produced:
+                        yield inflater.out.raw[:produced]
+                    elif not data:
+                        return
+                    if ret == Z_STREAM_END:
+                        member_end = in_pos - stream.avail_in + trailer_size
+                        next_offset = next_member_offset(gz, member_end)
+                        if next_offset is None:
+                            return
+                        gz.seek(next_offset)
+                        in_pos = next_offset
+                        inflater.reset(GZIP_WBITS)
+                        trailer_size = 0
+                        break
+        finally:
+            inflater.close()
+
+
+def read_lines(gz_path, point, out_end=None):
+    '''Yields lines which start between access point and out_end
+    (next point offset, None means EOF).
+    Together all points cover every line once.
+    '''
+    line_pos = point.out_offset
+    skip_partial = line_pos > 0 and point.window[-1:] != b'\n'
+    buffer = b''
+    for data in iter_decompressed(gz_path, point):
+        buffer += data
+        start = 0
+        while True:
+            newline = buffer.find(b'\n', start)
+            if newline < 0:
+                break
+            if skip_partial:
+                skip_partial = False
+            else:
+                if out_end is not None and line_pos >= out_end:
+                    return
+                yield buffer[start:newline + 1]
+            line_pos += newline + 1 - start
+            start = newline + 1
+        buffer = buffer[start:]
+        if out_end is not None and line_pos >= out_end and not skip_partial:
+            return
+    if buffer and not skip_partial and (out_end is None
+                                        or line_pos < out_end):
+        yield buffer
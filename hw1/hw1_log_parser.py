@@ -6,21 +6,73 @@
 """
 
 from argparse import ArgumentParser
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import collections
+import csv
 import datetime
 import gzip
+import heapq
 import itertools
 import json
 import logging
+import math
+import mmap
 import os
+import random
 import re
+import zlib
+
+import aggregate_store
+import gzip_index
+from run_metrics import RunMetrics, profiled
+from url_table import URLStats, URLTable, numpy_medians
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
-    "LOG_DIR": "./log"
+    "LOG_DIR": "./log",
+    "PERCENTILES": [90, 95, 99],
+    "SKETCH_ALPHA": 0.01,
+    "EXACT_MEDIAN": True,
+    "AGGREGATE_DIR": "./aggregates",
+    "TAIL_CHECKPOINT": "./aggregates/tail.checkpoint",
+    "NORMALIZE_URLS": False,
+    "URL_RULES": [
+        ["[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-"
+         "[0-9a-fA-F]{4}-[0-9a-fA-F]{12}", "{uuid}"],
+        ["(?<=[/=])(?=[0-9a-fA-F]*\\d)[0-9a-fA-F]{16,}(?=[/?&;.]|$)",
+         "{hash}"],
+        ["(?<=[/=])\\d+(?=[/?&;.]|$)", "{id}"]
+    ],
+    "TOP_K_CAPACITY": 0,
+    "EXPORT_FORMAT": None,
+    "SAMPLE_BLOCKS": 256,
+    "SAMPLE_BLOCK_SIZE": 1048576,
+    "SAMPLE_LINES": 100000
 }
 
 CONFIG_FROM_FILE = './config.json'
+CHUNKS_PER_WORKER = 1
+CURRENT_LOG = 'nginx-access-ui.log'
+TAIL_BLOCK = 64 * 1024
+HEAD_CHECK_SIZE = 4096
+TABLE_PLACEHOLDER = "$table_json"
+SCRIPT_ESCAPES = str.maketrans({'<': '\\u003c', '>': '\\u003e',
+                                '&': '\\u0026', '\u2028': '\\u2028',
+                                '\u2029': '\\u2029'})
+EXPORT_SUFFIXES = {'csv': '.csv.gz', 'npz': '.npz'}
+METRICS_SUFFIX = '.metrics.json'
+TIMINGS_SUFFIX = '.timings'
+EXPORT_BATCH = 4096
+MMAP_WINDOW = 64 * 1024 * 1024
+SAMPLE_Z = 1.96
+LOG_PATTERN = re.compile(r'^nginx-access-ui\.log-(\d{8})(\.gz)?$')
 
 
 def load_config(config_path):
@@ -35,12 +87,36 @@ def load_config(config_path):
     return config_file
 
 
+def merge_config(defaults, *paths):
+    '''Defaults overridden by keys of existing config files,
+    later files win.
+    '''
+    merged = dict(defaults)
+    for config_path in paths:
+        file_config = load_config(config_path)
+        if file_config:
+            merged.update(file_config)
+    return merged
+
+
 def create_args_parser(CONFIG_FROM_FILE):
     '''Create arguments parse.
     '''
     parser = ArgumentParser()
     parser.add_argument('--config', help='config path',
                         default=CONFIG_FROM_FILE)
+    parser.add_argument('--workers', help='parsing processes count',
+                        type=int, default=1)
+    parser.add_argument('--from', dest='date_from', type=str_date,
+                        help='range report first day, YYYYMMDD')
+    parser.add_argument('--to', dest='date_to', type=str_date,
+                        help='range report last day, YYYYMMDD')
+    parser.add_argument('--tail', action='store_true',
+                        help='incremental report of the current log')
+    parser.add_argument('--sample', action='store_true',
+                        help='approximate report by log sample')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='save cProfile stats of the run to PATH')
     return parser
 
 
@@ -81,10 +157,9 @@ def get_last_log(logdir):
     '''Looking for latest log in dir.
     '''
     last_logdate = None
-    pattern = re.compile('^nginx-access-ui.log-(\d{8})')
     if check_dir(logdir):
         for file in os.listdir(logdir):
-            matched = pattern.match(file)
+            matched = LOG_PATTERN.match(file)
             if matched:
                 date_string = matched.groups()[0]
                 log_date = str_date(date_string)
@@ -102,6 +177,37 @@ def get_last_log(logdir):
     raise FileNotFoundError("there's no log file")
 
 
+def get_logs(logdir, date_from, date_to):
+    '''Logs of the date range: {'YYYYMMDD': log_path}.
+    '''
+    logs = {}
+    if check_dir(logdir):
+        for file in sorted(os.listdir(logdir)):
+            matched = LOG_PATTERN.match(file)
+            if matched:
+                log_date = str_date(matched.groups()[0])
+                if date_from <= log_date <= date_to:
+                    logs[log_date] = os.path.join(
+                        os.path.abspath(logdir), file)
+    return logs
+
+
+def date_range(date_from, date_to):
+    '''Yields YYYYMMDD days from date_from to date_to inclusive.
+    '''
+    day = datetime.datetime.strptime(date_from, '%Y%m%d')
+    last_day = datetime.datetime.strptime(date_to, '%Y%m%d')
+    while day <= last_day:
+        yield day.strftime('%Y%m%d')
+        day += datetime.timedelta(days=1)
+
+
+def dotted_date(logdate):
+    '''YYYYMMDD -> YYYY.MM.DD
+    '''
+    return f'{logdate[:4]}.{logdate[4:6]}.{logdate[6:]}'
+
+
 def median(numbers_list):
     '''Compute median.
     '''
@@ -118,45 +224,507 @@ def median(numbers_list):
     return median
 
 
-def process_line(line):
-    '''Parse log lines.
+REJECT_NO_REQUEST = 'no_request'
+REJECT_BAD_REQUEST = 'bad_request'
+REJECT_BAD_TIME = 'bad_time'
+REJECT_BAD_URL = 'bad_url'
+
+
+def parse_line(line, start=0, end=None):
+    '''Bytes-level log line parser.
+    Only url and request time are sliced out of the line,
+    so the line may be a [start, end) span of a bigger buffer, e.g. mmap.
+    Returns (url, request_time) pair or rejection reason.
     '''
+    if end is None:
+        end = len(line)
+    request_start = line.find(b'"', start, end) + 1
+    if not request_start:
+        return REJECT_NO_REQUEST
+    request_end = line.find(b'"', request_start, end)
+    if request_end < 0:
+        return REJECT_NO_REQUEST
+    # "$request" is "METHOD URL PROTOCOL"
+    url_start = line.find(b' ', request_start, request_end) + 1
+    if not url_start:
+        return REJECT_BAD_REQUEST
+    url_end = line.find(b' ', url_start, request_end)
+    if url_end < 0:
+        url_end = request_end
+    if url_end == url_start:
+        return REJECT_BAD_REQUEST
+    time_start = line.rfind(b' ', start, end) + 1
+    try:
+        reqtime = float(line[max(time_start, start):end])
+    except ValueError:
+        return REJECT_BAD_TIME
     try:
-        url = line.split('"')[1].replace('GET ', '')
-        http_idx = url.find(' HTT')
-        url = url[:http_idx]
-        reqtime = line.split(' ')[-1].replace('\n', '')
-        return url, reqtime
+        url = line[url_start:url_end].decode('utf-8')
+    except UnicodeDecodeError:
+        return REJECT_BAD_URL
+    return url, reqtime
 
-    except IndexError:
-        return None
+
+def process_line(line):
+    '''Parse log lines.
+    Returns (url, request_time) or None if line is rejected.
+    '''
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    parsed_line = parse_line(line)
+    if isinstance(parsed_line, tuple):
+        return parsed_line
+    return None
 
 
-def xreadlines(log_path, errors_threshold):
+def xreadlines(log_path, errors_threshold, rejected=None):
     '''Read and parse log.
-    Yields parsed log lines.
+    Yields parsed log lines, rejected lines are counted by reason.
+    Raises RuntimeError if errors percent reaches errors_threshold.
     '''
+    if rejected is None:
+        rejected = collections.Counter()
     try:
         log = (gzip.open(log_path, 'rb')
                if log_path.endswith(".gz")
-               else open(log_path))
-        total = processed = errors = 0
+               else open(log_path, 'rb'))
+    except FileNotFoundError:
+        logging.debug("cannot open log file, check if it's in dir")
+        raise
+    total = 0
+    with log:
         for line in log:
-            parsed_line = process_line(line)
             total += 1
-            if parsed_line:
-                processed += 1
+            parsed_line = parse_line(line)
+            if isinstance(parsed_line, tuple):
                 yield parsed_line
             else:
-                errors += 1
-                if (errors / len(log)) >= errors_threshold:
-                    raise RuntimeError('wrong log format')
+                rejected[parsed_line] += 1
+    errors = sum(rejected.values())
+    if total and (errors / total) * 100 >= errors_threshold:
+        raise RuntimeError('wrong log format')
+
+
+class URLNormalizer:
+    """Collapse variable URL parts (ids, hashes) into placeholders.
+    Rules are [regex, replacement] pairs applied in order.
+    """
+
+    def __init__(self, rules):
+        self.rules = [(re.compile(pattern), replacement)
+                      for pattern, replacement in rules]
+
+    def __call__(self, url):
+        for pattern, replacement in self.rules:
+            url = pattern.sub(replacement, url)
+        return url
+
+
+class LogAggregator:
+    """Streaming per-URL log statistics.
+    Lines are not kept, but with exact_median every request time is
+    (8 bytes per line), so memory is O(lines); without it memory depends
+    on distinct URLs count only.
+    Statistics are kept in URLTable columns indexed by dense URL ids,
+    report and export columns are computed by its group_by.
+
+    URLs may be normalized by `url_rules` (see URLNormalizer).
+    If `capacity` is set, at most `capacity` URLs with the biggest timesum
+    are tracked (weighted Space-Saving): a new URL replaces the one with
+    minimal timesum m and inherits it, so its timesum is overestimated
+    by no more than `error` = m. Totals are always exact.
+    """
+
+    def __init__(self, alpha=0.01, exact_median=True, url_rules=(),
+                 capacity=0):
+        self.alpha = alpha
+        self.exact_median = exact_median
+        self.url_rules = [list(rule) for rule in url_rules]
+        self.normalize = URLNormalizer(url_rules) if url_rules else None
+        self.capacity = capacity
+        self.heap = []
+        self.table = URLTable(alpha, exact_median)
+        self.total_count = 0
+        self.total_time = 0.0
+        self.rejected = collections.Counter()
+        # {url: (count_ci, time_sum_ci)} if statistics are extrapolated
+        self.intervals = None
+
+    def settings(self):
+        '''Constructor arguments to create aggregator with same settings.
+        '''
+        return dict(alpha=self.alpha, exact_median=self.exact_median,
+                    url_rules=self.url_rules, capacity=self.capacity)
+
+    @property
+    def urls(self):
+        '''Dense ids of tracked URLs, {url: id}.
+        '''
+        return self.table.ids
+
+    def new_stats(self, url):
+        '''Create empty URL statistics row.
+        '''
+        return URLStats(self.table, self.table.intern(url))
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, url):
+        return url in self.table
+
+    def get(self, url):
+        '''Get URL statistics or None.
+        '''
+        url_id = self.table.ids.get(url)
+        if url_id is None:
+            return None
+        return URLStats(self.table, url_id)
+
+    def items(self):
+        '''Pairs of url and its statistics.
+        '''
+        table = self.table
+        for url, url_id in table.ids.items():
+            yield url, URLStats(table, url_id)
+
+    def add(self, url, reqtime):
+        '''Account single parsed log line.
+        '''
+        reqtime = float(reqtime)
+        if self.normalize is not None:
+            url = self.normalize(url)
+        url_id = self.table.ids.get(url)
+        if url_id is None:
+            url_id = self.new_url(url)
+        self.table.add(url_id, reqtime)
+        self.total_count += 1
+        self.total_time += reqtime
+
+    def new_url(self, url):
+        '''Start tracking URL and return its id, in top-K mode the URL
+        with minimal timesum is replaced if there's no room.
+        '''
+        if not self.capacity:
+            return self.table.intern(url)
+        time_sum = 0.0
+        if len(self.table.ids) >= self.capacity:
+            time_sum = self.pop_min()
+        url_id = self.table.intern(url)
+        self.table.time_sum[url_id] = self.table.error[url_id] = time_sum
+        heapq.heappush(self.heap, (time_sum, url))
+        return url_id
+
+    def pop_min(self):
+        '''Stop tracking URL with minimal timesum and return the timesum.
+        Heap is updated lazily: timesums only grow,
+        so stale entries are pushed back with actual values.
+        '''
+        ids = self.table.ids
+        if len(self.heap) < len(ids):
+            self.rebuild_heap()
+        heap = self.heap
+        time_sums = self.table.time_sum
+        while True:
+            time_sum, url = heap[0]
+            url_id = ids.get(url)
+            if url_id is None:
+                heapq.heappop(heap)
+            elif time_sums[url_id] != time_sum:
+                heapq.heapreplace(heap, (time_sums[url_id], url))
+            else:
+                heapq.heappop(heap)
+                self.table.release(url)
+                return time_sum
+
+    def rebuild_heap(self):
+        '''Recreate heap, e.g. after loading or merging.
+        '''
+        time_sums = self.table.time_sum
+        self.heap = [(time_sums[url_id], url)
+                     for url, url_id in self.table.ids.items()]
+        heapq.heapify(self.heap)
+
+    def is_full(self):
+        '''Check if top-K table has no room and URLs could be lost.
+        '''
+        return bool(self.capacity) and len(self.table) >= self.capacity
+
+    def min_time_sum(self):
+        '''Upper bound of timesum of any untracked URL.
+        '''
+        if not self.is_full():
+            return 0.0
+        time_sums = self.table.time_sum
+        return min(time_sums[url_id] for url_id in self.table.ids.values())
+
+    def update(self, parsed_lines):
+        '''Consume parsed lines iterable, e.g. xreadlines().
+        '''
+        for url, reqtime in parsed_lines:
+            self.add(url, reqtime)
+        return self
+
+    def merge(self, other):
+        '''Merge other aggregator into this one.
+        In top-K mode URL missing in one of summaries gets
+        its minimal timesum as possible error, then the table is trimmed.
+        '''
+        table = self.table
+        if self.capacity or other.capacity:
+            self_min, other_min = self.min_time_sum(), other.min_time_sum()
+            for url, url_id in table.ids.items():
+                if url not in other:
+                    table.time_sum[url_id] += other_min
+                    table.error[url_id] += other_min
+        else:
+            self_min = 0.0
+        ids = table.ids
+        for url, other_id in other.table.ids.items():
+            url_id = ids.get(url)
+            if url_id is None:
+                url_id = table.intern(url)
+                table.time_sum[url_id] = table.error[url_id] = self_min
+            table.merge_row(url_id, other.table, other_id)
+        if self.capacity:
+            self.rebuild_heap()
+            while len(table) > self.capacity:
+                self.pop_min()
+        self.total_count += other.total_count
+        self.total_time += other.total_time
+        self.rejected.update(other.rejected)
+        return self
+
+    @property
+    def errors(self):
+        '''Rejected lines count.
+        '''
+        return sum(self.rejected.values())
+
+    def errors_percent(self):
+        '''Percent of log lines which were not parsed.
+        '''
+        lines_count = self.total_count + self.errors
+        if not lines_count:
+            return 0
+        return (self.errors / lines_count) * 100
+
+
+def as_aggregator(url_time_dict):
+    '''Convert "{'url': [timepoint1, ...]}" dict to LogAggregator.
+    Aggregators are returned as is.
+    '''
+    if isinstance(url_time_dict, LogAggregator):
+        return url_time_dict
+    aggregator = LogAggregator()
+    for url, timepoints in url_time_dict.items():
+        for time in timepoints:
+            aggregator.add(url, time)
+    return aggregator
+
+
+def chunk_offsets(log_path, chunks_count):
+    '''Split file into newline-aligned (start, end) byte ranges.
+    '''
+    size = os.path.getsize(log_path)
+    offsets = [0]
+    with open(log_path, 'rb') as log:
+        for i in range(1, chunks_count):
+            pos = size * i // chunks_count
+            if pos <= offsets[-1]:
                 continue
-    except FileNotFoundError:
-        logging.debug("cannot open log file, check if it's in dir")
-        raise FileNotFoundError()
-    finally:
-        log.close()
+            # line containing byte pos-1 ends where the next one starts
+            log.seek(pos - 1)
+            log.readline()
+            pos = log.tell()
+            if pos >= size:
+                break
+            offsets.append(pos)
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+
+def read_chunk(log_path, start, end):
+    '''Yields lines of newline-aligned byte range.
+    '''
+    with open(log_path, 'rb') as log:
+        log.seek(start)
+        pos = start
+        while pos < end:
+            line = log.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def advise(window, log_fileno, offset, size):
+    '''Hint kernel that the mapped window is read sequentially.
+    '''
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        window.madvise(mmap.MADV_SEQUENTIAL)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(log_fileno, offset, size, os.POSIX_FADV_SEQUENTIAL)
+
+
+def drop_page_cache(log_fileno, offset, size):
+    '''Drop page cache of the parsed part of the log,
+    if the log doesn't fit into half of RAM.
+    '''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        ram = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return
+    if os.fstat(log_fileno).st_size > ram // 2:
+        os.posix_fadvise(log_fileno, offset, size, os.POSIX_FADV_DONTNEED)
+
+
+def mmap_windows(log_path, start=0, end=None, window_size=MMAP_WINDOW):
+    '''Map newline-aligned byte range [start, end) of plain log
+    window by window, so logs larger than RAM are read with bounded memory.
+    Yields (window, first, last): lines of the window are in [first, last).
+    Window is unmapped after the consumer moves on.
+    '''
+    with open(log_path, 'rb') as log:
+        fileno = log.fileno()
+        size = os.fstat(fileno).st_size
+        end = size if end is None else min(end, size)
+        pos = start
+        while pos < end:
+            offset = pos - pos % mmap.ALLOCATIONGRANULARITY
+            length = min(end, offset + window_size) - offset
+            with mmap.mmap(fileno, length, access=mmap.ACCESS_READ,
+                           offset=offset) as window:
+                advise(window, fileno, offset, length)
+                first = pos - offset
+                if offset + length < end:
+                    last = window.rfind(b'\n', first) + 1
+                    if not last:
+                        # line is longer than window
+                        window_size *= 2
+                        continue
+                else:
+                    last = length
+                yield window, first, last
+            drop_page_cache(fileno, offset, last)
+            pos = offset + last
+
+
+def parse_mapped(log_path, start=0, end=None, settings=None):
+    '''Parse byte range of plain log through mmap:
+    lines are found by find() over the mapped window and
+    parsed in place, only url and time are copied.
+    '''
+    aggregator = LogAggregator(**(settings or {}))
+    add = aggregator.add
+    rejected = aggregator.rejected
+    for window, pos, last in mmap_windows(log_path, start, end):
+        find = window.find
+        while pos < last:
+            line_end = find(b'\n', pos, last) + 1 or last
+            parsed_line = parse_line(window, pos, line_end)
+            if isinstance(parsed_line, tuple):
+                add(*parsed_line)
+            else:
+                rejected[parsed_line] += 1
+            pos = line_end
+    return aggregator
+
+
+def parse_lines(lines, settings=None):
+    '''Parse raw log lines into partial aggregate.
+    '''
+    aggregator = LogAggregator(**(settings or {}))
+    add = aggregator.add
+    rejected = aggregator.rejected
+    for line in lines:
+        parsed_line = parse_line(line)
+        if isinstance(parsed_line, tuple):
+            add(*parsed_line)
+        else:
+            rejected[parsed_line] += 1
+    return aggregator
+
+
+def parse_chunk(log_path, start, end, settings=None):
+    '''Parse byte range of plain log.
+    Runs in worker process.
+    '''
+    return parse_mapped(log_path, start, end, settings)
+
+
+def parse_gzip_chunk(log_path, point, out_end, settings=None):
+    '''Parse gzip log lines starting between access point and out_end,
+    which may be offset of a later point.
+    Runs in worker process.
+    '''
+    return parse_lines(gzip_index.read_lines(log_path, point, out_end),
+                       settings)
+
+
+def parse_task(func, *args):
+    '''Run parsing task and return its partial aggregate
+    in compact binary form (see aggregate_store.dumps).
+    Runs in worker process.
+    '''
+    aggregator = func(*args)
+    return aggregate_store.dumps(aggregator,
+                                 keep_timings=aggregator.exact_median)
+
+
+def point_ranges(points, ranges_count):
+    '''Group adjacent access points into at most ranges_count
+    (first point, out_end) ranges, None out_end means EOF.
+    Empty log has no points and no ranges.
+    '''
+    if not points:
+        return []
+    step = math.ceil(len(points) / ranges_count)
+    return [(points[i], points[i + step].out_offset
+             if i + step < len(points) else None)
+            for i in range(0, len(points), step)]
+
+
+def chunk_tasks(log_path, workers):
+    '''Worker tasks covering whole log: (func, *args).
+    Gzip logs are split into ranges of adjacent access points
+    of the index.
+    '''
+    if log_path.endswith(".gz"):
+        points = gzip_index.get_index(log_path).points
+        return [(parse_gzip_chunk, log_path, point, out_end)
+                for point, out_end in point_ranges(
+                    points, workers * CHUNKS_PER_WORKER)]
+    chunks = chunk_offsets(log_path, workers * CHUNKS_PER_WORKER)
+    return [(parse_chunk, log_path, start, end) for start, end in chunks]
+
+
+def parallel_aggregate(log_path, workers, settings=None):
+    '''Parse log in process pool.
+    About one chunk per worker; serialized partial aggregates are
+    merged as soon as they are ready and dropped right after,
+    so at most a few of them are held at once.
+    '''
+    tasks = chunk_tasks(log_path, workers)
+    logging.info(f'parsing {len(tasks)} chunks with {workers} workers')
+    aggregator = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = as_completed([pool.submit(parse_task, *task, settings)
+                                for task in tasks])
+        for future in futures:
+            partial = aggregate_store.loads(
+                future.result(), LogAggregator(**(settings or {})))
+            del future
+            if aggregator is None:
+                aggregator = partial
+            else:
+                aggregator.merge(partial)
+            del partial
+    if aggregator is None:
+        aggregator = LogAggregator(**(settings or {}))
+    return aggregator
 
 
 def url_timepoints_dict(log):
@@ -174,6 +742,11 @@ def url_timepoints_dict(log):
 def time_sum(url_time_dict):
     '''Yields url and its timesum.
     '''
+    if isinstance(url_time_dict, LogAggregator):
+        time_sums = url_time_dict.table.time_sum
+        for url, url_id in url_time_dict.urls.items():
+            yield url, time_sums[url_id]
+        return
     for url, timepoints in url_time_dict.items():
         yield url, sum(timepoints)
 
@@ -181,21 +754,12 @@ def time_sum(url_time_dict):
 def sorted_reqs(url_time_dict, report_size):
     '''Sort url dict by timesum (descending).
     Func returns first "report_size" pairs.
+    Only report_size pairs are kept in a heap, not all URLs sorted.
     '''
-    url_time_sum = dict(time_sum(url_time_dict))
-
-    report = dict(
-        sorted(url_time_sum.items(),
-               key=lambda pair: pair[1],
-               reverse=True)
-    )
-
-    report_sample = dict(
-        itertools.islice(
-            report.items(), report_size
-        )
+    return dict(
+        heapq.nlargest(report_size, time_sum(url_time_dict),
+                       key=lambda pair: pair[1])
     )
-    return report_sample
 
 
 def dict_length(d):
@@ -207,6 +771,8 @@ def dict_length(d):
 def all_reqs_timesum(utd):
     '''General timesum of all requests.
     '''
+    if isinstance(utd, LogAggregator):
+        return utd.total_time
     timesum = 0
     for _, timepoints in utd.items():
         timesum += sum(timepoints)
@@ -219,34 +785,60 @@ def round3(number):
     return round(number, ndigits=3)
 
 
-def full_report(url_time_dict, max_time_sample, log):
+def percentile_colname(p):
+    '''Report column name for p-th percentile, e.g. "time_p99".
+    '''
+    return f'time_p{p:g}'
+
+
+def full_report(url_time_dict, max_time_sample, percentiles=()):
     '''Log statistics computing.
+    Percentiles columns are estimated by URL quantile sketches.
+    In top-K mode "time_sum_err" column holds timesum error bound.
+    '''
+    return list(iter_report(url_time_dict, max_time_sample, percentiles))
+
+
+def iter_report(url_time_dict, max_time_sample, percentiles=()):
+    '''Yields report rows one by one, see full_report.
     '''
-    urls_table = []
+    aggregator = as_aggregator(url_time_dict)
     colnames = ['url', 'count', 'count_perc',
                 'time_avg', 'time_max', 'time_med',
                 'time_perc', 'time_sum']
+    colnames.extend(map(percentile_colname, percentiles))
+    if aggregator.capacity:
+        colnames.append('time_sum_err')
+    if aggregator.intervals is not None:
+        colnames.extend(['count_ci', 'time_sum_ci'])
 
-    for url, url_timesum in max_time_sample.items():
-        all_url_timepoints = url_time_dict.get(url)
-        count = len(all_url_timepoints)
-        count_perc = (count / len(log))*100
+    total_count = aggregator.total_count
+    total_time = aggregator.total_time
+    table = aggregator.table
+    ids = [table.ids[url] for url in max_time_sample]
+    columns = table.group_by(ids)
+
+    for (url, url_timesum), url_id, count, time_max, time_med, error in zip(
+            max_time_sample.items(), ids, columns['count'],
+            columns['time_max'], columns['time_med'], columns['error']):
+        count_perc = (count / total_count)*100
         time_avg = url_timesum / count
-        time_max = max(all_url_timepoints)
-        time_med = median(all_url_timepoints)
-        time_perc = (url_timesum / all_reqs_timesum(url_time_dict))*100
+        time_perc = (url_timesum / total_time)*100
         time_sum = url_timesum
 
         to_round = [count_perc, time_avg,
                     time_max, time_med, time_perc,
                     time_sum]
+        to_round.extend(map(table.sketches[url_id].percentile, percentiles))
+        if aggregator.capacity:
+            to_round.append(error)
+        if aggregator.intervals is not None:
+            to_round.extend(aggregator.intervals[url])
 
         stat_values = list(map(round3, to_round))
         url_row = list((url, count))
         url_row.extend(stat_values)
-        url_table_row = dict(zip(colnames, url_row))
-        urls_table.append(url_table_row)
-    return urls_table
+        yield dict(zip(colnames, url_row))
 
 
 def errors_percent(errors_count, utd):
@@ -256,8 +848,18 @@ def errors_percent(errors_count, utd):
     return (errors_count / all_urls_count) * 100
 
 
+def script_json(value):
+    '''JSON safe to embed into <script>: "</script>", "<!--" and
+    line separators in URLs can't end the script or break the page.
+    '''
+    return json.dumps(value, ensure_ascii=False).translate(SCRIPT_ESCAPES)
+
+
 def render_report(report_path, content):
     '''Create and render html report.
+    Template prefix is written first, then table rows are streamed
+    as JSON, then the suffix. Report appears under report_path
+    only when it's completely written.
     '''
     try:
         with open("report.html", "r") as report:
@@ -265,10 +867,21 @@ def render_report(report_path, content):
     except UnicodeError:
         logging.debug("report unicode error when opening")
         raise
-    page = page.replace("$table_json", str(content))
+    prefix, placeholder, suffix = page.partition(TABLE_PLACEHOLDER)
+    if not placeholder:
+        raise ValueError(f'no {TABLE_PLACEHOLDER} in report template')
+    tmp_path = report_path + '.tmp'
     try:
-        with open(report_path, "w", encoding='utf-8') as report:
-            report.write(page)
+        with open(tmp_path, "w", encoding='utf-8') as report:
+            report.write(prefix)
+            report.write('[')
+            for i, row in enumerate(content):
+                if i:
+                    report.write(', ')
+                report.write(script_json(row))
+            report.write(']')
+            report.write(suffix)
+        os.replace(tmp_path, report_path)
         logging.info('report is ready')
     except PermissionError:
         logging.debug(
@@ -276,29 +889,470 @@ def render_report(report_path, content):
         raise
 
 
-def main(config, errors_threshold):
-    report_size = config['REPORT_SIZE']
+def iter_url_stats(aggregator, percentiles=()):
+    '''Yields statistics columns of every URL for export.
+    Columns are computed by URL table group-by in batches
+    of EXPORT_BATCH URLs.
+    '''
+    table = aggregator.table
+    items = iter(table.ids.items())
+    while True:
+        batch = list(itertools.islice(items, EXPORT_BATCH))
+        if not batch:
+            return
+        columns = table.group_by(url_id for _, url_id in batch)
+        for (url, url_id), count, time_sum, time_max, time_med, error in zip(
+                batch, columns['count'], columns['time_sum'],
+                columns['time_max'], columns['time_med'], columns['error']):
+            row = [url, count, time_sum, time_max, time_med]
+            row.extend(map(table.sketches[url_id].percentile, percentiles))
+            row.append(error)
+            yield row
+
+
+def export_columns(percentiles=()):
+    '''Column names of the statistics export.
+    '''
+    columns = ['url', 'count', 'time_sum', 'time_max', 'time_med']
+    columns.extend(map(percentile_colname, percentiles))
+    columns.append('time_sum_err')
+    return columns
+
+
+def export_csv(aggregator, export_path, percentiles=()):
+    '''Stream statistics of all URLs to gzipped CSV.
+    '''
+    with gzip.open(export_path, 'wt', encoding='utf-8', newline='') as export:
+        writer = csv.writer(export)
+        writer.writerow(export_columns(percentiles))
+        writer.writerows(iter_url_stats(aggregator, percentiles))
+
+
+def export_npz(aggregator, export_path, percentiles=()):
+    '''Save statistics of all URLs as numpy columns.
+    '''
+    if numpy is None:
+        raise RuntimeError('npz export requires numpy')
+    columns = export_columns(percentiles)
+    rows = list(iter_url_stats(aggregator, percentiles))
+    arrays = {'url': numpy.array([row[0] for row in rows], dtype=str),
+              'count': numpy.array([row[1] for row in rows],
+                                   dtype=numpy.int64)}
+    for i, column in enumerate(columns[2:], start=2):
+        arrays[column] = numpy.array([row[i] for row in rows],
+                                     dtype=numpy.float64)
+    numpy.savez_compressed(export_path, **arrays)
+
+
+def export_stats(aggregator, report_path, export_format, percentiles=()):
+    '''Export full per-URL statistics next to the report.
+    '''
+    if export_format not in EXPORT_SUFFIXES:
+        raise ValueError(f'unknown export format: {export_format}')
+    base_path, _ = os.path.splitext(report_path)
+    export_path = base_path + EXPORT_SUFFIXES[export_format]
+    exporter = export_csv if export_format == 'csv' else export_npz
+    exporter(aggregator, export_path, percentiles)
+    logging.info(f'statistics exported: {export_path}')
+    return export_path
+
+
+def aggregator_settings(config, **overrides):
+    '''LogAggregator arguments from config.
+    '''
+    settings = dict(
+        alpha=config.get("SKETCH_ALPHA", 0.01),
+        exact_median=config.get("EXACT_MEDIAN", True),
+        url_rules=(config.get("URL_RULES", [])
+                   if config.get("NORMALIZE_URLS") else []),
+        capacity=config.get("TOP_K_CAPACITY", 0))
+    settings.update(overrides)
+    return settings
+
+
+def aggregate_log(log_path, config, errors_threshold, workers=1):
+    '''Parse log into LogAggregator, in process pool if workers > 1.
+    Plain logs are read through mmap.
+    '''
+    settings = aggregator_settings(config)
+    plain = not log_path.endswith(".gz")
+    if workers > 1 and (plain or gzip_index.is_supported()):
+        aggregator = parallel_aggregate(log_path, workers, settings)
+    elif plain:
+        aggregator = parse_mapped(log_path, settings=settings)
+    else:
+        aggregator = LogAggregator(**settings)
+        aggregator.update(xreadlines(log_path, errors_threshold,
+                                     aggregator.rejected))
+    if aggregator.errors_percent() >= errors_threshold:
+        raise RuntimeError('wrong log format')
+    if aggregator.rejected:
+        logging.info(f'rejected lines: {dict(aggregator.rejected)}')
+    return aggregator
+
+
+def save_day_aggregate(config, logdate, log_path, aggregator):
+    '''Save day aggregate to the store if it's configured.
+    '''
+    store_dir = config.get("AGGREGATE_DIR")
+    if store_dir:
+        aggregate_store.save_day(store_dir, logdate, log_path, aggregator)
+
+
+def saved_day_aggregate(config, logdate, log_path):
+    '''Load saved day aggregate, None if there's no store or
+    no aggregate for this log content.
+    '''
+    store_dir = config.get("AGGREGATE_DIR")
+    if not store_dir:
+        return None
+    empty = LogAggregator(**aggregator_settings(config, exact_median=False))
+    if log_path:
+        aggregator = aggregate_store.load_day(store_dir, logdate,
+                                              log_path, empty)
+    else:
+        aggregator = aggregate_store.load_saved_day(store_dir, logdate, empty)
+    if aggregator is not None:
+        logging.info(f'{logdate}: loaded saved aggregate')
+    return aggregator
+
+
+def range_aggregate(config, date_from, date_to, errors_threshold,
+                    workers=1, metrics=None):
+    '''Merge day aggregates of the date range.
+    Only days without saved aggregates are parsed and saved,
+    metrics.lines counts lines of parsed days only.
+    '''
+    if metrics is None:
+        metrics = RunMetrics()
+    logs = get_logs(config['LOG_DIR'], date_from, date_to)
+    aggregator = LogAggregator(
+        **aggregator_settings(config, exact_median=False))
+    parsed_lines = 0
+    for logdate in date_range(date_from, date_to):
+        log_path = logs.get(logdate)
+        with metrics.stage('load_aggregate'):
+            day = saved_day_aggregate(config, logdate, log_path)
+        if day is None:
+            if not log_path:
+                logging.info(f'{logdate}: no log and no saved aggregate')
+                continue
+            logging.info(f'{logdate}: parsing {log_path}')
+            with metrics.stage('aggregate'):
+                day = aggregate_log(log_path, config, errors_threshold,
+                                    workers)
+            parsed_lines += day.total_count + day.errors
+            with metrics.stage('save_aggregate'):
+                save_day_aggregate(config, logdate, log_path, day)
+        with metrics.stage('merge'):
+            aggregator.merge(day)
+    metrics.lines = parsed_lines
+    if not aggregator.total_count:
+        raise FileNotFoundError("there's no logs for this date range")
+    return aggregator
+
+
+def line_start(log, pos):
+    '''Offset of the first line starting at or after pos.
+    '''
+    if pos <= 0:
+        return 0
+    log.seek(pos - 1)
+    log.readline()
+    return log.tell()
+
+
+def sample_blocks(log_path, blocks_count, block_size):
+    '''Evenly spaced blocks of plain log as (start, end) ranges
+    and total blocks count. Each line belongs to the block it starts in.
+    '''
+    size = os.path.getsize(log_path)
+    total = max(1, -(-size // block_size))
+    count = min(total, max(2, blocks_count))
+    step = total / count
+    blocks = []
+    with open(log_path, 'rb') as log:
+        for i in range(count):
+            index = int((i + 0.5) * step)
+            blocks.append((line_start(log, index * block_size),
+                           line_start(log, min(size,
+                                               (index + 1) * block_size))))
+    return blocks, total
+
+
+def reservoir_sample(lines, size, seed=0):
+    '''Uniform random sample of size lines (algorithm R)
+    and count of all lines.
+    '''
+    rnd = random.Random(seed)
+    sample = []
+    total = 0
+    for total, line in enumerate(lines, start=1):
+        if total <= size:
+            sample.append(line)
+        else:
+            i = int(rnd.random() * total)
+            if i < size:
+                sample[i] = line
+    rnd.shuffle(sample)
+    return sample, total
+
+
+def sample_units(log_path, config):
+    '''Sampling units (iterables of raw lines) and
+    estimated units count of the whole log.
+    Plain log is sampled by byte blocks, gzip log by lines,
+    sampled lines are split into random groups.
+    '''
+    blocks_count = config.get("SAMPLE_BLOCKS", 256)
+    if not log_path.endswith(".gz"):
+        blocks, total = sample_blocks(
+            log_path, blocks_count,
+            config.get("SAMPLE_BLOCK_SIZE", 1048576))
+        units = (read_chunk(log_path, start, end) for start, end in blocks)
+        return units, total
+    with gzip.open(log_path, 'rb') as log:
+        sample, lines_count = reservoir_sample(
+            log, config.get("SAMPLE_LINES", 100000))
+    groups = max(1, min(blocks_count, len(sample)))
+    units = [sample[i::groups] for i in range(groups)]
+    return units, lines_count / max(1, len(sample)) * groups
+
+
+def confidence_interval(units_sum, squares_sum, sampled, units_total):
+    '''Half-width of confidence interval of extrapolated total
+    N * mean for n of N units: z * N * sqrt((1 - n/N) * s^2 / n).
+    '''
+    if sampled < 2 or sampled >= units_total:
+        return 0.0
+    variance = (squares_sum - units_sum ** 2 / sampled) / (sampled - 1)
+    return SAMPLE_Z * units_total * math.sqrt(
+        max(variance, 0.0) * (1 - sampled / units_total) / sampled)
+
+
+def extrapolate(aggregator, squares, sampled, units_total):
+    '''Scale sampled statistics to the whole log and set
+    confidence intervals of URL counts and timesums.
+    squares holds {url: [sum of unit counts^2, sum of unit timesums^2]}.
+    '''
+    scale = units_total / sampled if sampled else 1.0
+    aggregator.intervals = {}
+    for url, stats in aggregator.items():
+        count_squares, time_squares = squares.get(url, (0.0, 0.0))
+        aggregator.intervals[url] = (
+            confidence_interval(stats.count, count_squares,
+                                sampled, units_total),
+            confidence_interval(stats.time_sum, time_squares,
+                                sampled, units_total))
+        stats.count = round(stats.count * scale)
+        stats.time_sum *= scale
+        stats.error *= scale
+    aggregator.total_count = round(aggregator.total_count * scale)
+    aggregator.total_time *= scale
+    return aggregator
+
+
+def sample_aggregate(log_path, config, errors_threshold):
+    '''Approximate log statistics by a sample of the log.
+    Medians and percentiles are taken from the sample as is,
+    time_max is the sample maximum.
+    '''
+    settings = aggregator_settings(config)
+    units, units_total = sample_units(log_path, config)
+    aggregator = LogAggregator(**settings)
+    squares = {}
+    total_squares = 0.0
+    sampled = 0
+    for lines in units:
+        unit = parse_lines(lines, settings)
+        for url, stats in unit.items():
+            url_squares = squares.setdefault(url, [0.0, 0.0])
+            url_squares[0] += stats.count ** 2
+            url_squares[1] += stats.time_sum ** 2
+        total_squares += unit.total_count ** 2
+        aggregator.merge(unit)
+        sampled += 1
+    if aggregator.errors_percent() >= errors_threshold:
+        raise RuntimeError('wrong log format')
+    lines_ci = confidence_interval(aggregator.total_count, total_squares,
+                                   sampled, units_total)
+    extrapolate(aggregator, squares, sampled, units_total)
+    logging.info(f'sampled {sampled} of {units_total:.0f} units, '
+                 f'estimated {aggregator.total_count} lines '
+                 f'(±{lines_ci:.0f})')
+    return aggregator
+
+
+def make_report(config, aggregator, reportpath, metrics=None):
+    '''Compute statistics and render report.
+    Run metrics are saved next to the report.
+    '''
+    if metrics is None:
+        metrics = RunMetrics()
+    percentiles = config.get("PERCENTILES", [])
+    with metrics.stage('rank'):
+        max_time_sample = sorted_reqs(aggregator, config['REPORT_SIZE'])
+    urls_report = iter_report(aggregator, max_time_sample, percentiles)
+
+    logging.info('log processing completed, statistics calculated')
+    logging.info('start report rendering')
+    with metrics.stage('render'):
+        render_report(reportpath, urls_report)
+    export_format = config.get("EXPORT_FORMAT")
+    if export_format:
+        with metrics.stage('export'):
+            export_stats(aggregator, reportpath, export_format, percentiles)
+    base_path, _ = os.path.splitext(reportpath)
+    metrics.save(base_path + METRICS_SUFFIX, aggregator, report=reportpath)
+
+
+def last_line_end(log_path, offset, size):
+    '''Offset after the last complete line between offset and size.
+    '''
+    with open(log_path, 'rb') as log:
+        end = size
+        while end > offset:
+            start = max(offset, end - TAIL_BLOCK)
+            log.seek(start)
+            newline = log.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return offset
+
+
+def head_crc(log_path, size):
+    '''Crc of the first bytes of the log to detect replaced content.
+    '''
+    with open(log_path, 'rb') as log:
+        return zlib.crc32(log.read(min(size, HEAD_CHECK_SIZE)))
+
+
+def is_same_log(state, log_path, stat):
+    '''Check that checkpoint belongs to this log:
+    it wasn't rotated (inode) or truncated (size, head crc).
+    '''
+    return (state['inode'] == stat.st_ino
+            and state['device'] == stat.st_dev
+            and state['offset'] <= stat.st_size
+            and state['head_crc'] == head_crc(log_path, state['offset']))
+
+
+def tail_report(config, errors_threshold, reportpath, metrics=None):
+    '''Parse lines appended to the current log since the last run,
+    save checkpoint and re-render report.
+    Checkpoint keeps sketches only, for exact median timings of new lines
+    are appended to "<checkpoint>.timings": a run writes O(new lines),
+    but still reads all timings (in top-K mode median is estimated).
+    '''
+    log_path = os.path.join(os.path.abspath(config['LOG_DIR']), CURRENT_LOG)
+    checkpoint_path = config.get("TAIL_CHECKPOINT",
+                                 "./aggregates/tail.checkpoint")
+    timings_path = checkpoint_path + TIMINGS_SUFFIX
+    settings = aggregator_settings(config)
+    keep_timings = settings['exact_median'] and not settings['capacity']
+    if metrics is None:
+        metrics = RunMetrics()
+
+    stat = os.stat(log_path)
+    aggregator = LogAggregator(**settings)
+    state = aggregate_store.load_checkpoint(checkpoint_path, aggregator)
+    checkpoint_settings = json.loads(json.dumps(
+        dict(settings, keep_timings=keep_timings)))
+    if state is not None and not is_same_log(state, log_path, stat):
+        logging.info('log was rotated or truncated, start over')
+        state = None
+    if state is not None and state.get('settings') != checkpoint_settings:
+        logging.info('aggregator settings were changed, start over')
+        state = None
+    if state is not None and keep_timings:
+        with metrics.stage('load_timings'):
+            if not aggregate_store.load_timings(
+                    timings_path, aggregator, state.get('timings_size', 0)):
+                logging.info(f'timings are lost: {timings_path}, start over')
+                state = None
+    if state is not None:
+        offset = state['offset']
+        timings_size = state.get('timings_size', 0)
+    else:
+        aggregator = LogAggregator(**settings)
+        offset = timings_size = 0
+
+    end = last_line_end(log_path, offset, stat.st_size)
+    logging.info(f'parsing {end - offset} new bytes from offset {offset}')
+    new_lines = LogAggregator(**settings)
+    if end > offset:
+        with metrics.stage('aggregate'):
+            new_lines = parse_mapped(log_path, offset, end, settings)
+            aggregator.merge(new_lines)
+        metrics.lines = new_lines.total_count + new_lines.errors
+    if aggregator.errors_percent() >= errors_threshold:
+        raise RuntimeError('wrong log format')
+
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint_path)),
+                exist_ok=True)
+    with metrics.stage('save_aggregate'):
+        if keep_timings:
+            timings_size = aggregate_store.append_timings(
+                timings_path, new_lines, timings_size)
+        state = {'inode': stat.st_ino, 'device': stat.st_dev, 'offset': end,
+                 'head_crc': head_crc(log_path, end),
+                 'timings_size': timings_size,
+                 'settings': checkpoint_settings}
+        aggregate_store.dump_checkpoint(checkpoint_path, state, aggregator)
+    if aggregator.total_count:
+        make_report(config, aggregator, reportpath, metrics)
+    return aggregator
+
+
+def main(config, errors_threshold, workers=1, date_from=None, date_to=None,
+         tail=False, sample=False):
     logdir = config['LOG_DIR']
     report_dir = config["REPORT_DIR"]
 
     if not os.path.exists(report_dir):
         os.makedirs(report_dir)
+    metrics = RunMetrics()
+
+    if tail:
+        reportpath = os.path.join(os.path.abspath(report_dir),
+                                  'log_stats_report-current.html')
+        tail_report(config, errors_threshold, reportpath, metrics)
+        return
+
+    if date_from or date_to:
+        date_from = date_from or date_to
+        date_to = date_to or date_from
+        reportfname = (f'log_stats_report-{dotted_date(date_from)}'
+                       f'-{dotted_date(date_to)}.html')
+        reportpath = os.path.join(os.path.abspath(report_dir), reportfname)
+        aggregator = range_aggregate(config, date_from, date_to,
+                                     errors_threshold, workers, metrics)
+        make_report(config, aggregator, reportpath, metrics)
+        return
 
-    last_log_path, logdate = get_last_log(logdir)
-    logdate = f'{logdate[:4]}.{logdate[4:6]}.{logdate[6:]}'
-    reportfname = (f'log_stats_report-{logdate}.html')
+    with metrics.stage('scan'):
+        last_log_path, logdate = get_last_log(logdir)
+    if sample:
+        reportfname = f'log_stats_report-{dotted_date(logdate)}-sample.html'
+        reportpath = os.path.join(os.path.abspath(report_dir), reportfname)
+        with metrics.stage('aggregate'):
+            aggregator = sample_aggregate(last_log_path, config,
+                                          errors_threshold)
+        make_report(config, aggregator, reportpath, metrics)
+        return
+
+    reportfname = (f'log_stats_report-{dotted_date(logdate)}.html')
     reportpath = os.path.join(os.path.abspath(report_dir), reportfname)
 
     if not os.path.exists(reportpath):
-        log = list(xreadlines(last_log_path, errors_threshold))
-        logging.info('got log strings, start processing')
-        utd = url_timepoints_dict(log)
-        max_time_sample = sorted_reqs(utd, report_size)
-        urls_report = full_report(utd, max_time_sample, log)
-
-        logging.info('log processing completed, statistics calculated')
-        logging.info('start report rendering')
-        render_report(reportpath, urls_report)
+        logging.info('start streaming log processing')
+        with metrics.stage('aggregate'):
+            aggregator = aggregate_log(last_log_path, config,
+                                       errors_threshold, workers)
+        with metrics.stage('save_aggregate'):
+            save_day_aggregate(config, logdate, last_log_path, aggregator)
+        make_report(config, aggregator, reportpath, metrics)
 
     else:
         raise RuntimeError("you've got this log processing report yet!")
@@ -312,7 +1366,7 @@ if __name__ == '__main__':
 
     argsparser = create_args_parser(CONFIG_FROM_FILE)
     args = argsparser.parse_args()
-    config = load_config(CONFIG_FROM_FILE)
+    config = merge_config(config, CONFIG_FROM_FILE)
 
     if args.config:
         external_config = load_config(args.config)
@@ -321,7 +1375,10 @@ if __name__ == '__main__':
             config.update(external_config)
 
     errors_threshold = config.get('ERR_THRESHOLD')
-    if errors_threshold:
-        main(config, errors_threshold)
-    else:
-        main(config, 30)
+    with profiled(args.profile):
+        if errors_threshold:
+            main(config, errors_threshold, args.workers,
+                 args.date_from, args.date_to, args.tail, args.sample)
+        else:
+            main(config, 30, args.workers, args.date_from, args.date_to,
+                 args.tail, args.sample)
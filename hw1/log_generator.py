@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Synthetic nginx ui log generator.
+
+Output is deterministic for the same arguments and seed.
+"""
+
+from argparse import ArgumentParser
+import datetime
+import gzip
+import io
+import itertools
+import random
+
+LINE_FORMAT = ('{ip} -  - [{time_local}] "GET {url} HTTP/1.1" 200 {size} '
+               '"-" "Lynx/2.8.8dev.9 libwww-FM/2.14" "-" '
+               '"{request_id}" "dc7161be3" {request_time:.3f}\n')
+URL_TEMPLATES = ['/api/v2/banner/{}', '/api/v2/slot/{}/groups',
+                 '/api/v2/group/{}/statistic/sites/?date_type=day',
+                 '/api/1/photogenic_banners/list/?server_name={}',
+                 '/export/appinstall_raw/{}/']
+DISTRIBUTIONS = {
+    'exp': lambda rnd: rnd.expovariate(5),
+    'lognormal': lambda rnd: rnd.lognormvariate(-2, 1),
+    'pareto': lambda rnd: rnd.paretovariate(2) / 10,
+}
+START_TIME = datetime.datetime(2017, 6, 29, 3, 50, 22)
+BATCH_SIZE = 10000
+
+
+def make_urls(cardinality):
+    '''Distinct URLs of several API patterns.
+    '''
+    return [URL_TEMPLATES[i % len(URL_TEMPLATES)].format(i)
+            for i in range(cardinality)]
+
+
+def generate_lines(lines_count, cardinality=1000, distribution='lognormal',
+                   error_rate=0.0, seed=0):
+    '''Yields log lines, URL popularity follows Zipf law.
+    '''
+    rnd = random.Random(seed)
+    urls = make_urls(cardinality)
+    cum_weights = list(itertools.accumulate(
+        1 / rank for rank in range(1, cardinality + 1)))
+    request_time = DISTRIBUTIONS[distribution]
+    generated = 0
+    while generated < lines_count:
+        batch = min(BATCH_SIZE, lines_count - generated)
+        for url in rnd.choices(urls, cum_weights=cum_weights, k=batch):
+            if error_rate and rnd.random() < error_rate:
+                yield 'malformed line\n'
+            else:
+                time_local = START_TIME + datetime.timedelta(
+                    seconds=generated // 100)
+                yield LINE_FORMAT.format(
+                    ip=f'1.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.32',
+                    time_local=time_local.strftime('%d/%b/%Y:%H:%M:%S +0300'),
+                    url=url, size=rnd.randint(0, 100000),
+                    request_id=f'{rnd.getrandbits(40)}-{generated}',
+                    request_time=request_time(rnd))
+            generated += 1
+
+
+def generate(path, lines_count, cardinality=1000, distribution='lognormal',
+             error_rate=0.0, seed=0, compress=None):
+    '''Write synthetic log, gzip if compress or path ends with .gz.
+    '''
+    if compress is None:
+        compress = path.endswith('.gz')
+    # zero mtime keeps gzip output byte-identical between runs
+    log = (io.TextIOWrapper(gzip.GzipFile(path, 'wb', mtime=0))
+           if compress else open(path, 'w'))
+    with log:
+        log.writelines(generate_lines(lines_count, cardinality,
+                                      distribution, error_rate, seed))
+    return path
+
+
+def create_args_parser():
+    '''Create arguments parse.
+    '''
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('path', help='output log path, .gz is compressed')
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--urls', type=int, default=1000,
+                        help='URL cardinality')
+    parser.add_argument('--distribution', choices=sorted(DISTRIBUTIONS),
+                        default='lognormal', help='request time distribution')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of malformed lines')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_args_parser().parse_args()
+    generate(args.path, args.lines, args.urls, args.distribution,
+             args.error_rate, args.seed)
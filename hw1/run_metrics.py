@@ -0,0 +1,152 @@
+"""Stage timings and memory metrics of the log analyzer run.
+
+Every stage is timed, while it runs a background thread samples
+resident memory, so peak RSS of the stage is known.
+Metrics are saved as JSON next to the report.
+"""
+
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.05
+STATM_PATH = '/proc/self/statm'
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    '''Peak resident set size of the process (or its children), MB.
+    '''
+    maxrss = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return maxrss / 2 ** 20
+    return maxrss / 2 ** 10
+
+
+def current_rss_mb():
+    '''Current resident set size, MB.
+    Falls back to peak RSS where /proc is not available.
+    '''
+    try:
+        with open(STATM_PATH) as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return peak_rss_mb()
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+class MemorySampler(threading.Thread):
+    """Samples RSS every `interval` seconds until stopped."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss_mb()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def stop(self):
+        '''Stop sampling and return peak RSS, MB.
+        '''
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss_mb())
+        return self.peak
+
+
+class RunMetrics:
+    """Metrics of a single analyzer run: stages and log figures.
+    `lines` is set if fewer lines than the aggregator holds were parsed
+    by this run, e.g. in tail mode or when saved day aggregates
+    were merged; lines_per_sec counts only them.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.lines = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Time the stage and sample its memory.
+        Repeated stages are summed up.
+        '''
+        sampler = MemorySampler()
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = sampler.stop()
+            stage = self.stages.setdefault(
+                name, {'seconds': 0.0, 'peak_rss_mb': 0.0})
+            stage['seconds'] = round(stage['seconds'] + seconds, 4)
+            stage['peak_rss_mb'] = round(max(stage['peak_rss_mb'], peak), 1)
+            logging.info(f'{name} stage: {seconds:.3f}s, '
+                         f'peak rss {peak:.1f} MB')
+
+    def seconds(self, name):
+        '''Stage seconds, 0 if it wasn't run.
+        '''
+        return self.stages.get(name, {}).get('seconds', 0.0)
+
+    def summary(self, aggregator, **extra):
+        '''Metrics dict of the run for the aggregated log.
+        '''
+        total_lines = aggregator.total_count + aggregator.errors
+        lines = total_lines if self.lines is None else self.lines
+        aggregate_seconds = self.seconds('aggregate')
+        summary = {
+            'lines': lines,
+            'aggregated_lines': total_lines,
+            'lines_per_sec': (round(lines / aggregate_seconds)
+                              if aggregate_seconds else None),
+            'error_ratio': (round(aggregator.errors / total_lines, 6)
+                            if total_lines else 0.0),
+            'rejected': dict(aggregator.rejected),
+            'distinct_urls': len(aggregator),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'workers_peak_rss_mb': round(
+                peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+            'total_seconds': round(time.perf_counter() - self.started, 4),
+            'stages': self.stages,
+        }
+        summary.update(extra)
+        return summary
+
+    def save(self, path, aggregator, **extra):
+        '''Write metrics JSON.
+        '''
+        with open(path, 'w') as metrics_file:
+            json.dump(self.summary(aggregator, **extra), metrics_file,
+                      indent=2)
+        logging.info(f'metrics saved: {path}')
+        return path
+
+
+@contextlib.contextmanager
+def profiled(profile_path):
+    '''Run the block under cProfile and dump stats to profile_path.
+    Does nothing if profile_path is empty.
+    '''
+    if not profile_path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        logging.info(f'profile saved: {profile_path}')
@@ -0,0 +1,99 @@
+"""Mergeable quantile sketch.
+"""
+
+import math
+
+
+class QuantileSketch:
+    """Log-bucketed histogram of positive values (DDSketch-like).
+
+    Value x goes to bucket ceil(log(x) / log(gamma)),
+    gamma = (1 + alpha) / (1 - alpha), so any estimated quantile
+    differs from the true one by no more than `alpha` (relative).
+    Memory is bounded by `max_buckets`: when it's exceeded the lowest
+    buckets are collapsed, which only affects the lowest quantiles.
+    """
+
+    MIN_VALUE = 1e-9
+
+    def __init__(self, alpha=0.01, max_buckets=2048):
+        if not 0 < alpha < 1:
+            raise ValueError('alpha must be in (0, 1)')
+        self.alpha = alpha
+        self.max_buckets = max_buckets
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def bucket_index(self, value):
+        '''Bucket index of positive value.
+        '''
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def bucket_value(self, index):
+        '''Representative value of bucket.
+        '''
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        '''Account value.
+        '''
+        self.count += count
+        if value < self.MIN_VALUE:
+            self.zero_count += count
+            return
+        index = self.bucket_index(value)
+        buckets = self.buckets
+        buckets[index] = buckets.get(index, 0) + count
+        if len(buckets) > self.max_buckets:
+            self.collapse()
+
+    def collapse(self):
+        '''Fold the lowest buckets into one to respect max_buckets.
+        '''
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.max_buckets + 1
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.buckets[target] += self.buckets.pop(index)
+
+    def merge(self, other):
+        '''Merge other sketch into this one.
+        '''
+        if other.alpha != self.alpha:
+            raise ValueError('cannot merge sketches with different alpha')
+        buckets = self.buckets
+        for index, count in other.buckets.items():
+            buckets[index] = buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if len(buckets) > self.max_buckets:
+            self.collapse()
+        return self
+
+    def quantile(self, q):
+        '''Estimate q-quantile, 0 <= q <= 1.
+        '''
+        if not 0 <= q <= 1:
+            raise ValueError('quantile must be in [0, 1]')
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return self.bucket_value(index)
+        return self.bucket_value(max(self.buckets))
+
+    def percentile(self, p):
+        '''Estimate p-th percentile, 0 <= p <= 100.
+        '''
+        return self.quantile(p / 100)
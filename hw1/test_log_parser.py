@@ -1,5 +1,20 @@
+import collections
+import csv
+import gzip
+import json
+import mmap
+import os
+import random
+import tempfile
 import unittest
+import unittest.mock
 import hw1_log_parser as lp
+import aggregate_store
+import gzip_index
+import log_generator
+import run_metrics
+import url_table
+from sketch import QuantileSketch
 
 class TestLogParser(unittest.TestCase):
     
@@ -48,6 +63,786 @@ class TestLogParser(unittest.TestCase):
 
         self.assertEqual(lp.all_reqs_timesum(utd), utd_timesum)
 
+
+class TestLogAggregator(unittest.TestCase):
+
+    loglist = [['url_1', '0.000319'],
+               ['url_2', '0.1363'],
+               ['url_1', '1.380001']]
+
+    def test_aggregate(self):
+        aggregator = lp.LogAggregator().update(self.loglist)
+        self.assertEqual(len(aggregator), 2)
+        self.assertEqual(aggregator.total_count, 3)
+        url_1 = aggregator.get('url_1')
+        self.assertEqual(url_1.count, 2)
+        self.assertEqual(url_1.time_max, 1.380001)
+        self.assertEqual(list(url_1.timings), [0.000319, 1.380001])
+
+    def test_merge(self):
+        left = lp.LogAggregator().update(self.loglist[:2])
+        right = lp.LogAggregator().update(self.loglist[2:])
+        merged = left.merge(right)
+        whole = lp.LogAggregator().update(self.loglist)
+        self.assertEqual(merged.total_count, whole.total_count)
+        self.assertEqual(merged.get('url_1').count, 2)
+        self.assertEqual(sorted(merged.urls), sorted(whole.urls))
+
+    def test_report_same_as_dict(self):
+        utd = lp.url_timepoints_dict(self.loglist)
+        aggregator = lp.LogAggregator().update(self.loglist)
+        self.assertEqual(lp.sorted_reqs(aggregator, 2),
+                         lp.sorted_reqs(utd, 2))
+        self.assertEqual(
+            lp.full_report(aggregator, lp.sorted_reqs(aggregator, 2)),
+            lp.full_report(utd, lp.sorted_reqs(utd, 2)))
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(42)
+        self.values = [rnd.expovariate(5) for _ in range(10000)]
+
+    def assertRelClose(self, estimated, exact, alpha):
+        self.assertLessEqual(abs(estimated - exact), alpha * exact)
+
+    def test_error_bound(self):
+        sketch = QuantileSketch(alpha=0.01)
+        for value in self.values:
+            sketch.add(value)
+        ordered = sorted(self.values)
+        for p in (50, 90, 95, 99):
+            exact = ordered[int(p / 100 * (len(ordered) - 1))]
+            self.assertRelClose(sketch.percentile(p), exact, 0.01)
+
+    def test_merge(self):
+        whole, left, right = (QuantileSketch() for _ in range(3))
+        for i, value in enumerate(self.values):
+            whole.add(value)
+            (left if i % 2 else right).add(value)
+        merged = left.merge(right)
+        self.assertEqual(merged.count, whole.count)
+        self.assertEqual(merged.buckets, whole.buckets)
+
+    def test_zero_and_bounded(self):
+        sketch = QuantileSketch(alpha=0.01, max_buckets=16)
+        sketch.add(0.0)
+        for value in self.values:
+            sketch.add(value)
+        self.assertLessEqual(len(sketch.buckets), 16)
+        self.assertEqual(sketch.quantile(0), 0.0)
+        self.assertEqual(len(sketch), len(self.values) + 1)
+
+    def test_report_percentiles(self):
+        aggregator = lp.LogAggregator(exact_median=False)
+        aggregator.update(('url', value) for value in self.values)
+        sample = lp.sorted_reqs(aggregator, 1)
+        row, = lp.full_report(aggregator, sample, [50, 99.9])
+        self.assertIn('time_p99.9', row)
+        self.assertAlmostEqual(row['time_p50'], row['time_med'])
+
+
+LOG_LINE = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] '
+            '"GET {url} HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9" "-" '
+            '"1498697422-2190034393-4708-9752759" "dc7161be3" {time}\n')
+
+
+def write_log(dirpath, lines_count, seed=0, name='nginx-access-ui.log'):
+    rnd = random.Random(seed)
+    path = os.path.join(dirpath, name)
+    with open(path, 'w') as log:
+        for _ in range(lines_count):
+            log.write(LOG_LINE.format(
+                url=f'/api/v2/banner/{rnd.randint(1, 50)}',
+                time=f'{rnd.expovariate(5):.3f}'))
+    return path
+
+
+class TestParallelParsing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.log_path = write_log(self.tmpdir.name, 3000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_chunk_offsets(self):
+        chunks = lp.chunk_offsets(self.log_path, 7)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], os.path.getsize(self.log_path))
+        with open(self.log_path, 'rb') as log:
+            data = log.read()
+        for start, end in chunks:
+            self.assertEqual(data[start - 1:start] or b'\n', b'\n')
+        lines = sum(len(list(lp.read_chunk(self.log_path, *chunk)))
+                    for chunk in chunks)
+        self.assertEqual(lines, 3000)
+
+    def test_same_as_serial(self):
+        serial = lp.LogAggregator().update(
+            lp.xreadlines(self.log_path, 30))
+        parallel = lp.parallel_aggregate(self.log_path, 2)
+        self.assertEqual(parallel.total_count, serial.total_count)
+        self.assertEqual(
+            lp.full_report(parallel, lp.sorted_reqs(parallel, 10)),
+            lp.full_report(serial, lp.sorted_reqs(serial, 10)))
+
+
+class TestMmapReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.log_path = write_log(self.tmpdir.name, 3000)
+        with open(self.log_path, 'a') as log:
+            log.write(LOG_LINE.format(url='/long/' + 'x' * 20000, time=1))
+            log.write('no newline at the end 0.5')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_windows(self):
+        with open(self.log_path, 'rb') as log:
+            expected = log.read().splitlines(keepends=True)
+        lines = []
+        for window, first, last in lp.mmap_windows(
+                self.log_path, window_size=mmap.ALLOCATIONGRANULARITY):
+            lines.extend(window[first:last].splitlines(keepends=True))
+        self.assertEqual(lines, expected)
+
+    def test_same_as_lines(self):
+        with open(self.log_path, 'rb') as log:
+            expected = lp.parse_lines(log)
+        mapped = lp.parse_mapped(self.log_path)
+        self.assertEqual(mapped.total_count, 3001)
+        self.assertEqual(mapped.rejected, expected.rejected)
+        self.assertEqual(
+            lp.full_report(mapped, lp.sorted_reqs(mapped, 10)),
+            lp.full_report(expected, lp.sorted_reqs(expected, 10)))
+
+    def test_ranges(self):
+        chunks = lp.chunk_offsets(self.log_path, 5)
+        total = sum(lp.parse_mapped(self.log_path, start, end).total_count
+                    for start, end in chunks)
+        self.assertEqual(total, 3001)
+
+    def test_parse_span(self):
+        line = LOG_LINE.format(url='/api/1', time=0.25).encode()
+        buffer = b'garbage 1\n' + line + b'tail'
+        start = len(b'garbage 1\n')
+        self.assertEqual(lp.parse_line(buffer, start, start + len(line)),
+                         ('/api/1', 0.25))
+        self.assertEqual(lp.parse_line(b'x "GET /a HTTP" ab', 0, 18),
+                         lp.REJECT_BAD_TIME)
+
+
+@unittest.skipUnless(gzip_index.is_supported(), 'libz is not available')
+class TestGzipIndex(unittest.TestCase):
+
+    span = 64 * 1024
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        log_path = write_log(self.tmpdir.name, 20000)
+        with open(log_path, 'rb') as log:
+            self.data = log.read()
+        self.gz_path = log_path + '.gz'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_gzip(self, members=1, level=6):
+        step = len(self.data) // members + 1
+        with open(self.gz_path, 'wb') as gz:
+            for start in range(0, len(self.data), step):
+                # members are split in the middle of lines
+                gz.write(gzip.compress(self.data[start:start + step], level))
+
+    def read_by_points(self, index):
+        points = index.points
+        ends = [point.out_offset for point in points[1:]] + [None]
+        return b''.join(
+            b''.join(gzip_index.read_lines(self.gz_path, point, out_end))
+            for point, out_end in zip(points, ends))
+
+    def test_single_member(self):
+        self.write_gzip()
+        index = gzip_index.build_index(self.gz_path, self.span)
+        self.assertGreater(len(index.points), 2)
+        self.assertEqual(self.read_by_points(index), self.data)
+
+    def test_multi_member(self):
+        self.write_gzip(members=5)
+        index = gzip_index.build_index(self.gz_path, self.span)
+        self.assertEqual(self.read_by_points(index), self.data)
+
+    def test_index_reused_and_rebuilt(self):
+        self.write_gzip(level=1)
+        index = gzip_index.get_index(self.gz_path, self.span)
+        sidecar = gzip_index.index_path(self.gz_path)
+        self.assertTrue(os.path.exists(sidecar))
+        self.assertEqual(gzip_index.get_index(self.gz_path, self.span),
+                         index)
+        self.write_gzip(level=9)
+        rebuilt = gzip_index.get_index(self.gz_path, self.span)
+        self.assertNotEqual(rebuilt.fingerprint, index.fingerprint)
+        self.assertEqual(self.read_by_points(rebuilt), self.data)
+
+    def test_point_ranges(self):
+        self.write_gzip(members=2)
+        index = gzip_index.build_index(self.gz_path, self.span)
+        self.assertGreater(len(index.points), 2)
+        ranges = lp.point_ranges(index.points, 2)
+        self.assertEqual(len(ranges), 2)
+        self.assertEqual(b''.join(
+            b''.join(gzip_index.read_lines(self.gz_path, point, out_end))
+            for point, out_end in ranges), self.data)
+
+    def test_empty_log(self):
+        open(self.gz_path, 'wb').close()
+        self.assertEqual(lp.point_ranges(
+            gzip_index.get_index(self.gz_path).points, 2), [])
+        self.assertEqual(lp.parallel_aggregate(self.gz_path, 2).total_count,
+                         0)
+
+    def test_index_not_saved(self):
+        self.write_gzip()
+        save_index = gzip_index.save_index
+
+        def failing_save(index, path):
+            raise OSError(30, 'Read-only file system')
+
+        gzip_index.save_index = failing_save
+        self.addCleanup(setattr, gzip_index, 'save_index', save_index)
+        index = gzip_index.get_index(self.gz_path, self.span)
+        self.assertEqual(self.read_by_points(index), self.data)
+        self.assertFalse(os.path.exists(gzip_index.index_path(self.gz_path)))
+
+    def test_same_as_plain(self):
+        self.write_gzip(members=3)
+        plain = lp.parallel_aggregate(self.gz_path[:-3], 2)
+        compressed = lp.parallel_aggregate(self.gz_path, 2)
+        self.assertEqual(
+            lp.full_report(compressed, lp.sorted_reqs(compressed, 10)),
+            lp.full_report(plain, lp.sorted_reqs(plain, 10)))
+
+
+class TestParseLine(unittest.TestCase):
+
+    def test_parse(self):
+        line = LOG_LINE.format(url='/api/1/?a=b', time='0.133').encode()
+        self.assertEqual(lp.parse_line(line), ('/api/1/?a=b', 0.133))
+        self.assertEqual(lp.process_line(line.decode()),
+                         ('/api/1/?a=b', 0.133))
+
+    def test_rejected(self):
+        self.assertEqual(lp.parse_line(b'garbage\n'), lp.REJECT_NO_REQUEST)
+        self.assertEqual(lp.parse_line(b'1.1.1.1 "0" 400 0.001\n'),
+                         lp.REJECT_BAD_REQUEST)
+        line = LOG_LINE.format(url='/api/1/', time='-').encode()
+        self.assertEqual(lp.parse_line(line), lp.REJECT_BAD_TIME)
+        line = LOG_LINE.format(url='/api/\udcff/', time='0.1').encode(
+            'utf-8', 'surrogateescape')
+        self.assertEqual(lp.parse_line(line), lp.REJECT_BAD_URL)
+        self.assertIsNone(lp.process_line('garbage'))
+
+    def test_errors_threshold(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_path = write_log(tmpdir, 3)
+            with open(log_path, 'a') as log:
+                log.write('garbage\n')
+            rejected = collections.Counter()
+            parsed = list(lp.xreadlines(log_path, 30, rejected))
+            self.assertEqual(len(parsed), 3)
+            self.assertEqual(rejected, {lp.REJECT_NO_REQUEST: 1})
+            with self.assertRaises(RuntimeError):
+                list(lp.xreadlines(log_path, 25))
+
+
+class TestAggregateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.logdir = os.path.join(self.tmpdir.name, 'log')
+        os.makedirs(self.logdir)
+        self.config = dict(lp.config, LOG_DIR=self.logdir,
+                           AGGREGATE_DIR=os.path.join(self.tmpdir.name,
+                                                      'aggregates'))
+        for day in ('20170628', '20170629'):
+            write_log(self.logdir, 500, seed=int(day),
+                      name=f'nginx-access-ui.log-{day}')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        log_path = os.path.join(self.logdir, 'nginx-access-ui.log-20170628')
+        aggregator = lp.LogAggregator().update(lp.xreadlines(log_path, 30))
+        for keep_timings in (False, True):
+            loaded = aggregate_store.loads(
+                aggregate_store.dumps(aggregator, keep_timings),
+                lp.LogAggregator())
+            self.assertEqual(loaded.total_count, aggregator.total_count)
+            for url, stats in aggregator.items():
+                self.assertEqual(loaded.get(url).sketch.buckets,
+                                 stats.sketch.buckets)
+                self.assertEqual(loaded.get(url).timings is None,
+                                 not keep_timings)
+        with self.assertRaises(ValueError):
+            aggregate_store.loads(aggregate_store.dumps(aggregator),
+                                  lp.LogAggregator(alpha=0.02))
+
+    def test_damaged_saved_day_skipped(self):
+        lp.range_aggregate(self.config, '20170628', '20170629', 30)
+        os.remove(os.path.join(self.logdir, 'nginx-access-ui.log-20170628'))
+        store_dir = self.config['AGGREGATE_DIR']
+        for path in aggregate_store.day_aggregates(store_dir, '20170628'):
+            with open(path, 'wb') as damaged:
+                damaged.write(b'truncated')
+        merged = lp.range_aggregate(self.config, '20170628', '20170629', 30)
+        self.assertEqual(merged.total_count, 500)
+
+    def test_settings_change_reparses(self):
+        lp.range_aggregate(self.config, '20170628', '20170628', 30)
+        config = dict(self.config, TOP_K_CAPACITY=10)
+        merged = lp.range_aggregate(config, '20170628', '20170628', 30)
+        self.assertEqual(merged.capacity, 10)
+        self.assertLessEqual(len(merged), 10)
+        saved = aggregate_store.day_aggregates(config['AGGREGATE_DIR'],
+                                               '20170628')
+        self.assertEqual(len(saved), 1)
+        os.remove(os.path.join(self.logdir, 'nginx-access-ui.log-20170628'))
+        with self.assertRaises(FileNotFoundError):
+            lp.range_aggregate(self.config, '20170628', '20170628', 30)
+
+    def test_config_file_keeps_defaults(self):
+        config_path = os.path.join(self.tmpdir.name, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump({'LOG_DIR': self.logdir, 'REPORT_SIZE': 5}, config_file)
+        config = lp.merge_config(lp.config, config_path,
+                                 os.path.join(self.tmpdir.name, 'missing'))
+        self.assertEqual(config['REPORT_SIZE'], 5)
+        self.assertEqual(config['AGGREGATE_DIR'], lp.config['AGGREGATE_DIR'])
+        self.assertEqual(config['PERCENTILES'], lp.config['PERCENTILES'])
+        self.assertEqual(lp.config['REPORT_SIZE'], 1000)
+
+    def test_range_uses_saved_days(self):
+        metrics = lp.RunMetrics()
+        parsed = lp.range_aggregate(self.config, '20170627', '20170629', 30,
+                                    metrics=metrics)
+        self.assertEqual(metrics.lines, 1000)
+        saved = os.listdir(self.config['AGGREGATE_DIR'])
+        self.assertEqual(len(saved), 2)
+        # raw logs are not needed anymore
+        for file in os.listdir(self.logdir):
+            os.remove(os.path.join(self.logdir, file))
+        metrics = lp.RunMetrics()
+        merged = lp.range_aggregate(self.config, '20170627', '20170629', 30,
+                                    metrics=metrics)
+        summary = metrics.summary(merged)
+        self.assertEqual(summary['lines'], 0)
+        self.assertIsNone(summary['lines_per_sec'])
+        self.assertEqual(merged.total_count, parsed.total_count)
+        self.assertEqual(merged.total_count, 1000)
+        self.assertEqual(
+            lp.full_report(merged, lp.sorted_reqs(merged, 5), [90]),
+            lp.full_report(parsed, lp.sorted_reqs(parsed, 5), [90]))
+
+
+class TestTailMode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config = dict(lp.config, LOG_DIR=self.tmpdir.name,
+                           TAIL_CHECKPOINT=os.path.join(self.tmpdir.name,
+                                                        'tail.checkpoint'))
+        self.reportpath = os.path.join(self.tmpdir.name, 'tail_report.html')
+        self.log_path = write_log(self.tmpdir.name, 200, seed=1)
+        with open(self.log_path) as log:
+            self.lines = log.readlines()
+        # render_report reads template from working dir
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        with open('report.html', 'w') as template:
+            template.write('var table = $table_json;')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def tail(self):
+        return lp.tail_report(self.config, 30, self.reportpath)
+
+    def full(self):
+        return lp.LogAggregator().update(lp.xreadlines(self.log_path, 30))
+
+    def assertSameReport(self, left, right):
+        self.assertEqual(left.total_count, right.total_count)
+        self.assertEqual(lp.full_report(left, lp.sorted_reqs(left, 5)),
+                         lp.full_report(right, lp.sorted_reqs(right, 5)))
+
+    def test_incremental(self):
+        with open(self.log_path, 'w') as log:
+            log.writelines(self.lines[:100])
+            # partially written line is left for the next run
+            log.write(self.lines[100][:20])
+        self.assertEqual(self.tail().total_count, 100)
+        with open(self.log_path, 'a') as log:
+            log.write(self.lines[100][20:])
+            log.writelines(self.lines[101:])
+        self.assertSameReport(self.tail(), self.full())
+        self.assertSameReport(self.tail(), self.full())
+
+    def test_settings_changed(self):
+        with open(self.log_path, 'w') as log:
+            log.writelines(self.lines[:100])
+        for changed in ({'EXACT_MEDIAN': False}, {'TOP_K_CAPACITY': 1000}):
+            config = self.config
+            self.config = dict(config, **changed)
+            self.tail()
+            self.config = config
+            with open(self.log_path, 'a') as log:
+                log.writelines(self.lines[100:150])
+            self.assertSameReport(self.tail(), self.full())
+
+    def test_timings_appended(self):
+        checkpoint = self.config['TAIL_CHECKPOINT']
+        timings_path = checkpoint + lp.TIMINGS_SUFFIX
+        with open(self.log_path, 'w') as log:
+            log.writelines(self.lines[:100])
+        self.tail()
+        first_size = os.path.getsize(timings_path)
+        with open(self.log_path, 'a') as log:
+            log.writelines(self.lines[100:])
+        self.assertSameReport(self.tail(), self.full())
+        # only timings of new lines are written, checkpoint has none
+        self.assertAlmostEqual(os.path.getsize(timings_path) / first_size,
+                               2, delta=0.5)
+        loaded = lp.LogAggregator()
+        aggregate_store.load_checkpoint(checkpoint, loaded)
+        self.assertTrue(all(stats.timings is None
+                            for _, stats in loaded.items()))
+        os.remove(timings_path)
+        self.assertSameReport(self.tail(), self.full())
+
+    def test_rotation_and_truncation(self):
+        self.tail()
+        os.rename(self.log_path, self.log_path + '-20170630')
+        write_log(self.tmpdir.name, 50, seed=2)
+        self.assertSameReport(self.tail(), self.full())
+        with open(self.log_path, 'w') as log:
+            log.writelines(self.lines[:10])
+        self.assertSameReport(self.tail(), self.full())
+
+
+class TestHeavyHitters(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(7)
+        self.lines = []
+        for i in range(20000):
+            if i % 2:
+                # bots: every URL is unique
+                url = f'/bot/?q={rnd.getrandbits(64):x}'
+            else:
+                url = f'/api/{min(int(rnd.paretovariate(1)), 500)}/'
+            self.lines.append((url, rnd.expovariate(5)))
+        self.exact = lp.LogAggregator().update(self.lines)
+
+    def assertBounds(self, aggregator, top=10):
+        self.assertLessEqual(len(aggregator), aggregator.capacity)
+        self.assertEqual(aggregator.total_count, self.exact.total_count)
+        for url in lp.sorted_reqs(self.exact, top):
+            stats, exact = aggregator.get(url), self.exact.get(url)
+            self.assertIsNotNone(stats, url)
+            self.assertGreaterEqual(stats.time_sum + 1e-9, exact.time_sum)
+            self.assertLessEqual(stats.time_sum - stats.error,
+                                 exact.time_sum + 1e-9)
+
+    def test_space_saving(self):
+        aggregator = lp.LogAggregator(capacity=200).update(self.lines)
+        self.assertBounds(aggregator)
+        row = lp.full_report(aggregator, lp.sorted_reqs(aggregator, 1))[0]
+        self.assertIn('time_sum_err', row)
+
+    def test_merge(self):
+        left = lp.LogAggregator(capacity=200).update(self.lines[:10000])
+        right = lp.LogAggregator(capacity=200).update(self.lines[10000:])
+        self.assertBounds(left.merge(right))
+
+    def test_normalize(self):
+        aggregator = lp.LogAggregator(url_rules=lp.config['URL_RULES'])
+        aggregator.update([('/api/v2/banner/25019354', 1),
+                           ('/api/v2/banner/7/?h=0123456789abcdef0', 1),
+                           ('/x/550e8400-e29b-41d4-a716-446655440000', 1)])
+        self.assertEqual(sorted(aggregator.urls),
+                         ['/api/v2/banner/{id}',
+                          '/api/v2/banner/{id}/?h={hash}',
+                          '/x/{uuid}'])
+
+    def test_ids_reused(self):
+        aggregator = lp.LogAggregator(capacity=200).update(self.lines)
+        table = aggregator.table
+        self.assertEqual(len(table.count), 200)
+        self.assertEqual(sorted(table.ids.values()), list(range(200)))
+        for url, url_id in table.ids.items():
+            self.assertEqual(table.urls[url_id], url)
+
+
+class TestReportBuilding(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(3)
+        self.aggregator = lp.LogAggregator().update(
+            (f'/url/{rnd.randint(1, 300)}', round(rnd.random(), 1))
+            for _ in range(5000))
+
+    def test_top_same_as_full_sort(self):
+        time_sums = dict(lp.time_sum(self.aggregator))
+        expected = sorted(time_sums.items(), key=lambda pair: pair[1],
+                          reverse=True)[:50]
+        self.assertEqual(list(lp.sorted_reqs(self.aggregator, 50).items()),
+                         expected)
+
+    @unittest.skipIf(lp.numpy is None, 'numpy is not installed')
+    def test_numpy_medians(self):
+        stats_list = [stats for _, stats in self.aggregator.items()]
+        self.assertEqual(lp.numpy_medians([s.timings for s in stats_list]),
+                         [lp.median(s.timings) for s in stats_list])
+
+
+class TestURLTable(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(5)
+        self.loglist = [(f'/url/{rnd.randint(1, 40)}',
+                         round(rnd.random(), 3)) for _ in range(20000)]
+        self.aggregator = lp.LogAggregator().update(self.loglist)
+        self.table = self.aggregator.table
+
+    def test_same_as_dict(self):
+        utd = lp.url_timepoints_dict(self.loglist)
+        self.assertEqual(list(self.table.ids), list(utd))
+        self.assertEqual(list(self.table.ids.values()), list(range(40)))
+        for url, timepoints in utd.items():
+            url_id = self.table.ids[url]
+            self.assertEqual(self.table.urls[url_id], url)
+            self.assertEqual(self.table.count[url_id], len(timepoints))
+            self.assertEqual(self.table.time_max[url_id], max(timepoints))
+            self.assertEqual(list(self.table.timings[url_id]), timepoints)
+
+    def assertGroupBy(self, ids):
+        columns = self.table.group_by(ids)
+        utd = lp.url_timepoints_dict(self.loglist)
+        for i, url_id in enumerate(ids):
+            timepoints = utd[self.table.urls[url_id]]
+            self.assertEqual(columns['count'][i], len(timepoints))
+            self.assertAlmostEqual(columns['time_sum'][i], sum(timepoints))
+            self.assertEqual(columns['time_max'][i], max(timepoints))
+            self.assertEqual(columns['time_med'][i], lp.median(timepoints))
+            self.assertEqual(columns['error'][i], 0.0)
+
+    def test_group_by(self):
+        ids = [7, 3, 39, 0]
+        self.assertGroupBy(ids)
+        with unittest.mock.patch.object(url_table, 'numpy', None):
+            self.assertGroupBy(ids)
+
+    def test_group_by_sketch_median(self):
+        aggregator = lp.LogAggregator(exact_median=False).update(self.loglist)
+        columns = aggregator.table.group_by([0, 1])
+        self.assertEqual(columns['time_med'],
+                         [aggregator.table.sketches[0].quantile(0.5),
+                          aggregator.table.sketches[1].quantile(0.5)])
+
+    def test_export_same_as_stats(self):
+        rows = list(lp.iter_url_stats(self.aggregator, [90]))
+        self.assertEqual(len(rows), 40)
+        for url, count, time_sum, time_max, time_med, p90, error in rows:
+            stats = self.aggregator.get(url)
+            self.assertEqual([count, time_sum, time_max, time_med],
+                             [stats.count, stats.time_sum, stats.time_max,
+                              stats.median()])
+            self.assertEqual(p90, stats.percentile(90))
+            self.assertEqual(error, stats.error)
+
+
+class TestLogGenerator(unittest.TestCase):
+
+    def test_deterministic(self):
+        first = list(log_generator.generate_lines(500, 50, seed=1))
+        self.assertEqual(first,
+                         list(log_generator.generate_lines(500, 50, seed=1)))
+        self.assertNotEqual(first,
+                            list(log_generator.generate_lines(500, 50)))
+
+    def test_parsed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log_path = log_generator.generate(
+                os.path.join(tmpdir, 'synthetic.log.gz'), 2000,
+                cardinality=30, distribution='pareto', error_rate=0.1)
+            rejected = collections.Counter()
+            aggregator = lp.LogAggregator().update(
+                lp.xreadlines(log_path, 30, rejected))
+        self.assertEqual(aggregator.total_count + sum(rejected.values()),
+                         2000)
+        self.assertLessEqual(len(aggregator), 30)
+        self.assertGreater(rejected[lp.REJECT_NO_REQUEST], 100)
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.log_path = write_log(self.tmpdir.name, 20000)
+        self.exact = lp.LogAggregator().update(
+            lp.xreadlines(self.log_path, 30))
+        self.config = dict(lp.config, SAMPLE_BLOCKS=40,
+                           SAMPLE_BLOCK_SIZE=8192)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_blocks_cover_log(self):
+        blocks, total = lp.sample_blocks(self.log_path, 10 ** 6, 8192)
+        self.assertEqual(len(blocks), total)
+        self.assertEqual(blocks[-1][1], os.path.getsize(self.log_path))
+        sampled = lp.sample_aggregate(
+            self.log_path, dict(self.config, SAMPLE_BLOCKS=10 ** 6), 30)
+        self.assertEqual(sampled.total_count, 20000)
+        for url, stats in self.exact.items():
+            self.assertEqual(sampled.get(url).count, stats.count)
+            self.assertEqual(sampled.intervals[url], (0.0, 0.0))
+
+    def test_estimates(self):
+        sampled = lp.sample_aggregate(self.log_path, self.config, 30)
+        self.assertAlmostEqual(sampled.total_count, 20000, delta=2000)
+        covered = collections.Counter()
+        for url, stats in sampled.items():
+            count_ci, time_sum_ci = sampled.intervals[url]
+            self.assertGreater(count_ci, 0)
+            exact = self.exact.get(url)
+            covered['count'] += abs(stats.count - exact.count) <= count_ci
+            covered['time_sum'] += (abs(stats.time_sum - exact.time_sum)
+                                    <= time_sum_ci)
+        self.assertGreater(covered['count'] / len(sampled), 0.8)
+        self.assertGreater(covered['time_sum'] / len(sampled), 0.8)
+        row = lp.full_report(sampled, lp.sorted_reqs(sampled, 5), [90])[0]
+        self.assertEqual(list(row)[-3:], ['time_p90', 'count_ci',
+                                          'time_sum_ci'])
+
+    def test_gzip_reservoir(self):
+        gz_path = self.log_path + '-20170630.gz'
+        with open(self.log_path, 'rb') as log, gzip.open(gz_path, 'wb') as gz:
+            gz.write(log.read())
+        sampled = lp.sample_aggregate(
+            gz_path, dict(self.config, SAMPLE_LINES=2000), 30)
+        self.assertEqual(sampled.total_count, 20000)
+        self.assertAlmostEqual(sampled.total_time, self.exact.total_time,
+                               delta=self.exact.total_time * 0.1)
+
+
+class TestReportOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        with open('report.html', 'w') as template:
+            template.write('<script>var table = $table_json;</script>')
+        self.aggregator = lp.LogAggregator().update(
+            [('/url/"quoted"', 0.5), ('/url/2', 0.25), ('/url/"quoted"', 1)])
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_render_json(self):
+        rows = lp.full_report(self.aggregator,
+                              lp.sorted_reqs(self.aggregator, 10))
+        lp.render_report('out.html', iter(rows))
+        with open('out.html') as report:
+            page = report.read()
+        prefix = '<script>var table = '
+        self.assertTrue(page.startswith(prefix))
+        self.assertEqual(json.loads(page[len(prefix):-len(';</script>')]),
+                         rows)
+        self.assertFalse(os.path.exists('out.html.tmp'))
+
+    def test_render_escapes_script(self):
+        url = '/url/</script><script>alert("x&y")</script>\u2028'
+        rows = lp.full_report(lp.LogAggregator().update([(url, 0.5)]),
+                              {url: 0.5})
+        lp.render_report('out.html', iter(rows))
+        with open('out.html', encoding='utf-8') as report:
+            page = report.read()
+        prefix = '<script>var table = '
+        table = page[len(prefix):-len(';</script>')]
+        for char in '<>&\u2028':
+            self.assertNotIn(char, table)
+        self.assertEqual(json.loads(table), rows)
+
+    def test_export_csv(self):
+        path = lp.export_stats(self.aggregator, 'out.html', 'csv', [90])
+        self.assertTrue(path.endswith('out.csv.gz'))
+        with gzip.open(path, 'rt', newline='') as export:
+            rows = list(csv.reader(export))
+        self.assertEqual(rows[0], lp.export_columns([90]))
+        self.assertEqual(rows[1][:3], ['/url/"quoted"', '2', '1.5'])
+        self.assertEqual(len(rows), 3)
+
+    @unittest.skipIf(lp.numpy is None, 'numpy is not installed')
+    def test_export_npz(self):
+        path = lp.export_stats(self.aggregator, 'out.html', 'npz')
+        with lp.numpy.load(path) as export:
+            self.assertEqual(list(export['url']), ['/url/"quoted"', '/url/2'])
+            self.assertEqual(list(export['count']), [2, 1])
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    def test_stages(self):
+        metrics = run_metrics.RunMetrics()
+        for _ in range(2):
+            with metrics.stage('aggregate'):
+                aggregator = lp.LogAggregator().update(
+                    [('/a', 1), ('/b', 2)])
+        aggregator.rejected[lp.REJECT_BAD_TIME] += 2
+        summary = metrics.summary(aggregator, report='r.html')
+        self.assertEqual(set(metrics.stages), {'aggregate'})
+        self.assertEqual(summary['lines'], 4)
+        self.assertEqual(summary['error_ratio'], 0.5)
+        self.assertEqual(summary['distinct_urls'], 2)
+        self.assertGreater(summary['peak_rss_mb'], 0)
+        self.assertEqual(summary['report'], 'r.html')
+
+    def test_metrics_next_to_report(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                with open('report.html', 'w') as template:
+                    template.write('$table_json')
+                log_path = write_log(tmpdir, 100)
+                config = dict(lp.config, REPORT_SIZE=5)
+                aggregator = lp.aggregate_log(log_path, config, 30)
+                lp.make_report(config, aggregator, 'out.html')
+                with open('out.metrics.json') as metrics_file:
+                    summary = json.load(metrics_file)
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(summary['lines'], 100)
+        self.assertEqual(set(summary['stages']), {'rank', 'render'})
+
+    def test_profiled(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profile_path = os.path.join(tmpdir, 'run.prof')
+            with run_metrics.profiled(profile_path):
+                lp.median([3, 1, 2])
+            self.assertGreater(os.path.getsize(profile_path), 0)
+
+
 if __name__ == "__main__":
     unittest.main(lp)
 
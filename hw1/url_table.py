@@ -0,0 +1,237 @@
+"""Dictionary-encoded URL statistics table.
+
+URLs are mapped to dense integer ids, statistics of URL with id `i`
+are kept in row `i` of columns: typed arrays of count, timesum, max
+and top-K error, a quantile sketch and, if exact median is required,
+request times in a typed double array (8 bytes per request).
+Statistics of many URLs are computed by vectorized group-by over
+the columns.
+"""
+
+from array import array
+
+from sketch import QuantileSketch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# typed columns gathered by group_by
+COLUMNS = ('count', 'time_sum', 'time_max', 'error')
+
+
+class URLTable:
+    """Per-URL statistics in columns indexed by dense URL ids.
+    Ids of released URLs are reused, so in top-K mode the columns
+    don't grow beyond capacity.
+    """
+
+    def __init__(self, alpha=0.01, keep_timings=True):
+        self.alpha = alpha
+        self.keep_timings = keep_timings
+        self.ids = {}
+        self.urls = []
+        self.free = []
+        self.count = array('q')
+        self.time_sum = array('d')
+        self.time_max = array('d')
+        self.error = array('d')
+        self.sketches = []
+        self.timings = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, url):
+        return url in self.ids
+
+    def intern(self, url):
+        '''Dense id of URL, new URL gets a released or the next id
+        with empty statistics.
+        '''
+        url_id = self.ids.get(url)
+        if url_id is not None:
+            return url_id
+        sketch = QuantileSketch(self.alpha)
+        timings = array('d') if self.keep_timings else None
+        if self.free:
+            url_id = self.free.pop()
+            self.urls[url_id] = url
+            self.count[url_id] = 0
+            self.time_sum[url_id] = 0.0
+            self.time_max[url_id] = 0.0
+            self.error[url_id] = 0.0
+            self.sketches[url_id] = sketch
+            self.timings[url_id] = timings
+        else:
+            url_id = len(self.urls)
+            self.urls.append(url)
+            self.count.append(0)
+            self.time_sum.append(0.0)
+            self.time_max.append(0.0)
+            self.error.append(0.0)
+            self.sketches.append(sketch)
+            self.timings.append(timings)
+        self.ids[url] = url_id
+        return url_id
+
+    def release(self, url):
+        '''Forget URL statistics, its id goes to the next new URL.
+        '''
+        url_id = self.ids.pop(url)
+        self.urls[url_id] = None
+        self.sketches[url_id] = None
+        self.timings[url_id] = None
+        self.free.append(url_id)
+        return url_id
+
+    def add(self, url_id, reqtime):
+        '''Account single request time of URL.
+        '''
+        self.count[url_id] += 1
+        self.time_sum[url_id] += reqtime
+        if reqtime > self.time_max[url_id]:
+            self.time_max[url_id] = reqtime
+        timings = self.timings[url_id]
+        if timings is not None:
+            timings.append(reqtime)
+        self.sketches[url_id].add(reqtime)
+
+    def merge_row(self, url_id, other, other_id):
+        '''Merge statistics of URL other_id of other table into url_id.
+        '''
+        self.count[url_id] += other.count[other_id]
+        self.time_sum[url_id] += other.time_sum[other_id]
+        self.error[url_id] += other.error[other_id]
+        if other.time_max[other_id] > self.time_max[url_id]:
+            self.time_max[url_id] = other.time_max[other_id]
+        timings = self.timings[url_id]
+        if timings is not None:
+            other_timings = other.timings[other_id]
+            if other_timings is None:
+                self.timings[url_id] = None
+            else:
+                timings.extend(other_timings)
+        self.sketches[url_id].merge(other.sketches[other_id])
+
+    def group_by(self, ids):
+        '''Statistics columns of URLs with ids, in the same order:
+        count, time_sum, time_max, error and time_med (exact if timings
+        are kept, else estimated by sketch).
+        '''
+        ids = list(ids)
+        index = None
+        if numpy is not None and ids:
+            index = numpy.array(ids, dtype=numpy.intp)
+        columns = {}
+        for name in COLUMNS:
+            column = getattr(self, name)
+            if index is None:
+                columns[name] = [column[url_id] for url_id in ids]
+            else:
+                columns[name] = numpy.frombuffer(
+                    column, dtype=column.typecode)[index].tolist()
+        timings_list = [self.timings[url_id] for url_id in ids]
+        if any(timings is None for timings in timings_list):
+            columns['time_med'] = [
+                self.sketches[url_id].quantile(0.5) if timings is None
+                else python_medians([timings])[0]
+                for url_id, timings in zip(ids, timings_list)]
+        else:
+            columns['time_med'] = group_medians(timings_list)
+        return columns
+
+
+def row_property(column):
+    '''Property reading and writing URL row of the table column.
+    '''
+    def get(stats):
+        return getattr(stats.table, column)[stats.url_id]
+
+    def set(stats, value):
+        getattr(stats.table, column)[stats.url_id] = value
+
+    return property(get, set)
+
+
+class URLStats:
+    """Request time statistics of a single URL: a view of its row
+    in URLTable, valid while the URL is tracked.
+    Keeps count, timesum, max and a quantile sketch.
+    If exact median is required, timings are also stored
+    in a compact double array (8 bytes per request).
+    In top-K mode timesum may be overestimated by `error`.
+    """
+
+    __slots__ = ('table', 'url_id')
+
+    def __init__(self, table, url_id):
+        self.table = table
+        self.url_id = url_id
+
+    count = row_property('count')
+    time_sum = row_property('time_sum')
+    time_max = row_property('time_max')
+    error = row_property('error')
+    timings = row_property('timings')
+    sketch = row_property('sketches')
+
+    def add(self, reqtime):
+        '''Account single request time.
+        '''
+        self.table.add(self.url_id, reqtime)
+
+    def merge(self, other):
+        '''Merge other URL statistics into this one.
+        '''
+        self.table.merge_row(self.url_id, other.table, other.url_id)
+
+    def median(self):
+        '''Exact median if timings are kept, estimated otherwise.
+        '''
+        if self.timings is not None:
+            return python_medians([self.timings])[0]
+        return self.sketch.quantile(0.5)
+
+    def percentile(self, p):
+        '''Estimated p-th percentile of request time.
+        '''
+        return self.sketch.percentile(p)
+
+
+def group_medians(timings_list):
+    '''Medians of several non-empty timings arrays,
+    vectorized if numpy is available.
+    '''
+    if numpy is None or not timings_list:
+        return python_medians(timings_list)
+    return numpy_medians(timings_list)
+
+
+def numpy_medians(timings_list):
+    '''Medians of several timings arrays in one vectorized pass:
+    values are sorted within groups, then middle elements are taken.
+    '''
+    counts = numpy.fromiter(map(len, timings_list), dtype=numpy.int64,
+                            count=len(timings_list))
+    values = numpy.concatenate(
+        [numpy.frombuffer(timings, dtype=numpy.float64)
+         for timings in timings_list])
+    groups = numpy.repeat(numpy.arange(len(counts)), counts)
+    sorted_values = values[numpy.lexsort((values, groups))]
+    starts = numpy.cumsum(counts) - counts
+    low = sorted_values[starts + (counts - 1) // 2]
+    high = sorted_values[starts + counts // 2]
+    return ((low + high) / 2).tolist()
+
+
+def python_medians(timings_list):
+    '''Same as numpy_medians, URL by URL.
+    '''
+    medians = []
+    for timings in timings_list:
+        ordered = sorted(timings)
+        middle = len(ordered) // 2
+        medians.append((ordered[middle] + ordered[~middle]) / 2)
+    return medians
@@ -9,14 +9,23 @@ import datetime
 import logging
 import hashlib
 from pyclbr import Class
-import re
+import queue
+import selectors
+import signal
+import socket
+import threading
+import time
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from optparse import OptionParser
-from scoring import get_score, get_interests
+from scoring import get_score, get_many_interests
 import store
+from metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from schema import (Request, CharField, ArgumentsField, EmailField,
+                    PhoneField, DateField, BirthDayField, GenderField,
+                    ClientIDsField, GENDERS, NON_FIELD_ERRORS)
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
-empty_field = [[], (), {}, '', None]
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
@@ -26,166 +35,30 @@ FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
-UNKNOWN = 0
-MALE = 1
-FEMALE = 2
-GENDERS = {
-    UNKNOWN: "unknown",
-    MALE: "male",
-    FEMALE: "female",
-}
-
-
-class Field:
-    """Common field value validation.
-    """
-
-    def __init__(self, required, nullable):
-        self.required = required
-        self.nullable = nullable
-
-    def is_empty(self, inp):
-        '''Check if field value is empty.
-        '''
-
-        if not inp:
-            return True
-        return False
-
-    def check_inp(self, inp):
-        '''Check if requred value is correct.
-        '''
-
-        if self.required and self.is_empty(inp):
-            raise ValueError("Поле должно быть заполнено")
-
-        if not self.nullable and inp in empty_field:
-            raise ValueError("Поле не может быть пустым")
-
-
-class CharField(Field):
-    """Common char field class.
-    """
-
-    def check_str_arg(self, inp):
-        '''Check is input str.
-        '''
-        super().check_inp(inp)
-        if not isinstance(inp, str):
-            raise ValueError("Поле должно содержать текст")
-        return inp
-
-
-class ArgumentsField(Field):
-    """User arguments field validation and handling.
-    """
-
-    def validate(self, inp):
-        '''Field validation.
-        '''
-        super().check_inp(inp)
-        if not isinstance(inp, dict):
-            raise ValueError("Поле должно содержать python-словарь")
-
-
-class EmailField(CharField):
-    """E-mail field validation and handling.
-    """
-
-    def validate(self, inp):
-        '''Field validation.
-        '''
-        super().check_str_arg(inp)
-        email_pattern = '[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\\.[a-zA-Z0-9-.]+'
-        if not re.search(email_pattern, inp):
-            raise ValueError('Неверный формат адреса эл. почты')
-        return inp
-
-
-class PhoneField(Field):
-    """Phone field validation and handling.
-    """
-
-    def validate(self, inp):
-        '''Field validation.
-        '''
-        super().check_inp(inp)
-        phone_pattern = '7\d{10}'
-        if not re.search(phone_pattern, str(inp)):
-            raise ValueError('Неверный формат номера телефона')
-        return inp
-
-
-class DateField(Field):
-    """Common date field class.
-    """
-
-    def strptime(self, inp):
-        '''String to date.
-        '''
-        default_format = "%d.%m.%Y"
-        return datetime.datetime.strptime(inp, default_format).date()
-
-    def validate(self, inp):
-        '''Field validation.
-        '''
-        super().check_inp(inp)
-        try:
-            return self.strptime(inp)
-        except ValueError:
-            raise
-
-
-class BirthDayField(DateField):
-    """Birthday field validation and handling.
-    """
-
-    def validate(self, inp):
-        '''Field validation.
-        '''
-        inp = super().strptime(inp)
-        now = datetime.date.today()
-        timedelta = now - inp
-        if timedelta.days / 365  > 70:
-            raise ValueError("С введенной даты прошло больше 70 лет")
-        return inp
-
-
-class GenderField(Field):
-    """Gender field validation and handling.
-    """
-
-    def validate(self, inp):
-        '''Field validation.
-        '''
-        super().check_inp(inp)
-        if inp not in GENDERS:
-            raise ValueError("Значение должно быть 0, 1 или 2")
-        return inp
-
-
-class ClientIDsField(Field):
-    """ID's field validation and handling.
-    """
-
-    def validate_ids(self, inp):
-        '''Field validation.
-        '''
-        super().check_inp(inp)
-        if not isinstance(inp, list) \
-            or not all(
-                        isinstance(elem, int) for elem in inp):
-            raise TypeError("Поле должно содержать массив целых чисел")
-
-
-class ClientsInterestsRequest:
+REJECT_BODY = json.dumps({"error": ERRORS[SERVICE_UNAVAILABLE],
+                          "code": SERVICE_UNAVAILABLE}).encode("utf-8")
+REJECT_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\n"
+                   b"Content-Type: application/json\r\n"
+                   b"Content-Length: %d\r\n"
+                   b"Connection: close\r\n\r\n" % len(REJECT_BODY)
+                   + REJECT_BODY)
+REJECT_DRAIN = 64 * 1024
+REJECT_LINGER = 1.0
+REJECT_POLL = 0.01
+BATCH_MAX_ITEMS = 1000
+BATCH_WORKERS = 16
+
+
+class ClientsInterestsRequest(Request):
     """Get client IDs and date if validated.
     """
 
@@ -193,7 +66,7 @@ class ClientsInterestsRequest:
     date = DateField(required=False, nullable=True)
 
 
-class OnlineScoreRequest:
+class OnlineScoreRequest(Request):
     """Get person data if validated.
     """
 
@@ -204,27 +77,18 @@ class OnlineScoreRequest:
     birthday = BirthDayField(required=False, nullable=True)
     gender = GenderField(required=False, nullable=True)
 
-    pairs = (bool(first_name and last_name),
-             bool(email and phone),
-             bool(birthday and gender))
-
-    if not any(pairs):
-        raise ValueError('''Некорректно заполнены аргументы.
-                            См. требования по заполнению''')
-
-
-class Request:
-    '''Main request class.
-    Contains request attributes.
-    '''
-
-    def __init__(self, request, ctx):
-        self.ctx = ctx
-
-        for fieldname, value in request.items():
-            setattr(self, fieldname, value)
-            if value not in empty_field:
-                self.ctx['has'] += [fieldname]
+    @staticmethod
+    def check_fields(values):
+        '''At least one pair of arguments should be filled.
+        '''
+        pairs = (values["first_name"] is not None
+                 and values["last_name"] is not None,
+                 values["email"] is not None and values["phone"] is not None,
+                 values["birthday"] is not None
+                 and values["gender"] is not None)
+        if not any(pairs):
+            raise ValueError("Нужна хотя бы одна пара: first_name и "
+                             "last_name, email и phone, birthday и gender")
 
 
 class MethodRequest(Request):
@@ -249,20 +113,24 @@ def check_auth(request):
     '''
 
     if request.is_admin:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        msg = datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT
     else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
+        msg = (request.account or "") + (request.login or "") + SALT
+    digest = hashlib.sha512(msg.encode("utf-8")).hexdigest()
     if digest == request.token:
         return True
     return False
 
 
-def online_score(req_fields: MethodRequest, store):
+def online_score(request: MethodRequest, ctx, store):
     '''Run online score method.
     '''
-    req = OnlineScoreRequest(req_fields)
+    req = OnlineScoreRequest(request.arguments)
+    if req.errors:
+        return req.errors, INVALID_REQUEST
+    ctx["has"] = req.has
 
-    if req.is_admin():
+    if request.is_admin:
         score = 42
     else:
         score = get_score(store,
@@ -275,38 +143,208 @@ def online_score(req_fields: MethodRequest, store):
 
     return {"score": score}, OK
 
-def clients_interests(req_fields: MethodRequest, store):
+def clients_interests(request: MethodRequest, ctx, store):
     '''Run clients interests method.
     '''
 
-    req = ClientsInterestsRequest(req_fields)
+    req = ClientsInterestsRequest(request.arguments)
+    if req.errors:
+        return req.errors, INVALID_REQUEST
 
-    req.ctx["nclients"] = len(req.client_ids)
-    response = {clid: get_interests(store, clid)
-                for clid
-                in req.client_ids}
+    ctx["nclients"] = len(req.client_ids)
+    response = get_many_interests(store, req.client_ids)
     return response, OK
 
 
+HANDLERS = {
+    "online_score": online_score,
+    "clients_interests": clients_interests
+}
+
+
+def run_method(method_request, ctx, store):
+    '''Run method of validated and authenticated request.
+    '''
+
+    if method_request.method not in HANDLERS:
+        return {"method": "Неизвестный метод"}, INVALID_REQUEST
+    return HANDLERS[method_request.method](method_request, ctx, store)
+
+
 def method_handler(request, ctx, store):
-    '''Run methods.
+    '''Run methods. List body is a batch of method requests.
     '''
 
-    response, code = None, None
-    handlers = {
-        "online_score": online_score,
-        "clients_interests": clients_interests
-    }
+    if isinstance(request['body'], list):
+        return batch_handler(request['body'], ctx, store)
 
-    method_fields = MethodRequest(request['body'])
+    method_request = MethodRequest(request['body'])
 
-    if not method_fields:
-        return 'Invalid request', INVALID_REQUEST
-    if not check_auth(method_fields):
+    if method_request.errors:
+        return method_request.errors, INVALID_REQUEST
+    if not check_auth(method_request):
         return 'Forbidden', FORBIDDEN
 
-    response, code = handlers[method_fields.method](method_fields, ctx, store)
-    return response, code
+    return run_method(method_request, ctx, store)
+
+
+batch_executor = ThreadPoolExecutor(BATCH_WORKERS, thread_name_prefix="batch")
+
+
+def run_batch_item(method_request, ctx, store):
+    '''Run method of batch item, error fails only the item.
+    '''
+
+    try:
+        return run_method(method_request, ctx, store)
+    except Exception as exc:
+        logging.exception("Unexpected error in batch item: %s" % exc)
+        return None, INTERNAL_ERROR
+
+
+def check_batch_item(item, authorized):
+    '''Validate and authenticate batch item, `authorized` caches
+    auth result of account/login/token.
+    Returns (request, None) if the item should run,
+    otherwise (None, (response, code)).
+    '''
+
+    method_request = MethodRequest(item)
+    if method_request.errors:
+        return None, (method_request.errors, INVALID_REQUEST)
+    key = (method_request.account, method_request.login,
+           method_request.token)
+    if key not in authorized:
+        authorized[key] = check_auth(method_request)
+    if not authorized[key]:
+        return None, ('Forbidden', FORBIDDEN)
+    return method_request, None
+
+
+def batch_handler(items, ctx, store):
+    '''Run batch of method requests.
+    Items are validated first, each distinct account/login/token is
+    authenticated once, then valid items run concurrently.
+    Returns list of per-item responses in the order of items.
+    '''
+
+    if not items or len(items) > BATCH_MAX_ITEMS:
+        return ("Batch should contain from 1 to %s requests"
+                % BATCH_MAX_ITEMS), INVALID_REQUEST
+
+    authorized = {}
+    results = []
+    contexts = [{} for _ in items]
+    for item, item_ctx in zip(items, contexts):
+        try:
+            method_request, result = check_batch_item(item, authorized)
+        except Exception as exc:
+            logging.exception("Unexpected error in batch item: %s" % exc)
+            method_request, result = None, (None, INTERNAL_ERROR)
+        if method_request is None:
+            results.append(result)
+            continue
+        results.append(batch_executor.submit(
+            run_batch_item, method_request, item_ctx, store))
+
+    ctx["batch"] = contexts
+    ctx["nauth"] = len(authorized)
+    return [make_response(*(result.result() if isinstance(result, Future)
+                            else result))
+            for result in results], OK
+
+
+def make_response(response, code):
+    '''Response body of method call.
+    '''
+
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"),
+            "code": code}
+
+
+def make_metrics():
+    '''Service metrics registry with declared families.
+    '''
+
+    registry = Metrics()
+    registry.describe("api_request_duration_seconds", "histogram",
+                      "Request handling time by method.")
+    registry.describe("api_responses_total", "counter",
+                      "Responses by status code.")
+    registry.describe("api_in_flight_requests", "gauge",
+                      "Requests being handled now.")
+    registry.describe("store_duration_seconds", "histogram",
+                      "Storage call time by operation.")
+    registry.describe("store_circuit_open", "gauge",
+                      "1 if store calls are short-circuited.")
+    registry.describe("store_circuit_events_total", "counter",
+                      "Store circuit breaker transitions, "
+                      "short-circuited calls and failed probes.")
+    registry.describe("write_behind_pending", "gauge",
+                      "Cache writes queued for the storage.")
+    registry.describe("write_behind_events_total", "counter",
+                      "Cache writes written, merged, dropped or failed "
+                      "and batches written.")
+    registry.describe("local_cache_hit_ratio", "gauge",
+                      "Share of local cache lookups that were hits.")
+    registry.describe("local_cache_events_total", "counter",
+                      "Local cache hits, misses, evictions and expirations.")
+    return registry
+
+
+def instrument_store(registry, main_store):
+    '''Observe storage latency, circuit breaker state, write-behind
+    queue and local cache counters of the store.
+    '''
+
+    histograms = {
+        operation: registry.histogram("store_duration_seconds",
+                                      operation=operation)
+        for operation in ("get", "get_many", "set", "set_many")}
+    breaker = main_store.storage
+    if isinstance(breaker, store.CircuitBreaker):
+        breaker.storage = store.TimedStorage(breaker.storage, histograms)
+        registry.gauge("store_circuit_open",
+                       lambda: int(breaker.state == breaker.OPEN))
+        for event in ("opened", "closed", "short_circuited",
+                      "probe_failures"):
+            registry.gauge("store_circuit_events_total",
+                           lambda event=event: breaker.stats().get(event, 0),
+                           event=event)
+    else:
+        main_store.storage = store.TimedStorage(main_store.storage,
+                                                histograms)
+    writer = main_store.write_behind
+    if writer is not None:
+        registry.gauge("write_behind_pending",
+                       lambda: writer.stats()["pending"])
+        for event in ("written", "batches", "merged", "dropped", "failed"):
+            registry.gauge("write_behind_events_total",
+                           lambda event=event: writer.stats().get(event, 0),
+                           event=event)
+    cache = main_store.local_cache
+    if cache is not None:
+        registry.gauge("local_cache_hit_ratio",
+                       lambda: cache.stats()["hit_ratio"])
+        for event in ("hits", "misses", "evictions", "expirations",
+                      "coalesced"):
+            registry.gauge("local_cache_events_total",
+                           lambda event=event: cache.stats().get(event, 0),
+                           event=event)
+    return main_store
+
+
+def method_label(request):
+    '''Method name for metrics, limited to known methods.
+    '''
+
+    if isinstance(request, list):
+        return "batch"
+    if isinstance(request, dict) and request.get("method") in HANDLERS:
+        return request["method"]
+    return "unknown"
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
@@ -317,11 +355,40 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         "method": method_handler
     }
     store = store.Store(store.TarantoolStorage())
+    metrics = make_metrics()
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def do_GET(self):
+        if self.path.strip("/") != "metrics":
+            self.send_error(NOT_FOUND)
+            return
+        body = self.metrics.render().encode("utf-8")
+        self.send_response(OK)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_POST(self):
+        metrics = self.metrics
+        metrics.inc("api_in_flight_requests")
+        start = time.perf_counter()
+        method, code = "unknown", INTERNAL_ERROR
+        try:
+            method, code = self.handle_post()
+        finally:
+            metrics.histogram("api_request_duration_seconds",
+                              method=method).observe(
+                                  time.perf_counter() - start)
+            metrics.inc("api_responses_total", code=code)
+            metrics.inc("api_in_flight_requests", -1)
+
+    def handle_post(self):
+        '''Handle request and write response.
+        Returns method name for metrics and response code.
+        '''
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
@@ -329,11 +396,13 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             data_string = self.rfile.read(int(self.headers['Content-Length']))
             request = json.loads(data_string)
         except:
-            code = BAD_REQUEST
+            pass
 
-        if request:
+        if request is None:
+            code = BAD_REQUEST
+        else:
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+            logging.debug("%s: %s %s", self.path, data_string, context["request_id"])
             if path in self.router:
                 try:
                     response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
@@ -346,27 +415,211 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
         self.end_headers()
-        if code not in ERRORS:
-            resp = {"response": response, "code": code}
-        else:
-            resp = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+        resp = make_response(response, code)
         context.update(resp)
-        logging.info(context)
-        self.wfile.write(json.dumps(resp))
-        return
+        logging.debug("%s", context)
+        self.wfile.write(json.dumps(resp).encode("utf-8"))
+        return method_label(request), code
+
+    def log_request(self, code='-', size='-'):
+        logging.debug('"%s" %s %s', self.requestline, code, size)
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server handling requests in a fixed pool of worker threads.
+    Accepted connections wait in a queue of at most `queue_size` requests
+    besides the ones being handled; when it's full the client gets 503
+    at once instead of waiting indefinitely.
+    """
+
+    def __init__(self, server_address, handler_class,
+                 workers=8, queue_size=64):
+        super().__init__(server_address, handler_class)
+        self.requests = queue.Queue()
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.workers = [threading.Thread(target=self.work,
+                                         name="worker-%s" % i, daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        self.rejected = queue.Queue()
+        self.closer = threading.Thread(target=self.linger, name="closer",
+                                       daemon=True)
+        self.closer.start()
+
+    def process_request(self, request, client_address):
+        '''Queue accepted connection for workers.
+        '''
+        if self.slots.acquire(blocking=False):
+            self.requests.put((request, client_address))
+        else:
+            self.reject(request, client_address)
+
+    def work(self):
+        '''Worker loop, None in the queue stops it.
+        '''
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.slots.release()
+
+    def reject(self, request, client_address):
+        '''Answer 503 in the accepting thread without reading the request:
+        prebuilt response is written to the non-blocking socket, which is
+        then half-closed and left to the closer thread.
+        '''
+        logging.warning("queue is full, rejecting %s:%s" % client_address)
+        metrics = getattr(self.RequestHandlerClass, "metrics", None)
+        if metrics is not None:
+            metrics.inc("api_responses_total", code=SERVICE_UNAVAILABLE)
+        try:
+            request.setblocking(False)
+            request.send(REJECT_RESPONSE)
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.close_request(request)
+            return
+        self.rejected.put((time.monotonic() + REJECT_LINGER, request))
+
+    def linger(self):
+        '''Closer loop: drop what rejected clients send and close their
+        sockets on EOF or after REJECT_LINGER, so unread request doesn't
+        reset the connection before 503 is read. None stops it.
+        '''
+        selector = selectors.DefaultSelector()
+        deadlines = {}
+        while True:
+            try:
+                item = self.rejected.get(
+                    timeout=REJECT_POLL if deadlines else None)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            try:
+                if item:
+                    deadline, sock = item
+                    deadlines[sock] = deadline
+                    selector.register(sock, selectors.EVENT_READ)
+                ready = {key.fileobj for key, _ in selector.select(0)}
+            except (OSError, ValueError) as exc:
+                logging.warning("closer: %s" % exc)
+                ready = set()
+            now = time.monotonic()
+            for sock, deadline in list(deadlines.items()):
+                if deadline < now or sock in ready and not self.drain(sock):
+                    del deadlines[sock]
+                    self.drop_rejected(selector, sock)
+        for sock in list(deadlines):
+            self.drop_rejected(selector, sock)
+        selector.close()
+
+    @staticmethod
+    def drain(sock):
+        '''Drop received bytes, False on EOF or socket error.
+        '''
+        try:
+            return bool(sock.recv(REJECT_DRAIN))
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def drop_rejected(self, selector, sock):
+        '''Stop watching rejected socket and close it.
+        '''
+        try:
+            selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        self.close_request(sock)
+
+    def server_close(self):
+        '''Close listening socket, finish queued requests
+        and stop workers.
+        '''
+        super().server_close()
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.rejected.put(None)
+        self.closer.join()
+
+
+def serve(server):
+    '''Serve until SIGTERM or Ctrl+C, then shut down gracefully:
+    stop accepting, finish accepted requests.
+    '''
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), so not in this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logging.info("Stopping server, finishing queued requests")
+    server.server_close()
 
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=8)
+    op.add_option("-q", "--queue-size", action="store", type=int,
+                  default=64)
+    op.add_option("-c", "--cache-mb", action="store", type=float, default=16)
+    op.add_option("-t", "--cache-ttl", action="store", type=float,
+                  default=60)
+    op.add_option("-s", "--storage", action="store", default="tarantool",
+                  type="choice", choices=sorted(store.STORAGES))
+    op.add_option("--store-latency-ms", action="store", type=float,
+                  default=0)
+    op.add_option("--store-jitter-ms", action="store", type=float,
+                  default=0)
+    op.add_option("--breaker-threshold", action="store", type=int,
+                  default=5)
+    op.add_option("--breaker-probe", action="store", type=float,
+                  default=1.0)
+    op.add_option("--write-batch", action="store", type=int, default=256)
+    op.add_option("--write-interval", action="store", type=float,
+                  default=0.05)
+    op.add_option("--write-max-pending", action="store", type=int,
+                  default=10000)
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    if opts.storage == "memory":
+        storage = store.MemoryStorage(latency=opts.store_latency_ms / 1000,
+                                      jitter=opts.store_jitter_ms / 1000)
+    else:
+        storage = store.STORAGES[opts.storage]()
+    if opts.breaker_threshold > 0:
+        storage = store.CircuitBreaker(storage, opts.breaker_threshold,
+                                       opts.breaker_probe)
+    local_cache = (store.LocalCache(int(opts.cache_mb * 2 ** 20),
+                                    opts.cache_ttl)
+                   if opts.cache_mb > 0 else None)
+    write_behind = (store.WriteBehind(opts.write_batch, opts.write_interval,
+                                      opts.write_max_pending)
+                    if opts.write_batch > 0 else None)
+    MainHTTPHandler.store = instrument_store(
+        MainHTTPHandler.metrics,
+        store.Store(storage, local_cache, write_behind))
+    server = PooledHTTPServer(("localhost", opts.port), MainHTTPHandler,
+                              opts.workers, opts.queue_size)
+    logging.info("Starting server at %s with %s workers"
+                 % (opts.port, opts.workers))
+    serve(server)
+    MainHTTPHandler.store.close()
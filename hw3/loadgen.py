@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Scoring API load generator.
+
+Threads send a mix of online_score and clients_interests requests
+to running api.py and report throughput and latency percentiles.
+Users are drawn from a fixed pool, so repeated users hit the caches:
+
+    python api.py --storage memory --store-latency-ms 2
+    python loadgen.py --concurrency 16 --requests 20000
+"""
+
+import hashlib
+import http.client
+import json
+import random
+import threading
+import time
+from collections import Counter
+from optparse import OptionParser
+
+from api import SALT
+
+ACCOUNT = "horns&hoofs"
+PERCENTILES = (50, 90, 95, 99)
+
+
+def token(account, login):
+    return hashlib.sha512((account + login + SALT).encode("utf-8")).hexdigest()
+
+
+def make_requests(count, interests_ratio, users, batch, seed):
+    '''Deterministic list of request bodies.
+    '''
+    rnd = random.Random(seed)
+    bodies = []
+    for _ in range(count):
+        items = []
+        for _ in range(batch):
+            user = rnd.randrange(users)
+            login = "user%s" % (user % 100)
+            if rnd.random() < interests_ratio:
+                method = "clients_interests"
+                arguments = {"client_ids": rnd.sample(range(users), 10),
+                             "date": "20.07.2017"}
+            else:
+                method = "online_score"
+                arguments = {"phone": "7%010d" % user,
+                             "email": "user%s@otus.ru" % user,
+                             "first_name": "name%s" % user,
+                             "last_name": "lname%s" % user}
+            items.append({"account": ACCOUNT, "login": login,
+                          "method": method, "token": token(ACCOUNT, login),
+                          "arguments": arguments})
+        body = items if batch > 1 else items[0]
+        bodies.append(json.dumps(body).encode("utf-8"))
+    return bodies
+
+
+def worker(host, port, bodies, latencies, codes, timeout):
+    '''Send bodies one by one, collect latencies (s) and codes.
+    '''
+    for body in bodies:
+        start = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+            conn.request("POST", "/method/", body,
+                         {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            code = response.status
+        except OSError as exc:
+            code = type(exc).__name__
+        latencies.append(time.perf_counter() - start)
+        codes[code] += 1
+
+
+def percentile(ordered, p):
+    '''Nearest-rank percentile of sorted values.
+    '''
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def run(host, port, bodies, concurrency, timeout=5.0):
+    '''Send bodies from `concurrency` threads, return report dict.
+    '''
+    parts = [bodies[i::concurrency] for i in range(concurrency)]
+    latencies = [[] for _ in parts]
+    codes = [Counter() for _ in parts]
+    threads = [threading.Thread(target=worker,
+                                args=(host, port, part, part_latencies,
+                                      part_codes, timeout))
+               for part, part_latencies, part_codes
+               in zip(parts, latencies, codes)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    ordered = sorted(latency for part in latencies for latency in part)
+    total_codes = sum(codes, Counter())
+    report = {
+        "requests": len(ordered),
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "rps": round(len(ordered) / seconds, 1) if seconds else None,
+        "codes": {str(code): count for code, count in total_codes.items()},
+        "latency_ms": {
+            "mean": round(1000 * sum(ordered) / len(ordered), 3)
+            if ordered else None,
+            "max": round(1000 * ordered[-1], 3) if ordered else None,
+        },
+    }
+    for p in PERCENTILES:
+        value = percentile(ordered, p)
+        report["latency_ms"]["p%s" % p] = (round(1000 * value, 3)
+                                           if value is not None else None)
+    return report
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("--host", action="store", default="localhost")
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-c", "--concurrency", action="store", type=int,
+                  default=8)
+    op.add_option("-n", "--requests", action="store", type=int,
+                  default=10000)
+    op.add_option("-i", "--interests-ratio", action="store", type=float,
+                  default=0.3)
+    op.add_option("-u", "--users", action="store", type=int, default=1000)
+    op.add_option("-b", "--batch", action="store", type=int, default=1)
+    op.add_option("--seed", action="store", type=int, default=0)
+    op.add_option("-o", "--output", action="store", default=None)
+    (opts, args) = op.parse_args()
+    bodies = make_requests(opts.requests, opts.interests_ratio, opts.users,
+                           opts.batch, opts.seed)
+    report = run(opts.host, opts.port, bodies, opts.concurrency)
+    print(json.dumps(report, indent=2))
+    if opts.output:
+        with open(opts.output, "w") as output:
+            json.dump(report, output, indent=2)
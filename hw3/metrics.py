@@ -0,0 +1,156 @@
+"""In-process service metrics.
+
+Counters, gauges and fixed-bucket histograms, rendered in the plain-text
+exposition format. Recording is a dict lookup, a bisect and an increment
+under a lock; series are created once and may be kept by the caller.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labels, extra=""):
+    '''{name="value",...} or empty string.
+    '''
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                          .replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Counts of observations in fixed buckets, their sum and count.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        '''Account one observation.
+        '''
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        '''Observe duration of the block, seconds.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        '''Cumulative bucket counts (le, count), sum and count.
+        '''
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        buckets, cumulative = [], 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return buckets, total, cumulative
+
+
+class Metrics:
+    """Registry of metric families.
+
+    Family is declared once with describe(); counter and gauge series are
+    changed by inc(), histogram series are taken by histogram(),
+    gauge() registers a function read at render time.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.values = {}
+        self.histograms = {}
+        self.callbacks = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, help_text):
+        '''Declare family: kind is counter, gauge or histogram.
+        '''
+        self.families[name] = (kind, help_text)
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        '''Add amount to counter or gauge series.
+        '''
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        '''Histogram series, created on the first call.
+        '''
+        key = self.key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def gauge(self, name, func, **labels):
+        '''Series which value is func() at render time.
+        '''
+        self.callbacks[self.key(name, labels)] = func
+
+    def series(self):
+        '''{family: [(labels, value or Histogram)]}.
+        '''
+        with self.lock:
+            items = list(self.values.items()) + list(self.histograms.items())
+        items += [(key, func()) for key, func in list(self.callbacks.items())]
+        families = {}
+        for (name, labels), value in items:
+            families.setdefault(name, []).append((labels, value))
+        return families
+
+    def render(self):
+        '''Metrics in the plain-text exposition format.
+        '''
+        lines = []
+        for name, series in sorted(self.series().items()):
+            kind, help_text = self.families.get(name, ("untyped", ""))
+            if help_text:
+                lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in sorted(series, key=lambda item: item[0]):
+                if not isinstance(value, Histogram):
+                    if value is not None:
+                        lines.append("%s%s %s" % (name, format_labels(labels),
+                                                  format_value(value)))
+                    continue
+                buckets, total, count = value.snapshot()
+                for bound, cumulative in buckets:
+                    le = 'le="%s"' % format_value(bound)
+                    lines.append("%s_bucket%s %s" % (
+                        name, format_labels(labels, le), cumulative))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels),
+                                              format_value(total)))
+                lines.append("%s_count%s %s" % (name, format_labels(labels),
+                                                count))
+        return "\n".join(lines) + "\n"
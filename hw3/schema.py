@@ -0,0 +1,211 @@
+"""Declarative request schemas.
+
+Request class declares fields as class attributes, RequestMeta compiles
+them once, at class creation, into a single validator function:
+regexes are precompiled, required/nullable checks and field checks are
+resolved ahead, all field errors are collected in one pass.
+"""
+
+import datetime
+import re
+
+UNKNOWN = 0
+MALE = 1
+FEMALE = 2
+GENDERS = {
+    UNKNOWN: "unknown",
+    MALE: "male",
+    FEMALE: "female",
+}
+EMAIL_RE = re.compile(r'[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+')
+PHONE_RE = re.compile(r'7\d{10}')
+MAX_AGE_DAYS = 70 * 365
+NON_FIELD_ERRORS = "non_field_errors"
+EMPTY_TYPES = (str, list, tuple, dict)
+
+
+def is_empty(value):
+    '''None or empty string/collection; 0 is a value.
+    '''
+    return value is None or (not value and isinstance(value, EMPTY_TYPES))
+
+
+def parse_date(value):
+    '''DD.MM.YYYY string to date, faster than strptime.
+    '''
+    if not isinstance(value, str):
+        raise ValueError("Дата должна быть строкой DD.MM.YYYY")
+    parts = value.split('.')
+    if len(parts) != 3 or len(parts[2]) != 4:
+        raise ValueError("Дата должна быть в формате DD.MM.YYYY")
+    day, month, year = parts
+    try:
+        return datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        raise ValueError("Некорректная дата")
+
+
+class Field:
+    """Common field: required means the key must be present,
+    nullable means the value may be empty.
+    clean() checks non-empty value and returns it converted.
+    """
+
+    def __init__(self, required, nullable):
+        self.required = required
+        self.nullable = nullable
+
+    def clean(self, value):
+        return value
+
+
+class CharField(Field):
+    """Common char field class.
+    """
+
+    def clean(self, value):
+        if not isinstance(value, str):
+            raise ValueError("Поле должно содержать текст")
+        return value
+
+
+class ArgumentsField(Field):
+    """User arguments field validation and handling.
+    """
+
+    def clean(self, value):
+        if not isinstance(value, dict):
+            raise ValueError("Поле должно содержать python-словарь")
+        return value
+
+
+class EmailField(CharField):
+    """E-mail field validation and handling.
+    """
+
+    def clean(self, value):
+        if not isinstance(value, str) or not EMAIL_RE.search(value):
+            raise ValueError('Неверный формат адреса эл. почты')
+        return value
+
+
+class PhoneField(Field):
+    """Phone field validation and handling.
+    """
+
+    def clean(self, value):
+        if not isinstance(value, (str, int)) or isinstance(value, bool) \
+                or not PHONE_RE.search(str(value)):
+            raise ValueError('Неверный формат номера телефона')
+        return value
+
+
+class DateField(Field):
+    """Common date field class.
+    """
+
+    def clean(self, value):
+        return parse_date(value)
+
+
+class BirthDayField(DateField):
+    """Birthday field validation and handling.
+    """
+
+    def clean(self, value):
+        value = parse_date(value)
+        if (datetime.date.today() - value).days > MAX_AGE_DAYS:
+            raise ValueError("С введенной даты прошло больше 70 лет")
+        return value
+
+
+class GenderField(Field):
+    """Gender field validation and handling.
+    """
+
+    def clean(self, value):
+        if type(value) is not int or value not in GENDERS:
+            raise ValueError("Значение должно быть 0, 1 или 2")
+        return value
+
+
+class ClientIDsField(Field):
+    """ID's field validation and handling.
+    """
+
+    def clean(self, value):
+        if not isinstance(value, list) \
+                or not all(type(elem) is int for elem in value):
+            raise ValueError("Поле должно содержать массив целых чисел")
+        return value
+
+
+def compile_validator(fields, check_fields=None):
+    '''Validator of data dict for {name: Field}.
+    Returns (values, errors): cleaned values of all fields (None if
+    absent or empty) and {name: message} of invalid ones.
+    check_fields(values) runs if fields are valid, its ValueError
+    goes to NON_FIELD_ERRORS.
+    '''
+    checks = tuple((name, field.required, field.nullable, field.clean)
+                   for name, field in fields.items())
+
+    def validate(data):
+        if not isinstance(data, dict):
+            return ({name: None for name in fields},
+                    {NON_FIELD_ERRORS: "Ожидается python-словарь"})
+        values, errors = {}, {}
+        for name, required, nullable, clean in checks:
+            value = data.get(name)
+            if value is None or (not value and isinstance(value, EMPTY_TYPES)):
+                if required and name not in data:
+                    errors[name] = "Поле обязательно"
+                elif not nullable:
+                    errors[name] = "Поле не может быть пустым"
+                values[name] = None
+                continue
+            try:
+                values[name] = clean(value)
+            except ValueError as exc:
+                errors[name] = str(exc)
+                values[name] = None
+        if not errors and check_fields is not None:
+            try:
+                check_fields(values)
+            except ValueError as exc:
+                errors[NON_FIELD_ERRORS] = str(exc)
+        return values, errors
+
+    return validate
+
+
+class RequestMeta(type):
+    """Collects Field attributes of the class and its bases
+    and compiles them into `validate`.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        cls = super().__new__(mcs, name, bases, namespace)
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            fields.update((attr, value) for attr, value in vars(klass).items()
+                          if isinstance(value, Field))
+        cls.fields = fields
+        cls.validate = staticmethod(
+            compile_validator(fields, getattr(cls, 'check_fields', None)))
+        return cls
+
+
+class Request(metaclass=RequestMeta):
+    """Validated request: field values are attributes,
+    `errors` holds per-field messages, `has` - names of non-empty fields.
+    """
+
+    def __init__(self, data):
+        values, self.errors = self.validate(data)
+        self.__dict__.update(values)
+        self.has = [name for name in self.fields
+                    if isinstance(data, dict) and not is_empty(data.get(name))]
+
+    def is_valid(self):
+        return not self.errors
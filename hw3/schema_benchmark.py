@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Request validation microbenchmark.
+
+Validates typical valid and invalid payloads of every request class
+and prints validations/sec.
+"""
+
+import json
+import timeit
+from optparse import OptionParser
+
+from api import MethodRequest, OnlineScoreRequest, ClientsInterestsRequest
+
+CASES = [
+    ("MethodRequest", MethodRequest,
+     {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+      "token": "0" * 128, "arguments": {"phone": "79175002040"}}),
+    ("MethodRequest invalid", MethodRequest,
+     {"account": 1, "method": ""}),
+    ("OnlineScoreRequest", OnlineScoreRequest,
+     {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1,
+      "birthday": "01.01.2000", "first_name": "a", "last_name": "b"}),
+    ("OnlineScoreRequest invalid", OnlineScoreRequest,
+     {"phone": "89175002040", "email": "stupnikovotus.ru", "gender": "1",
+      "birthday": "XXX"}),
+    ("ClientsInterestsRequest", ClientsInterestsRequest,
+     {"client_ids": list(range(20)), "date": "20.07.2017"}),
+    ("ClientsInterestsRequest invalid", ClientsInterestsRequest,
+     {"client_ids": ["1", "2"], "date": "XXX"}),
+]
+
+
+def run(number, repeat):
+    '''Best validations/sec of every case.
+    '''
+    results = {}
+    for name, request_class, payload in CASES:
+        best = min(timeit.repeat(lambda: request_class(payload),
+                                 number=number, repeat=repeat))
+        results[name] = round(number / best)
+    return results
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=20000)
+    op.add_option("-r", "--repeat", action="store", type=int, default=5)
+    op.add_option("-o", "--output", action="store", default=None)
+    (opts, args) = op.parse_args()
+    results = run(opts.number, opts.repeat)
+    for name, rate in results.items():
+        print("%-32s %10d validations/sec" % (name, rate))
+    if opts.output:
+        with open(opts.output, "w") as output:
+            json.dump(results, output, indent=2)
@@ -6,10 +6,10 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
     key_parts = [
         first_name or "",
         last_name or "",
-        phone or "",
+        str(phone) if phone else "",
         birthday.strftime("%Y%m%d") if birthday is not None else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+    key = "uid:" + hashlib.md5("".join(key_parts).encode("utf-8")).hexdigest()
     # try get from cache,
     # fallback to heavy calculation in case of cache miss
     score = store.cache_get(key) or 0
@@ -31,3 +31,10 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
 def get_interests(store, cid):
     r = store.get("i:%s" % cid)
     return json.loads(r) if r else []
+
+
+def get_many_interests(store, cids):
+    keys = {cid: "i:%s" % cid for cid in cids}
+    values = store.get_many(keys.values())
+    return {cid: json.loads(values[key]) if values.get(key) else []
+            for cid, key in keys.items()}
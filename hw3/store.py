@@ -1,44 +1,263 @@
 """Store logic realization.
 """
 
+import collections
+import contextlib
 import functools
+import logging
+import sys
+import threading
 import time
 import random
+from concurrent.futures import Future
 import tarantool
 
+GET_MANY_LUA = """
+local space, keys = ...
+local values = {}
+for i, key in ipairs(keys) do
+    local tuple = box.space[space]:get(key)
+    values[i] = tuple and tuple[2] or box.NULL
+end
+return values
+"""
+SET_MANY_LUA = """
+local space, tuples = ...
+for _, tuple in ipairs(tuples) do
+    box.space[space]:replace(tuple)
+end
+return #tuples
+"""
+NETWORK_ERRORS = (tarantool.NetworkError, ConnectionError, OSError)
+
+
+class StoreUnavailable(Exception):
+    """Store can't be reached now, the call should not wait for it."""
+
+
+class CircuitOpen(StoreUnavailable):
+    """Store call short-circuited by open CircuitBreaker."""
 
-def retry(retries=3):
+
+FAILURES = (StoreUnavailable, ) + NETWORK_ERRORS
+
+
+def retry(retries=3, deadline=0.5):
+    '''Retry call on network errors, at most `retries` times and
+    until `deadline` seconds pass. There's no sleeping between attempts:
+    a broken connection is dropped and the next attempt takes another one,
+    while the pool itself backs off reconnecting.
+    Returns None if the store is unavailable, as a cache miss.
+    '''
     def decorator(f):
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            for _ in retries:
+            stop_at = time.monotonic() + deadline
+            for attempt in range(1, retries + 1):
                 try:
                     return f(*args, **kwargs)
-                except (tarantool.NetworkError,
-                        ConnectionRefusedError):
-                    random_sec = random.randint(2, 7)
-                    time.sleep(random_sec)
+                except CircuitOpen:
+                    return None
+                except StoreUnavailable as exc:
+                    logging.warning("%s: %s" % (f.__name__, exc))
+                    return None
+                except NETWORK_ERRORS as exc:
+                    logging.warning("%s: attempt %s failed: %s"
+                                    % (f.__name__, attempt, exc))
+                    if time.monotonic() >= stop_at:
+                        break
+            return None
         return wrapper
     return decorator
 
 
+class ConnectionPool:
+    """Pool of at most `size` store connections.
+
+    Connection idle longer than `check_interval` is pinged before reuse,
+    broken connections are closed. After failed connect the next one
+    is allowed only after capped exponential backoff with jitter;
+    until then acquiring a new connection fails at once.
+    """
+
+    def __init__(self, connect, size=8, acquire_timeout=1.0,
+                 check_interval=30.0, backoff_base=0.1, backoff_cap=10.0):
+        self.connect = connect
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.check_interval = check_interval
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.idle = collections.deque()
+        self.opened = 0
+        self.failures = 0
+        self.retry_at = 0.0
+        self.counters = collections.Counter()
+        self.lock = threading.Condition()
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''Borrow connection, it's dropped if a network error occurs.
+        '''
+        conn = self.acquire()
+        try:
+            yield conn
+        except NETWORK_ERRORS:
+            self.discard(conn)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        self.release(conn)
+
+    def acquire(self):
+        '''Take idle connection or open a new one if there's a free slot.
+        Waits for a slot at most acquire_timeout seconds.
+        '''
+        deadline = time.monotonic() + self.acquire_timeout
+        with self.lock:
+            while not self.idle and self.opened >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters["acquire_timeouts"] += 1
+                    raise StoreUnavailable("no free connection in pool")
+                self.counters["waits"] += 1
+                self.lock.wait(remaining)
+            self.counters["acquired"] += 1
+            if not self.idle:
+                self.opened += 1
+                conn = None
+            else:
+                conn, last_used = self.idle.pop()
+        if conn is None:
+            return self.open()
+        if time.monotonic() - last_used > self.check_interval:
+            if not self.is_healthy(conn):
+                self.counters["health_check_failures"] += 1
+                self.close_connection(conn)
+                return self.open()
+        return conn
+
+    def open(self):
+        '''Open connection in the slot reserved by acquire().
+        '''
+        with self.lock:
+            if time.monotonic() < self.retry_at:
+                self.free_slot()
+                self.counters["backoff_rejects"] += 1
+                raise StoreUnavailable(
+                    "reconnect in %.2fs" % (self.retry_at - time.monotonic()))
+        try:
+            conn = self.connect()
+        except NETWORK_ERRORS as exc:
+            with self.lock:
+                self.free_slot()
+                self.failures += 1
+                self.retry_at = time.monotonic() + self.backoff()
+                self.counters["connect_failures"] += 1
+            raise StoreUnavailable("cannot connect: %s" % exc) from exc
+        with self.lock:
+            self.failures = 0
+            self.counters["connects"] += 1
+        return conn
+
+    def backoff(self):
+        '''Delay before the next connect after `failures` failed ones:
+        exponential, capped, half of it is random (equal jitter).
+        '''
+        delay = min(self.backoff_cap,
+                    self.backoff_base * 2 ** (self.failures - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def is_healthy(self, conn):
+        '''Check connection with ping.
+        '''
+        try:
+            conn.ping()
+        except NETWORK_ERRORS:
+            return False
+        return True
+
+    def release(self, conn):
+        '''Return connection to the pool.
+        '''
+        with self.lock:
+            self.idle.append((conn, time.monotonic()))
+            self.lock.notify()
+
+    def discard(self, conn):
+        '''Close broken connection and free its slot.
+        '''
+        self.close_connection(conn)
+        with self.lock:
+            self.counters["discarded"] += 1
+            self.free_slot()
+
+    def free_slot(self):
+        self.opened -= 1
+        self.lock.notify()
+
+    def close_connection(self, conn):
+        try:
+            conn.close()
+        except NETWORK_ERRORS:
+            pass
+
+    def close(self):
+        '''Close idle connections.
+        '''
+        with self.lock:
+            while self.idle:
+                conn, _ = self.idle.pop()
+                self.close_connection(conn)
+                self.free_slot()
+
+    def stats(self):
+        '''Pool state and counters.
+        '''
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(
+                size=self.size,
+                opened=self.opened,
+                idle=len(self.idle),
+                in_use=self.opened - len(self.idle),
+                connect_failures_in_row=self.failures,
+                backoff_remaining=round(
+                    max(0.0, self.retry_at - time.monotonic()), 3))
+        return stats
+
+
 class TarantoolStorage:
     """Key-value storage based on Tarantool logic.
+    Connections are taken from ConnectionPool.
     """
 
-    def __init__(self, host="localhost", port=8888, retries=3):
+    BATCH_SIZE = 1000
+    RECONNECT_DELAY = 0.01
+
+    def __init__(self, host="localhost", port=8888, retries=3, space="kv",
+                 pool_size=8, connect_timeout=1.0, read_timeout=0.5,
+                 acquire_timeout=1.0):
         self.host = host
         self.port = port
         self.retries = retries
-        self.tsconnect = self.connect()
+        self.space = space
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool = ConnectionPool(self.connect, pool_size, acquire_timeout)
 
 
     def connection(self):
         '''Tarantool storage connection initialization.
         '''
 
-        conn = tarantool.Connection(connect_now=False)
+        conn = tarantool.Connection(self.host, self.port,
+                                    socket_timeout=self.read_timeout,
+                                    connection_timeout=self.connect_timeout,
+                                    connect_now=False)
         conn.reconnect_max_attempts = self.retries
+        conn.reconnect_delay = self.RECONNECT_DELAY
         return conn
 
 
@@ -46,7 +265,9 @@ class TarantoolStorage:
         '''Run connection.
         '''
 
-        self.connection().connect(self.host, self.port)
+        conn = self.connection()
+        conn.connect()
+        return conn
 
 
     def get(self, key):
@@ -54,9 +275,27 @@ class TarantoolStorage:
         '''
 
         try:
-            return self.tsconnect.select(key)
+            with self.pool.connection() as conn:
+                tuples = conn.select(self.space, key)
         except tarantool.DatabaseError:
             raise tarantool.DatabaseError(("No such index"))
+        return tuples[0][1] if tuples else None
+
+    def get_many(self, keys):
+        '''Get values of several keys, one round trip per BATCH_SIZE keys.
+        Returns {key: value}, value is None for missing keys.
+        '''
+
+        values = {}
+        with self.pool.connection() as conn:
+            for start in range(0, len(keys), self.BATCH_SIZE):
+                batch = keys[start:start + self.BATCH_SIZE]
+                try:
+                    response = conn.eval(GET_MANY_LUA, (self.space, batch))
+                except tarantool.DatabaseError:
+                    raise tarantool.DatabaseError(("No such index"))
+                values.update(zip(batch, response.data[0]))
+        return values
 
 
     def set(self, key, value, sec):
@@ -64,19 +303,464 @@ class TarantoolStorage:
         '''
 
         try:
-            return self.tsconnect.insert((key, value, sec))
+            with self.pool.connection() as conn:
+                return conn.insert(self.space, (key, value, sec))
         except tarantool.DatabaseError:
             raise tarantool.DatabaseError(("Duplicate key exists in a unique index"))
 
+    def set_many(self, items):
+        '''Place or replace several (key, value, sec) tuples,
+        one round trip per BATCH_SIZE tuples.
+        '''
+
+        with self.pool.connection() as conn:
+            for start in range(0, len(items), self.BATCH_SIZE):
+                batch = [list(item)
+                         for item in items[start:start + self.BATCH_SIZE]]
+                conn.eval(SET_MANY_LUA, (self.space, batch))
+
+    def stats(self):
+        '''Connection pool stats.
+        '''
+
+        return self.pool.stats()
+
+
+class MemoryStorage:
+    """In-memory key-value storage with TarantoolStorage interface.
+    Every call sleeps `latency` plus random up to `jitter` seconds,
+    emulating a network round trip.
+    """
+
+    BATCH_SIZE = TarantoolStorage.BATCH_SIZE
+
+    def __init__(self, values=None, latency=0.0, jitter=0.0):
+        self.values = {key: (value, None)
+                       for key, value in (values or {}).items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    def round_trip(self, name):
+        with self.lock:
+            self.counters[name] += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def lookup(self, key):
+        '''Value or None if key is missing or expired.
+        '''
+        value, expires_at = self.values.get(key, (None, None))
+        if expires_at is not None and time.monotonic() >= expires_at:
+            return None
+        return value
+
+    def get(self, key):
+        '''Get value by key.
+        '''
+        self.round_trip("get")
+        with self.lock:
+            return self.lookup(key)
+
+    def get_many(self, keys):
+        '''Get values of several keys, one round trip per BATCH_SIZE keys.
+        '''
+        for _ in range(0, len(keys), self.BATCH_SIZE):
+            self.round_trip("get_many")
+        with self.lock:
+            return {key: self.lookup(key) for key in keys}
+
+    def set(self, key, value, sec):
+        '''Place value for `sec` seconds.
+        '''
+        self.round_trip("set")
+        expires_at = time.monotonic() + sec if sec else None
+        with self.lock:
+            self.values[key] = (value, expires_at)
+
+    def set_many(self, items):
+        '''Place several (key, value, sec) tuples,
+        one round trip per BATCH_SIZE tuples.
+        '''
+        for _ in range(0, len(items), self.BATCH_SIZE):
+            self.round_trip("set_many")
+        now = time.monotonic()
+        with self.lock:
+            for key, value, sec in items:
+                self.values[key] = (value, now + sec if sec else None)
+
+    def stats(self):
+        '''Number of calls of every kind.
+        '''
+        with self.lock:
+            return dict(self.counters, keys=len(self.values))
+
+
+class TimedStorage:
+    """Storage wrapper observing latency of get, get_many, set
+    and set_many into `histograms` {operation: Histogram}.
+    """
+
+    def __init__(self, storage, histograms):
+        self.storage = storage
+        self.histograms = histograms
+
+    def get(self, key):
+        with self.histograms["get"].time():
+            return self.storage.get(key)
+
+    def get_many(self, keys):
+        with self.histograms["get_many"].time():
+            return self.storage.get_many(keys)
+
+    def set(self, key, value, sec):
+        with self.histograms["set"].time():
+            return self.storage.set(key, value, sec)
+
+    def set_many(self, items):
+        with self.histograms["set_many"].time():
+            return self.storage.set_many(items)
+
+    def stats(self):
+        return self.storage.stats()
+
+
+class CircuitBreaker:
+    """Storage wrapper failing fast during store outage.
+
+    After `threshold` consecutive failed calls the circuit opens: calls
+    raise CircuitOpen without touching the storage, and a background
+    thread probes the storage every `probe_interval` seconds.
+    The first successful probe closes the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    PROBE_KEY = "health:probe"
+
+    def __init__(self, storage, threshold=5, probe_interval=1.0):
+        self.storage = storage
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.state = self.CLOSED
+        self.failures = 0
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def call(self, func, *args):
+        '''Call storage unless the circuit is open, account the result.
+        '''
+        if self.state == self.OPEN:
+            with self.lock:
+                self.counters["short_circuited"] += 1
+            raise CircuitOpen("circuit is open")
+        try:
+            result = func(*args)
+        except FAILURES:
+            self.failure()
+            raise
+        if self.failures:
+            with self.lock:
+                self.failures = 0
+        return result
+
+    def get(self, key):
+        return self.call(self.storage.get, key)
+
+    def get_many(self, keys):
+        return self.call(self.storage.get_many, keys)
+
+    def set(self, key, value, sec):
+        return self.call(self.storage.set, key, value, sec)
+
+    def set_many(self, items):
+        return self.call(self.storage.set_many, items)
+
+    def failure(self):
+        '''Count failure, open the circuit after threshold in a row.
+        '''
+        with self.lock:
+            self.failures += 1
+            if self.state == self.OPEN or self.failures < self.threshold:
+                return
+            self.state = self.OPEN
+            self.counters["opened"] += 1
+        logging.warning("store circuit opened after %s failures in a row"
+                        % self.failures)
+        threading.Thread(target=self.probe, name="store-probe",
+                         daemon=True).start()
+
+    def probe(self):
+        '''Probe the storage until it answers, then close the circuit.
+        '''
+        while not self.stopped.wait(self.probe_interval):
+            try:
+                self.storage.get(self.PROBE_KEY)
+            except FAILURES as exc:
+                with self.lock:
+                    self.counters["probe_failures"] += 1
+                logging.debug("store probe failed: %s" % exc)
+                continue
+            except tarantool.DatabaseError:
+                pass  # the store answers
+            with self.lock:
+                self.state = self.CLOSED
+                self.failures = 0
+                self.counters["closed"] += 1
+            logging.info("store circuit closed, store is available")
+            return
+
+    def close(self):
+        '''Stop probing.
+        '''
+        self.stopped.set()
+
+    def stats(self):
+        '''Circuit state and counters.
+        '''
+        with self.lock:
+            return dict(self.counters, state=self.state,
+                        failures_in_row=self.failures)
+
+
+STORAGES = {
+    "tarantool": TarantoolStorage,
+    "memory": MemoryStorage,
+}
+
+
+class LocalCache:
+    """In-process LRU cache with TTL and memory budget.
+
+    Entries live at most `ttl` seconds, least recently used ones are
+    evicted while estimated size of keys and values exceeds `max_bytes`.
+    Concurrent misses of the same key are coalesced into one load.
+    """
+
+    ENTRY_OVERHEAD = 120
+
+    def __init__(self, max_bytes=16 * 2 ** 20, ttl=60.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.loading = {}
+        self.nbytes = 0
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+
+    def entry_size(self, key, value):
+        '''Estimated memory of cached entry, bytes.
+        '''
+        return sys.getsizeof(key) + sys.getsizeof(value) + self.ENTRY_OVERHEAD
+
+    def lookup(self, key):
+        '''Fresh value or None, the caller holds the lock.
+        '''
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() >= entry[1]:
+            self.remove(key)
+            self.counters["expirations"] += 1
+            entry = None
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return entry[0]
+
+    def get(self, key):
+        '''Cached value or None.
+        '''
+        with self.lock:
+            return self.lookup(key)
+
+    def set(self, key, value, sec=None):
+        '''Cache value for `sec` seconds, but not longer than ttl.
+        '''
+        ttl = self.ttl if sec is None else min(sec, self.ttl)
+        size = self.entry_size(key, value)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, time.monotonic() + ttl, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.counters["evictions"] += 1
+
+    def remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.nbytes -= size
+
+    def get_or_load(self, key, load):
+        '''Cached value or load(key) result. Only one thread loads
+        a key, the others wait for its result. None is not cached.
+        '''
+        with self.lock:
+            value = self.lookup(key)
+            if value is not None:
+                return value
+            flight = self.loading.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.loading[key] = Future()
+            else:
+                self.counters["coalesced"] += 1
+        if not leader:
+            return flight.result()
+        try:
+            value = load(key)
+        except BaseException as exc:
+            flight.set_exception(exc)
+            raise
+        else:
+            if value is not None:
+                self.set(key, value)
+            flight.set_result(value)
+            return value
+        finally:
+            with self.lock:
+                del self.loading[key]
+
+    def stats(self):
+        '''Cache size and hit/miss/eviction counters.
+        '''
+        with self.lock:
+            stats = dict(self.counters)
+            lookups = self.counters["hits"] + self.counters["misses"]
+            stats.update(
+                entries=len(self.entries),
+                nbytes=self.nbytes,
+                max_bytes=self.max_bytes,
+                hit_ratio=round(self.counters["hits"] / lookups, 4)
+                if lookups else 0.0)
+        return stats
+
+
+class WriteBehind:
+    """Asynchronous batched cache writes.
+
+    put() only queues the write, a background thread passes queued
+    (key, value, sec) tuples to `flush` in batches of up to `batch_size`,
+    when a batch is full or `flush_interval` seconds after the first
+    queued write. Repeated writes of a queued key are merged. Writes
+    beyond `max_pending` queued keys are dropped. close() writes
+    everything queued before returning.
+    """
+
+    def __init__(self, batch_size=256, flush_interval=0.05,
+                 max_pending=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.closing = False
+        self.flush = None
+        self.thread = None
+        self.lock = threading.Condition()
+
+    def start(self, flush):
+        '''Start writing batches with flush(items).
+        '''
+        self.flush = flush
+        self.thread = threading.Thread(target=self.run, name="write-behind",
+                                       daemon=True)
+        self.thread.start()
+
+    def put(self, key, value, sec):
+        '''Queue write, returns False if it was dropped.
+        '''
+        with self.lock:
+            if key in self.pending:
+                self.counters["merged"] += 1
+            elif self.closing or len(self.pending) >= self.max_pending:
+                self.counters["dropped"] += 1
+                return False
+            self.pending[key] = (value, sec)
+            if len(self.pending) in (1, self.batch_size):
+                self.lock.notify()
+        return True
+
+    def next_batch(self):
+        '''Wait until a batch is due and take it.
+        Empty batch means the writer is closed and drained.
+        '''
+        with self.lock:
+            while not self.pending and not self.closing:
+                self.lock.wait()
+            deadline = time.monotonic() + self.flush_interval
+            while not self.closing and len(self.pending) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            batch = []
+            while self.pending and len(batch) < self.batch_size:
+                key, (value, sec) = self.pending.popitem(last=False)
+                batch.append((key, value, sec))
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return
+            self.write(batch)
+
+    def write(self, batch):
+        '''Flush batch, failed batch is counted and lost.
+        '''
+        try:
+            self.flush(batch)
+        except CircuitOpen:
+            self.count(failed=len(batch))
+        except Exception as exc:
+            self.count(failed=len(batch))
+            logging.warning("write-behind: %s writes failed: %s"
+                            % (len(batch), exc))
+        else:
+            self.count(written=len(batch), batches=1)
+
+    def count(self, **amounts):
+        with self.lock:
+            self.counters.update(amounts)
+
+    def close(self, timeout=10.0):
+        '''Stop accepting writes, flush queued ones, stop the thread.
+        '''
+        with self.lock:
+            self.closing = True
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def stats(self):
+        '''Queue size and counters.
+        '''
+        with self.lock:
+            return dict(self.counters, pending=len(self.pending),
+                        max_pending=self.max_pending)
+
 
 class Store:
     """Main storage class.
+    With local_cache cache_get and cache_set go through it first,
+    with write_behind cache_set writes to the storage asynchronously.
     """
 
     RETRIES = 3
 
-    def __init__(self, storage):
+    def __init__(self, storage, local_cache=None, write_behind=None):
         self.storage = storage
+        self.local_cache = local_cache
+        self.write_behind = write_behind
+        if write_behind is not None:
+            write_behind.start(self.storage_set_many)
 
     def get(self, key):
         '''Get value from db.
@@ -84,16 +768,54 @@ class Store:
 
         return self.storage.get(key)
 
-    @retry(RETRIES)
+    def get_many(self, keys):
+        '''Get values of several keys from db in a few round trips.
+        '''
+
+        return self.storage.get_many(list(keys))
+
     def cache_get(self, key):
         '''Get value from cache.
         '''
 
-        return self.storage.get(key)
+        if self.local_cache is None:
+            return self.storage_cache_get(key)
+        return self.local_cache.get_or_load(key, self.storage_cache_get)
 
-    @retry(RETRIES)
     def cache_set(self, key, value, sec):
         '''Place data in the cache.
         '''
 
-        return self.storage.set((key, value, sec))
+        if self.local_cache is not None:
+            self.local_cache.set(key, value, sec)
+        if self.write_behind is not None:
+            self.write_behind.put(key, value, sec)
+            return None
+        return self.storage_cache_set(key, value, sec)
+
+    @retry(RETRIES)
+    def storage_cache_get(self, key):
+        '''Get cached value from the storage.
+        '''
+
+        return self.storage.get(key)
+
+    @retry(RETRIES)
+    def storage_cache_set(self, key, value, sec):
+        '''Place cached value in the storage.
+        '''
+
+        return self.storage.set(key, value, sec)
+
+    def storage_set_many(self, items):
+        '''Place batch of cached (key, value, sec) in the storage.
+        '''
+
+        return self.storage.set_many(items)
+
+    def close(self):
+        '''Write queued cache values.
+        '''
+
+        if self.write_behind is not None:
+            self.write_behind.close()
@@ -1,9 +1,16 @@
 import hashlib
 import datetime
 import functools
+import http.client
+import json
+import os
+import resource
+import socket
+import threading
 import unittest
 
 import api
+import store
 
 
 def cases(cases):
@@ -21,19 +28,19 @@ class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
         self.headers = {}
-        self.settings = {}
+        self.settings = store.Store(store.MemoryStorage(
+            {"i:%s" % cid: '["books", "travel"]' for cid in range(10)}))
 
     def get_response(self, request):
         return api.method_handler({"body": request, "headers": self.headers}, self.context, self.settings)
 
     def set_valid_auth(self, request):
         if request.get("login") == api.ADMIN_LOGIN:
-            request["token"] = hashlib.sha512(datetime.datetime.now().strftime(
-                "%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+            msg = datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT
         else:
             msg = request.get("account", "") + \
                 request.get("login", "") + api.SALT
-            request["token"] = hashlib.sha512(msg).hexdigest()
+        request["token"] = hashlib.sha512(msg.encode("utf-8")).hexdigest()
 
     def test_empty_request(self):
         _, code = self.get_response({})
@@ -155,5 +162,350 @@ class TestSuite(unittest.TestCase):
                          len(arguments["client_ids"]))
 
 
+class TestSchema(unittest.TestCase):
+    def test_fields_compiled(self):
+        self.assertEqual(list(api.MethodRequest.fields),
+                         ["account", "login", "token", "arguments", "method"])
+        self.assertTrue(callable(api.MethodRequest.validate))
+
+    def test_all_field_errors(self):
+        req = api.OnlineScoreRequest({"phone": "89175002040",
+                                      "email": "stupnikovotus.ru",
+                                      "gender": "1", "birthday": "XXX"})
+        self.assertEqual(sorted(req.errors),
+                         ["birthday", "email", "gender", "phone"])
+        req = api.MethodRequest({"method": ""})
+        self.assertEqual(sorted(req.errors),
+                         ["arguments", "login", "method", "token"])
+
+    def test_cleaned_values(self):
+        req = api.OnlineScoreRequest({"gender": 0, "birthday": "01.01.2000"})
+        self.assertFalse(req.errors)
+        self.assertEqual(req.birthday, datetime.date(2000, 1, 1))
+        self.assertIsNone(req.phone)
+        self.assertEqual(sorted(req.has), ["birthday", "gender"])
+
+    @cases([{}, {"phone": "79175002040"}, {"first_name": "a", "gender": 1}])
+    def test_pairs(self, arguments):
+        req = api.OnlineScoreRequest(arguments)
+        self.assertEqual(list(req.errors), [api.NON_FIELD_ERRORS])
+
+    @cases(["01.13.2000", "1.1.20", "2000-01-01", 20000101])
+    def test_bad_date(self, value):
+        req = api.ClientsInterestsRequest({"client_ids": [1], "date": value})
+        self.assertEqual(list(req.errors), ["date"])
+
+
+class DictStore:
+    def __init__(self):
+        self.values = {}
+
+    def cache_get(self, key):
+        return self.values.get(key)
+
+    def cache_set(self, key, value, sec):
+        self.values[key] = value
+
+    def get_many(self, keys):
+        return {key: '["books"]' for key in keys}
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.context = {}
+        self.store = DictStore()
+        self.auth_calls = 0
+        check_auth = api.check_auth
+
+        def counting_check_auth(request):
+            self.auth_calls += 1
+            return check_auth(request)
+
+        api.check_auth = counting_check_auth
+        self.addCleanup(setattr, api, "check_auth", check_auth)
+
+    def item(self, login, method, arguments):
+        msg = "horns&hoofs" + login + api.SALT
+        return {"account": "horns&hoofs", "login": login, "method": method,
+                "token": hashlib.sha512(msg.encode()).hexdigest(),
+                "arguments": arguments}
+
+    def get_response(self, items):
+        return api.method_handler({"body": items, "headers": {}},
+                                  self.context, self.store)
+
+    def test_items(self):
+        items = [
+            self.item("h&f", "online_score",
+                      {"phone": "79175002040", "email": "a@b.ru"}),
+            self.item("h&f", "online_score", {"phone": "79175002040"}),
+            dict(self.item("h&f", "online_score", {}), token="bad"),
+            self.item("h&f", "clients_interests", {"client_ids": [1, 2]}),
+            {"login": "h&f"},
+            self.item("h&f", "unknown", {}),
+        ]
+        response, code = self.get_response(items)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([item["code"] for item in response],
+                         [api.OK, api.INVALID_REQUEST, api.FORBIDDEN,
+                          api.OK, api.INVALID_REQUEST, api.INVALID_REQUEST])
+        self.assertEqual(response[0]["response"], {"score": 3.0})
+        self.assertEqual(response[3]["response"],
+                         {1: ["books"], 2: ["books"]})
+        self.assertIn("phone", self.context["batch"][0]["has"])
+
+    def test_auth_once(self):
+        items = [self.item("login%s" % (i % 3), "online_score",
+                           {"first_name": "a", "last_name": "b"})
+                 for i in range(30)]
+        response, code = self.get_response(items)
+        self.assertEqual([item["code"] for item in response], [api.OK] * 30)
+        self.assertEqual(self.auth_calls, 3)
+
+    def test_item_exception(self):
+        class BrokenStore(DictStore):
+            def get_many(self, keys):
+                raise RuntimeError("store is broken")
+
+        self.store = BrokenStore()
+        items = [self.item("h&f", "clients_interests", {"client_ids": [1]}),
+                 self.item("h&f", "online_score",
+                           {"first_name": "a", "last_name": "b"})]
+        response, code = self.get_response(items)
+        self.assertEqual([item["code"] for item in response],
+                         [api.INTERNAL_ERROR, api.OK])
+
+    def test_null_login(self):
+        good = self.item("h&f", "online_score",
+                         {"first_name": "a", "last_name": "b"})
+        bad = dict(good, login=None)
+        response, code = self.get_response([good, bad, "not a dict"])
+        self.assertEqual(api.OK, code)
+        self.assertEqual([item["code"] for item in response],
+                         [api.OK, api.FORBIDDEN, api.INVALID_REQUEST])
+
+    def test_item_check_exception(self):
+        good = self.item("h&f", "online_score",
+                         {"first_name": "a", "last_name": "b"})
+        bad = self.item("broken", "online_score", {})
+
+        def check_auth(request):
+            if request.login == "broken":
+                raise RuntimeError("auth is broken")
+            return True
+
+        api.check_auth = check_auth
+        response, code = self.get_response([good, bad])
+        self.assertEqual([item["code"] for item in response],
+                         [api.OK, api.INTERNAL_ERROR])
+
+    def test_batch_size(self):
+        item = self.item("h&f", "online_score", {})
+        _, code = self.get_response([item] * (api.BATCH_MAX_ITEMS + 1))
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+
+class BlockingHandler(api.MainHTTPHandler):
+    """Handler waiting for the test to release it."""
+
+    entered = threading.Semaphore(0)
+    release = threading.Event()
+    router = {
+        "method": lambda request, ctx, store: (
+            BlockingHandler.entered.release()
+            or BlockingHandler.release.wait(5) and ({}, api.OK))
+    }
+
+
+class TestPooledServer(unittest.TestCase):
+    def setUp(self):
+        BlockingHandler.entered = threading.Semaphore(0)
+        BlockingHandler.release.clear()
+        self.server = api.PooledHTTPServer(("localhost", 0), BlockingHandler,
+                                           workers=2, queue_size=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.closed = False
+
+    def tearDown(self):
+        BlockingHandler.release.set()
+        if not self.closed:
+            self.server.shutdown()
+            self.server.server_close()
+        self.thread.join()
+
+    def post(self, results):
+        conn = http.client.HTTPConnection(*self.server.server_address,
+                                          timeout=10)
+        conn.request("POST", "/method/", json.dumps({"a": 1}),
+                     {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        results.append((response.status, json.loads(response.read())))
+        conn.close()
+
+    def fill(self, results):
+        '''Occupy both workers and the queue slot.
+        '''
+        clients = []
+        for _ in range(2):
+            clients.append(threading.Thread(target=self.post,
+                                            args=(results,)))
+            clients[-1].start()
+        for _ in range(2):
+            self.assertTrue(BlockingHandler.entered.acquire(timeout=5))
+        clients.append(threading.Thread(target=self.post, args=(results,)))
+        clients[-1].start()
+        while self.server.requests.qsize() < 1:
+            threading.Event().wait(0.01)
+        return clients
+
+    def test_bounded_queue(self):
+        results = []
+        clients = self.fill(results)
+        self.post(results)
+        self.assertEqual(results, [(api.SERVICE_UNAVAILABLE,
+                                    {"error": "Service Unavailable",
+                                     "code": api.SERVICE_UNAVAILABLE})])
+        BlockingHandler.release.set()
+        for client in clients:
+            client.join()
+        self.assertEqual([code for code, _ in results[1:]], [api.OK] * 3)
+
+    def test_reject_without_reading(self):
+        results = []
+        clients = self.fill(results)
+        silent = socket.create_connection(self.server.server_address,
+                                          timeout=5)
+        response = http.client.HTTPResponse(silent)
+        response.begin()
+        self.assertEqual(response.status, api.SERVICE_UNAVAILABLE)
+        self.assertEqual(response.getheader("Connection"), "close")
+        self.assertEqual(json.loads(response.read()),
+                         {"error": "Service Unavailable",
+                          "code": api.SERVICE_UNAVAILABLE})
+        silent.close()
+        BlockingHandler.release.set()
+        for client in clients:
+            client.join()
+
+    def test_reject_high_fd(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limit = 2048 if hard == resource.RLIM_INFINITY else min(hard, 2048)
+        if limit < 2048:
+            self.skipTest("can't open 2048 files")
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, limit), hard))
+        self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE,
+                        (soft, hard))
+        fds = [os.open(os.devnull, os.O_RDONLY) for _ in range(1100)]
+        for fd in fds:
+            self.addCleanup(os.close, fd)
+        results = []
+        clients = self.fill(results)
+        for _ in range(2):
+            self.post(results)
+        self.assertEqual([code for code, _ in results],
+                         [api.SERVICE_UNAVAILABLE] * 2)
+        # closer has polled the rejected sockets
+        threading.Event().wait(10 * api.REJECT_POLL)
+        self.assertTrue(self.server.closer.is_alive())
+        BlockingHandler.release.set()
+        for client in clients:
+            client.join()
+
+    def test_graceful_shutdown(self):
+        results = []
+        clients = self.fill(results)
+        self.server.shutdown()
+        BlockingHandler.release.set()
+        self.server.server_close()
+        self.closed = True
+        for client in clients:
+            client.join()
+        self.assertEqual([code for code, _ in results], [api.OK] * 3)
+        self.assertFalse(any(worker.is_alive()
+                             for worker in self.server.workers))
+
+
+class MetricsHandler(api.MainHTTPHandler):
+    """Handler with in-memory store and its own metrics."""
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        MetricsHandler.metrics = api.make_metrics()
+        MetricsHandler.store = api.instrument_store(
+            MetricsHandler.metrics,
+            store.Store(store.CircuitBreaker(store.MemoryStorage()),
+                        store.LocalCache()))
+        self.server = api.PooledHTTPServer(("localhost", 0), MetricsHandler,
+                                           workers=2, queue_size=4)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def request(self, method, path, body=None):
+        conn = http.client.HTTPConnection(*self.server.server_address,
+                                          timeout=10)
+        conn.request(method, path, body)
+        response = conn.getresponse()
+        result = response.status, response.getheader("Content-Type"), \
+            response.read().decode("utf-8")
+        conn.close()
+        return result
+
+    def test_histogram(self):
+        histogram = api.Metrics().histogram("latency", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        buckets, total, count = histogram.snapshot()
+        self.assertEqual(buckets, [(0.1, 2), (1, 3), (float("inf"), 4)])
+        self.assertAlmostEqual(total, 2.65)
+        self.assertEqual(count, 4)
+
+    def test_endpoint(self):
+        login = "h&f"
+        msg = "horns&hoofs" + login + api.SALT
+        body = json.dumps({"account": "horns&hoofs", "login": login,
+                           "method": "online_score",
+                           "token": hashlib.sha512(msg.encode()).hexdigest(),
+                           "arguments": {"first_name": "a",
+                                         "last_name": "b"}})
+        for _ in range(2):
+            self.assertEqual(self.request("POST", "/method/", body)[0],
+                             api.OK)
+        self.request("POST", "/method/", "{]")
+        status, content_type, text = self.request("GET", "/metrics")
+        self.assertEqual(status, api.OK)
+        self.assertTrue(content_type.startswith("text/plain"))
+        lines = text.splitlines()
+        self.assertIn("# TYPE api_request_duration_seconds histogram", lines)
+        self.assertIn('api_request_duration_seconds_count'
+                      '{method="online_score"} 2', lines)
+        self.assertIn('api_request_duration_seconds_bucket'
+                      '{method="online_score",le="+Inf"} 2', lines)
+        self.assertIn('api_responses_total{code="200"} 2', lines)
+        self.assertIn('api_responses_total{code="400"} 1', lines)
+        self.assertIn('api_in_flight_requests 0', lines)
+        self.assertIn('store_duration_seconds_count{operation="get"} 1',
+                      lines)
+        self.assertIn('store_duration_seconds_count{operation="set"} 1',
+                      lines)
+        self.assertIn('local_cache_hit_ratio 0.5', lines)
+        self.assertIn('store_circuit_open 0', lines)
+        self.assertIn('store_circuit_events_total{event="opened"} 0', lines)
+        self.assertEqual(self.request("GET", "/other")[0], api.NOT_FOUND)
+
+    def test_empty_batch(self):
+        status, _, text = self.request("POST", "/method/", "[]")
+        self.assertEqual(status, api.INVALID_REQUEST)
+        self.assertEqual(json.loads(text)["code"], api.INVALID_REQUEST)
+        self.assertEqual(self.request("POST", "/method/", "null")[0],
+                         api.BAD_REQUEST)
+
+
 if __name__ == "__main__":
     unittest.main()
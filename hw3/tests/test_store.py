@@ -1,11 +1,26 @@
 """Store functions testing.
 """
 
+import socket
+import threading
+import time
 import unittest
+import uuid
 import store
 import tarantool
 
 
+def tarantool_available(host="localhost", port=8888):
+    '''Check if Tarantool server accepts connections.
+    '''
+
+    try:
+        socket.create_connection((host, port), timeout=0.2).close()
+    except OSError:
+        return False
+    return True
+
+
 class TarantoolStoreTest(unittest.TestCase):
     """Tarantool storage get and set functions tests.
     """
@@ -45,5 +60,522 @@ class TarantoolStoreTest(unittest.TestCase):
         
         self.assertEqual(tarantool_retries, storage.RETRIES)
 
+    @unittest.skipUnless(tarantool_available(), "no Tarantool server")
+    def test_get_many(self):
+        '''Checks that several keys are read at once
+        and missing keys are None.
+        '''
+
+        tarantool_storage = store.TarantoolStorage()
+        storage = store.Store(tarantool_storage)
+        keys = ['key-%s' % uuid.uuid4().hex for _ in range(3)]
+        for key in keys[:2]:
+            tarantool_storage.set(key, key.upper(), 60)
+        self.assertEqual(storage.get_many(keys),
+                         {keys[0]: keys[0].upper(),
+                          keys[1]: keys[1].upper(),
+                          keys[2]: None})
+
+
+class FakeConnection:
+    """Connection stand-in, remembers if it was closed.
+    """
+
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+
+    def ping(self):
+        if not self.alive:
+            raise ConnectionError("connection lost")
+
+    def close(self):
+        self.closed = True
+
+
+class EvalConnection(FakeConnection):
+    """Connection stand-in evaluating GET_MANY_LUA over a dict.
+    """
+
+    def __init__(self, values):
+        super().__init__()
+        self.values = values
+        self.evals = []
+
+    def eval(self, script, args):
+        space, keys = args
+        self.evals.append(list(keys))
+
+        class Response:
+            data = [[self.values.get(key) for key in keys]]
+
+        return Response()
+
+
+class TarantoolGetManyTest(unittest.TestCase):
+    """TarantoolStorage.get_many batching over a fake connection.
+    """
+
+    def test_get_many(self):
+        '''Checks that keys are read in BATCH_SIZE batches
+        and missing keys are None.
+        '''
+
+        conn = EvalConnection({"i:1": '["books"]', "i:3": '["cars"]'})
+        tarantool_storage = store.TarantoolStorage()
+        tarantool_storage.BATCH_SIZE = 2
+        tarantool_storage.pool = store.ConnectionPool(lambda: conn)
+        storage = store.Store(tarantool_storage)
+        self.assertEqual(storage.get_many(["i:1", "i:2", "i:3"]),
+                         {"i:1": '["books"]', "i:2": None, "i:3": '["cars"]'})
+        self.assertEqual(conn.evals, [["i:1", "i:2"], ["i:3"]])
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Connection pool reuse, limits, health checks and backoff tests.
+    """
+
+    def setUp(self):
+        self.opened = []
+        self.down = False
+
+    def connect(self):
+        if self.down:
+            raise ConnectionError("connection refused")
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+    def test_reuse(self):
+        '''Checks that released connection is reused.
+        '''
+
+        pool = store.ConnectionPool(self.connect, size=2)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_size_limit(self):
+        '''Checks that no more than size connections are opened
+        and acquiring fails after acquire_timeout.
+        '''
+
+        pool = store.ConnectionPool(self.connect, size=2, acquire_timeout=0.05)
+        held = [pool.acquire(), pool.acquire()]
+        with self.assertRaises(store.StoreUnavailable):
+            pool.acquire()
+        self.assertEqual(pool.stats()["acquire_timeouts"], 1)
+        pool.acquire_timeout = 5
+        waiter = threading.Thread(target=lambda: held.append(pool.acquire()))
+        waiter.start()
+        pool.release(held[0])
+        waiter.join()
+        self.assertIs(held[-1], held[0])
+        self.assertEqual(len(self.opened), 2)
+
+    def test_broken_connection_dropped(self):
+        '''Checks that connection failed with network error is closed.
+        '''
+
+        pool = store.ConnectionPool(self.connect, size=1)
+        with self.assertRaises(ConnectionError):
+            with pool.connection() as conn:
+                raise ConnectionError("reset by peer")
+        self.assertTrue(conn.closed)
+        with pool.connection() as fresh:
+            self.assertIsNot(fresh, conn)
+        self.assertEqual(pool.stats()["opened"], 1)
+
+    def test_health_check(self):
+        '''Checks that stale idle connection is pinged and replaced.
+        '''
+
+        pool = store.ConnectionPool(self.connect, size=1, check_interval=0)
+        with pool.connection() as conn:
+            conn.alive = False
+        with pool.connection() as fresh:
+            self.assertIsNot(fresh, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()["health_check_failures"], 1)
+
+    def test_backoff(self):
+        '''Checks that after failed connect new connects
+        are rejected at once until backoff passes.
+        '''
+
+        pool = store.ConnectionPool(self.connect, backoff_base=10)
+        self.down = True
+        with self.assertRaises(store.StoreUnavailable):
+            pool.acquire()
+        self.down = False
+        with self.assertRaises(store.StoreUnavailable):
+            pool.acquire()
+        stats = pool.stats()
+        self.assertEqual(stats["backoff_rejects"], 1)
+        self.assertEqual(stats["opened"], 0)
+        pool.retry_at = 0
+        with pool.connection():
+            pass
+        self.assertEqual(pool.stats()["connect_failures_in_row"], 0)
+
+    def test_backoff_growth(self):
+        '''Checks that backoff doubles and is capped.
+        '''
+
+        pool = store.ConnectionPool(self.connect, backoff_base=1,
+                                    backoff_cap=4)
+        for failures, delay in [(1, 1), (2, 2), (3, 4), (10, 4)]:
+            pool.failures = failures
+            self.assertTrue(delay / 2 <= pool.backoff() <= delay)
+
+    def test_retry_without_sleep(self):
+        '''Checks that cache call gives up at once
+        when the store is down.
+        '''
+
+        class DownStorage:
+            calls = 0
+
+            def get(self, key):
+                self.calls += 1
+                raise ConnectionError("connection refused")
+
+        storage = store.Store(DownStorage())
+        self.assertIsNone(storage.cache_get("key"))
+        self.assertEqual(storage.storage.calls, store.Store.RETRIES)
+
+
+class MemoryStorageTest(unittest.TestCase):
+    """In-memory storage stand-in tests.
+    """
+
+    def test_get_set(self):
+        '''Checks get, get_many and set through Store.
+        '''
+
+        storage = store.Store(store.MemoryStorage({"i:1": '["books"]'}))
+        storage.cache_set("uid:1", 1.5, 60)
+        self.assertEqual(storage.cache_get("uid:1"), 1.5)
+        self.assertEqual(storage.get("i:1"), '["books"]')
+        self.assertEqual(storage.get_many(["i:1", "i:2"]),
+                         {"i:1": '["books"]', "i:2": None})
+        self.assertEqual(storage.storage.stats()["set"], 1)
+
+    def test_ttl(self):
+        '''Checks that expired value is not returned.
+        '''
+
+        storage = store.MemoryStorage()
+        storage.set("uid:1", 1.5, 0.01)
+        time.sleep(0.02)
+        self.assertIsNone(storage.get("uid:1"))
+
+    def test_latency(self):
+        '''Checks that every call waits injected latency.
+        '''
+
+        storage = store.MemoryStorage(latency=0.02)
+        start = time.monotonic()
+        storage.get("uid:1")
+        storage.get_many(["i:%s" % i for i in range(2500)])
+        self.assertGreaterEqual(time.monotonic() - start, 0.08)
+        self.assertEqual(storage.stats()["get_many"], 3)
+
+
+class FlakyStorage(store.MemoryStorage):
+    """Memory storage which can be switched down.
+    """
+
+    down = False
+
+    def round_trip(self, name):
+        super().round_trip(name)
+        if self.down:
+            raise ConnectionError("connection refused")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """Store circuit breaker tests.
+    """
+
+    def setUp(self):
+        self.storage = FlakyStorage()
+        self.breaker = store.CircuitBreaker(self.storage, threshold=3,
+                                            probe_interval=0.01)
+        self.addCleanup(self.breaker.close)
+
+    def wait_state(self, state):
+        deadline = time.monotonic() + 5
+        while self.breaker.state != state and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.breaker.state, state)
+
+    def test_opens_after_failures(self):
+        '''Checks that circuit opens after threshold failures in a row
+        and cache calls return at once without touching the storage.
+        '''
+
+        storage = store.Store(self.breaker)
+        self.breaker.probe_interval = 60
+        self.storage.down = True
+        self.assertIsNone(storage.cache_get("uid:1"))
+        self.assertEqual(self.breaker.state, store.CircuitBreaker.OPEN)
+        calls = self.storage.stats()["get"]
+        self.assertIsNone(storage.cache_get("uid:1"))
+        self.assertIsNone(storage.cache_set("uid:1", 1.5, 60))
+        self.assertEqual(self.storage.stats()["get"], calls)
+        self.assertEqual(self.breaker.stats()["short_circuited"], 2)
+        with self.assertRaises(store.CircuitOpen):
+            self.breaker.get_many(["i:1"])
+
+    def test_success_resets_failures(self):
+        '''Checks that only failures in a row open the circuit.
+        '''
+
+        for _ in range(5):
+            self.storage.down = True
+            for _ in range(2):
+                with self.assertRaises(ConnectionError):
+                    self.breaker.get("uid:1")
+            self.storage.down = False
+            self.breaker.get("uid:1")
+        self.assertEqual(self.breaker.state, store.CircuitBreaker.CLOSED)
+
+    def test_probe_closes(self):
+        '''Checks that background probe closes the circuit
+        when the storage recovers.
+        '''
+
+        self.storage.down = True
+        for _ in range(3):
+            with self.assertRaises(ConnectionError):
+                self.breaker.get("uid:1")
+        self.assertEqual(self.breaker.state, store.CircuitBreaker.OPEN)
+        time.sleep(0.05)
+        self.assertEqual(self.breaker.state, store.CircuitBreaker.OPEN)
+        self.storage.down = False
+        self.wait_state(store.CircuitBreaker.CLOSED)
+        self.breaker.set("uid:1", 1.5, 60)
+        stats = self.breaker.stats()
+        self.assertEqual((stats["opened"], stats["closed"]), (1, 1))
+        self.assertGreater(stats["probe_failures"], 0)
+
+
+class WriteBehindTest(unittest.TestCase):
+    """Asynchronous batched cache writes tests.
+    """
+
+    def setUp(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def flush(self, items):
+        self.release.wait(5)
+        self.batches.append(items)
+
+    def start(self, **kwargs):
+        writer = store.WriteBehind(**kwargs)
+        writer.start(self.flush)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_flush_on_size(self):
+        '''Checks that full batch is written without waiting interval.
+        '''
+
+        writer = self.start(batch_size=3, flush_interval=60)
+        for i in range(6):
+            writer.put("uid:%s" % i, i, 60)
+        deadline = time.monotonic() + 5
+        while len(self.batches) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.batches,
+                         [[("uid:%s" % i, i, 60) for i in range(3)],
+                          [("uid:%s" % i, i, 60) for i in range(3, 6)]])
+
+    def test_flush_on_time(self):
+        '''Checks that partial batch is written after flush_interval.
+        '''
+
+        writer = self.start(batch_size=100, flush_interval=0.02)
+        writer.put("uid:1", 1.5, 60)
+        time.sleep(0.2)
+        self.assertEqual(self.batches, [[("uid:1", 1.5, 60)]])
+        self.assertEqual(writer.stats()["written"], 1)
+
+    def test_merge_and_drop(self):
+        '''Checks that queued key is rewritten in place
+        and writes beyond max_pending are dropped.
+        '''
+
+        self.release.clear()
+        writer = self.start(batch_size=1, flush_interval=0, max_pending=2)
+        writer.put("uid:0", 0, 60)
+        while not writer.stats()["pending"] == 0:
+            time.sleep(0.01)
+        self.assertTrue(writer.put("uid:1", 1, 60))
+        self.assertTrue(writer.put("uid:2", 2, 60))
+        self.assertTrue(writer.put("uid:1", 10, 60))
+        self.assertFalse(writer.put("uid:3", 3, 60))
+        self.release.set()
+        writer.close()
+        self.assertEqual(self.batches, [[("uid:0", 0, 60)],
+                                        [("uid:1", 10, 60)],
+                                        [("uid:2", 2, 60)]])
+        stats = writer.stats()
+        self.assertEqual((stats["merged"], stats["dropped"]), (1, 1))
+
+    def test_drain_on_close(self):
+        '''Checks that close writes all queued values.
+        '''
+
+        writer = self.start(batch_size=4, flush_interval=60)
+        for i in range(10):
+            writer.put("uid:%s" % i, i, 60)
+        writer.close()
+        self.assertEqual([len(batch) for batch in self.batches], [4, 4, 2])
+        self.assertFalse(writer.thread.is_alive())
+        self.assertFalse(writer.put("uid:11", 11, 60))
+
+    def test_failed_batch(self):
+        '''Checks that failed batch is counted and writing goes on.
+        '''
+
+        def flush(items):
+            if items[0][0] == "uid:0":
+                raise ConnectionError("connection refused")
+            self.batches.append(items)
+
+        writer = store.WriteBehind(batch_size=1, flush_interval=0)
+        writer.start(flush)
+        writer.put("uid:0", 0, 60)
+        writer.put("uid:1", 1, 60)
+        writer.close()
+        stats = writer.stats()
+        self.assertEqual((stats["failed"], stats["written"]), (1, 1))
+
+    def test_store_cache_set(self):
+        '''Checks that cache_set through write-behind doesn't wait
+        for the storage and the value is written in batch.
+        '''
+
+        memory = store.MemoryStorage(latency=0.05)
+        storage = store.Store(memory, store.LocalCache(),
+                              store.WriteBehind(flush_interval=0.01))
+        start = time.monotonic()
+        for i in range(20):
+            storage.cache_set("uid:%s" % i, i, 60)
+        self.assertLess(time.monotonic() - start, 0.05)
+        self.assertEqual(storage.cache_get("uid:3"), 3)
+        storage.close()
+        self.assertEqual(memory.stats()["set_many"], 1)
+        self.assertEqual(memory.get("uid:19"), 19)
+
+
+class DictStorage:
+    """Storage stand-in counting get calls, get may be held by event.
+    """
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.gets = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def get(self, key):
+        self.gets += 1
+        self.release.wait(5)
+        return self.values.get(key)
+
+    def set(self, key, value, sec):
+        self.values[key] = value
+
+
+class LocalCacheTest(unittest.TestCase):
+    """In-process LRU/TTL cache in front of the store tests.
+    """
+
+    def test_hit_after_miss(self):
+        '''Checks that the second cache_get doesn't go to the store.
+        '''
+
+        storage = store.Store(DictStorage({"uid:1": 3.0}), store.LocalCache())
+        self.assertEqual(storage.cache_get("uid:1"), 3.0)
+        self.assertEqual(storage.cache_get("uid:1"), 3.0)
+        self.assertEqual(storage.storage.gets, 1)
+        stats = storage.local_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_set_writes_through(self):
+        '''Checks that cache_set fills both levels.
+        '''
+
+        storage = store.Store(DictStorage(), store.LocalCache())
+        storage.cache_set("uid:1", 1.5, 60)
+        self.assertEqual(storage.storage.values, {"uid:1": 1.5})
+        self.assertEqual(storage.cache_get("uid:1"), 1.5)
+        self.assertEqual(storage.storage.gets, 0)
+
+    def test_ttl(self):
+        '''Checks that expired entry is loaded again.
+        '''
+
+        cache = store.LocalCache(ttl=60)
+        cache.set("uid:1", 1.5, 0)
+        self.assertIsNone(cache.get("uid:1"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_lru_eviction(self):
+        '''Checks that least recently used entry is evicted
+        when memory budget is exceeded.
+        '''
+
+        cache = store.LocalCache()
+        cache.max_bytes = 3 * cache.entry_size("uid:1", 1.5)
+        for key in ["uid:1", "uid:2", "uid:3"]:
+            cache.set(key, 1.5)
+        cache.get("uid:1")
+        cache.set("uid:4", 1.5)
+        self.assertIsNone(cache.get("uid:2"))
+        self.assertEqual(cache.get("uid:1"), 1.5)
+        stats = cache.stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertLessEqual(stats["nbytes"], cache.max_bytes)
+
+    def test_single_flight(self):
+        '''Checks that concurrent misses of one key
+        make a single store lookup.
+        '''
+
+        storage = store.Store(DictStorage({"uid:1": 3.0}), store.LocalCache())
+        storage.storage.release.clear()
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(storage.cache_get("uid:1")))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        while storage.local_cache.stats().get("coalesced", 0) < 7:
+            threading.Event().wait(0.01)
+        storage.storage.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [3.0] * 8)
+        self.assertEqual(storage.storage.gets, 1)
+
+    def test_miss_not_cached(self):
+        '''Checks that missing key is looked up in the store again.
+        '''
+
+        storage = store.Store(DictStorage(), store.LocalCache())
+        self.assertIsNone(storage.cache_get("uid:1"))
+        self.assertIsNone(storage.cache_get("uid:1"))
+        self.assertEqual(storage.storage.gets, 2)
+
+
 if __name__ == "__main__":
     unittest.main()